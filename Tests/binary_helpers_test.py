@@ -0,0 +1,35 @@
+import os
+import tempfile
+
+import numpy as np
+
+from sample_maps import write_sample_maps
+
+import binary_helpers as bh
+import map_loaders as ml
+
+
+def test_binary_round_trip():
+    with tempfile.TemporaryDirectory() as target:
+        for path in write_sample_maps(os.path.join(target, '')):
+            binary_path = path[:-len('.json')] + '.mdrb'
+            bh.json_to_binary(path, binary_path)
+            map_type, fields, arrays = ml.load_map_arrays(path)
+            binary_type, binary_fields, binary_arrays = bh.load_binary_map(binary_path)
+            assert binary_type == map_type
+            assert binary_fields == fields
+            assert binary_arrays.keys() == arrays.keys()
+            for name, array in arrays.items():
+                assert binary_arrays[name].dtype == array.dtype
+                assert np.array_equal(binary_arrays[name], array)
+
+            # the json backend with exact floats writes the same file again
+            round_trip = path[:-len('.json')] + '_round_trip.json'
+            bh.binary_to_json(binary_path, round_trip)
+            with open(path, 'r') as original, open(round_trip, 'r') as converted:
+                assert original.read() == converted.read(), path
+
+
+if __name__ == "__main__":
+    test_binary_round_trip()
+    print("binary_helpers tests passed")
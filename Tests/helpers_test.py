@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers as he  # noqa: E402
+
+
+def test_index_mesh_merges_close_vertices():
+    # the two vertices are closer than the tolerance but on both sides of a cell boundary of the hashing grid
+    polygons = [[[2.5e-6 - 1e-12, 0, 0], [1, 0, 0], [0, 1, 0]], [[2.5e-6 + 1e-12, 0, 0], [1, 1, 0], [0, 1, 0]]]
+    vertices, offsets, indices = he.index_mesh(polygons)
+    assert len(vertices) == 4 and offsets.tolist() == [0, 3, 6] and indices.tolist() == [0, 1, 2, 0, 3, 2]
+
+
+def test_index_mesh_against_brute_force():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 1.5e-5, (300, 3))
+    points[::3, 0] = np.rint(points[::3, 0] / he.MESH_TOLERANCE) * he.MESH_TOLERANCE
+    vertices, _, indices = he.index_mesh([points])
+    # the vertices closer than the tolerance, directly or through other vertices, share the smallest index of them
+    close = np.linalg.norm(points[:, None] - points[None], axis=2) <= he.MESH_TOLERANCE
+    label = np.arange(len(points))
+    while True:
+        low = np.array([label[row].min() for row in close])
+        if np.array_equal(low, label):
+            break
+        label = low
+    assert np.array_equal(np.unique(label, return_inverse=True)[1].ravel(), indices)
+    assert np.array_equal(vertices, points[np.unique(label)])
+
+
+if __name__ == "__main__":
+    test_index_mesh_merges_close_vertices()
+    test_index_mesh_against_brute_force()
+    print("helpers tests passed")
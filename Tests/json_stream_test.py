@@ -0,0 +1,57 @@
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_stream as js  # noqa: E402
+
+DOCUMENT = {'a': [1.5, -0.25e-3, 1E+10, 12345, 0, -7, 3.0e2, True, False, None, 'x"y\\z', 'unicode é'],
+            'b': {'c': [[-1.25], [], {}], 'd': 'text'}, 'e': 2.75, 'f': -12}
+
+
+def test_read_value_with_tiny_buffers():
+    for text in (json.dumps(DOCUMENT), json.dumps(DOCUMENT, indent=2), '-12.5e3', '[1.5]', '7'):
+        for buffer_size in range(1, 12):
+            reader = js.JsonStreamReader(io.StringIO(text), buffer_size)
+            assert reader.read_value() == json.loads(text), (text, buffer_size)
+            assert reader.peek() == ''
+
+
+def test_walk_with_tiny_buffers():
+    text = json.dumps(DOCUMENT)
+    for buffer_size in range(1, 12):
+        reader = js.JsonStreamReader(io.StringIO(text), buffer_size)
+        walked = {}
+        for key in reader.iter_object():
+            if key == 'a':
+                walked[key] = list(reader.iter_values())
+            elif key == 'b':
+                walked[key] = {}
+                for member in reader.iter_object():
+                    if member == 'c':
+                        walked[key][member] = [reader.read_value() for _ in reader.iter_array()]
+                    else:
+                        walked[key][member] = reader.read_value()
+            else:
+                walked[key] = reader.read_value()
+        assert walked == DOCUMENT, buffer_size
+
+
+def test_invalid_json():
+    for text in ('[1.]', '[1, 2', '[{"a" 1}]', '[1 2]', '[-]'):
+        for buffer_size in (1, 2, 100):
+            reader = js.JsonStreamReader(io.StringIO(text), buffer_size)
+            try:
+                list(reader.iter_values())
+            except ValueError:
+                continue
+            raise AssertionError("%r was accepted with a buffer of %d" % (text, buffer_size))
+
+
+if __name__ == "__main__":
+    test_read_value_with_tiny_buffers()
+    test_walk_with_tiny_buffers()
+    test_invalid_json()
+    print("json_stream tests passed")
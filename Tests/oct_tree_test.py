@@ -0,0 +1,138 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import oct_tree as oc  # noqa: E402
+
+
+def brute_force_radius(points, ids, query, radius):
+    distances = np.linalg.norm(points - query, axis=1)
+    return set(ids[distances <= radius].tolist())
+
+
+def check_queries(tree, points, ids, rng):
+    """
+    Function comparing the queries of the tree with a brute force search over its points.
+    :param tree: built OctTree
+    :param points: (N,3) array of the stored points
+    :param ids: (N,) array of the indices of the stored points
+    :param rng: random generator of the queries
+    """
+    leaves = tree.locate_batch(points)
+    assert (leaves >= 0).all() and tree.leaf[leaves].all()
+    assert np.logical_and(tree.bounds[leaves, :3] <= points, points <= tree.bounds[leaves, 3:]).all()
+    counts = tree.point_end - tree.point_start
+    assert counts[0] == len(points)
+    assert (counts[tree.leaf & (tree.depth < tree.max_depth)] < tree.point_threshold).all()
+
+    queries = points[rng.choice(len(points), 40)] + rng.normal(scale=0.1, size=(40, 3))
+    radii = rng.uniform(0.1, 1.0, len(queries))
+    offsets, found, distances = tree.radius_query_batch(queries, radii)
+    for i, (query, radius) in enumerate(zip(queries, radii)):
+        assert set(found[offsets[i]:offsets[i + 1]].tolist()) == brute_force_radius(points, ids, query, radius)
+        assert np.allclose(distances[offsets[i]:offsets[i + 1]],
+                           np.linalg.norm(points[np.searchsorted(ids, found[offsets[i]:offsets[i + 1]])] - query,
+                                          axis=1))
+
+    k = 7
+    _, knn_distances = tree.knn_query_batch(queries, k)
+    for query, row in zip(queries, knn_distances):
+        assert np.allclose(row, np.sort(np.linalg.norm(points - query, axis=1))[:k])
+
+    lowers = queries - rng.uniform(0, 0.5, queries.shape)
+    uppers = queries + rng.uniform(0, 0.5, queries.shape)
+    offsets, found = tree.box_query_batch(lowers, uppers)
+    occupied = np.flatnonzero(tree.leaf & (counts > 0))
+    for i, (lower, upper) in enumerate(zip(lowers, uppers)):
+        bounds = tree.bounds[occupied]
+        expected = occupied[np.logical_and(bounds[:, :3] <= upper, bounds[:, 3:] >= lower).all(axis=1)]
+        assert np.array_equal(found[offsets[i]:offsets[i + 1]], expected)
+
+
+def test_build_and_queries():
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(3000, 3))
+    for contiguous in (False, True):
+        tree = oc.OctTree(points, 10, contiguous=contiguous)
+        tree.build_tree()
+        check_queries(tree, points, np.arange(len(points)), rng)
+
+
+def test_insert_remove_round_trip():
+    rng = np.random.default_rng(1)
+    points = rng.normal(size=(2000, 3))
+    for contiguous in (False, True):
+        tree = oc.OctTree(points, 10, contiguous=contiguous)
+        tree.build_tree()
+        # partly outside of the root, which has to grow
+        batch = rng.normal(loc=3.0, scale=2.0, size=(1500, 3))
+        tree.insert(batch)
+        assert tree.max_depth == oc.MAX_DEPTH
+        check_queries(tree, np.concatenate([points, batch]), np.arange(len(points) + len(batch)), rng)
+
+        assert tree.remove(batch) == len(batch)
+        assert tree.remove(batch) == 0
+        check_queries(tree, points, np.arange(len(points)), rng)
+
+
+def segment_touches_box(a, b, lower, upper, slack=1e-9):
+    # slab test of the segment from a to b against the closed box
+    t_low, t_high = 0.0, 1.0
+    for axis in range(3):
+        d = b[axis] - a[axis]
+        if d == 0:
+            if not lower[axis] - slack <= a[axis] <= upper[axis] + slack:
+                return False
+            continue
+        t0, t1 = sorted([(lower[axis] - slack - a[axis]) / d, (upper[axis] + slack - a[axis]) / d])
+        t_low, t_high = max(t_low, t0), min(t_high, t1)
+    return t_low <= t_high
+
+
+def test_occupancy_rays_match_sampling():
+    cube = dict(x_min=0, y_min=0, z_min=0, x_max=8, y_max=8, z_max=8)
+    tree = oc.OccupancyOctTree(cube, 3)
+    rng = np.random.default_rng(2)
+    # origins on a cell corner, on a face, inside a cell and outside of the cube
+    for origin in ([4, 4, 4], [4, 2.5, 3], [1.3, 6.2, 0.7], [-3, 4, 4]):
+        origin = np.array(origin, dtype=float)
+        # ends anywhere, on cell corners, and along diagonals crossing several boundaries at once
+        ends = np.concatenate([rng.uniform(-4, 12, (60, 3)), rng.integers(-3, 12, (60, 3)).astype(float),
+                               origin + rng.integers(-6, 7, (30, 1)) * np.array([[1, 1, 1]]),
+                               origin + rng.integers(-6, 7, (30, 1)) * np.array([[1, -1, 0]])])
+        for end in ends:
+            hits, free = tree.cast_rays(origin, [end])
+            cells = np.concatenate([hits, free])
+            # every cell the ray passes through is found
+            t = np.linspace(0, 1, 2001)[1:-1, None]
+            samples = origin + t * (end - origin)
+            samples = samples[np.logical_and(samples >= 0, samples < 8).all(axis=1) &
+                              (np.abs(samples - np.rint(samples)) > 1e-7).all(axis=1)]
+            assert np.isin(tree._codes(np.floor(samples)), cells).all(), (origin, end)
+            # and every cell found is touched by the ray
+            for cell in tree._cells(cells):
+                assert segment_touches_box(origin, end, cell, cell + 1), (origin, end, cell)
+
+
+def test_occupancy_pruning():
+    cube = dict(x_min=0, y_min=0, z_min=0, x_max=8, y_max=8, z_max=8)
+    tree = oc.OccupancyOctTree(cube, 3)
+    rng = np.random.default_rng(3)
+    directions = rng.normal(size=(20000, 3))
+    # the rays from the center of the cube leave it, so every cell becomes free
+    ends = 4 + 20 * directions / np.linalg.norm(directions, axis=1)[:, None]
+    for _ in range(int(np.ceil(tree.clamp[0] / tree.miss))):
+        tree.insert_scan([4, 4, 4], ends)
+    assert len(tree) == 1 and tree.levels[0] == 0 and tree.values[0] == np.float32(tree.clamp[0])
+    assert (tree.occupancy(rng.uniform(0, 8, (100, 3))) == 0).all()
+
+
+if __name__ == "__main__":
+    test_build_and_queries()
+    test_insert_remove_round_trip()
+    test_occupancy_rays_match_sampling()
+    test_occupancy_pruning()
+    print("oct_tree tests passed")
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import helpers as he  # noqa: E402
+import json_helpers as jh  # noqa: E402
+import oct_tree as oc  # noqa: E402
+import toy_example_generator as tg  # noqa: E402
+
+
+def write_sample_maps(targetpath, seed=0):
+    """
+    Function writing a small local map of every type from random points and from the walls of test_1.csv.
+    :param targetpath: directory receiving the maps, ending with a separator
+    :param seed: seed of the random points
+    :return: list of the paths of the maps
+    """
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 4, (500, 3))
+    labels = rng.integers(0, 5, len(points))
+    cube = he.compute_max_cube(points)
+    h, _ = tg.compute_pseudo_dens_grid_chunked([(points, labels)], cube, 1.0)
+    tree = oc.OctTree(points, 20)
+    tree.build_tree()
+    occupancy_tree = tg.build_occupancy_oct_tree([(points, labels)], cube, 1.0, oc.MAX_DEPTH)
+    paras = tg.generate_parallelograms(os.path.join(ROOT, 'test_1.csv'))
+
+    jh.save_dense_grid_as_jason(h.shape, h.ravel(order='F'), [1.0] * 3, targetpath=targetpath)
+    jh.save_sparse_grid_as_jason(h.shape, tg.sparse_grid_from_dense_grid(h), [1.0] * 3, targetpath=targetpath)
+    jh.save_point_cloud_as_jason(points, targetpath=targetpath, labels=labels)
+    jh.save_oct_map_as_jason(tree, [cube['x_max'] - cube['x_min']] * 3, targetpath=targetpath)
+    jh.save_oct_map_as_jason(occupancy_tree, [cube['x_max'] - cube['x_min']] * 3, file_name='test_occupancy',
+                             targetpath=targetpath)
+    jh.save_mesh_as_json([{'par': wall, 'points': []} for wall in paras], targetpath=targetpath)
+    return sorted(os.path.join(targetpath, name) for name in os.listdir(targetpath) if name.endswith('_map.json'))
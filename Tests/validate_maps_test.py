@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+
+from sample_maps import write_sample_maps
+
+import validate_maps as vm
+
+
+def corrupted_maps(path):
+    """
+    Generator producing invalid variants of a local map: every field replaced by a number or removed, and the first
+    item of every list replaced by a number.
+    :param path: path of a valid local map
+    :return: iterator over pairs of a description and the modified map
+    """
+    with open(path, 'r') as f:
+        local_map = json.load(f)
+    for key in local_map:
+        yield 'number ' + key, dict(local_map, **{key: 1})
+        yield 'without ' + key, {k: v for k, v in local_map.items() if k != key}
+        if isinstance(local_map[key], list) and local_map[key]:
+            yield 'number item ' + key, dict(local_map, **{key: [1] + local_map[key][1:]})
+    if 'tree' in local_map:
+        yield 'number child', dict(local_map, tree=dict(local_map['tree'], node_children=[1] * 8))
+
+
+def test_streaming_and_full_validation_agree():
+    with tempfile.TemporaryDirectory() as target:
+        maps = write_sample_maps(os.path.join(target, ''))
+        for path in maps:
+            for streaming in (False, True):
+                result = vm.validate_file(path, streaming=streaming)
+                assert result['valid'], (path, streaming, result['error'])
+
+        tested = 0
+        for path in maps:
+            for description, local_map in corrupted_maps(path):
+                corrupted = os.path.join(target, 'corrupted.json')
+                with open(corrupted, 'w') as f:
+                    json.dump(local_map, f)
+                full = vm.validate_file(corrupted)
+                streamed = vm.validate_file(corrupted, streaming=True)
+                assert full['valid'] == streamed['valid'], (path, description, full['error'], streamed['error'])
+                tested += not full['valid']
+        assert tested > 0
+
+
+def test_malformed_files_do_not_abort_the_batch():
+    with tempfile.TemporaryDirectory() as target:
+        valid = write_sample_maps(os.path.join(target, ''))[0]
+        malformed = os.path.join(target, 'malformed.json')
+        for text in ('5', '[1]', '{"list_of_voxels": [1, 2]}', '{"tree": 1}', '{"list_of_points": [[1, 2]]'):
+            with open(malformed, 'w') as f:
+                f.write(text)
+            for streaming in (False, True):
+                summary = vm.validate_files([malformed, valid], workers=1, streaming=streaming)
+                assert (summary['valid'], summary['invalid']) == (1, 1), (text, streaming)
+
+
+if __name__ == "__main__":
+    test_streaming_and_full_validation_agree()
+    test_malformed_files_do_not_abort_the_batch()
+    print("validate_maps tests passed")
@@ -0,0 +1,208 @@
+import argparse
+import datetime as dt
+import functools
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import helpers as he
+import json_helpers as jh
+import oct_tree as oc
+import surface_voxelization as sv
+import toy_example_generator as tg
+import validate_maps as vm
+import voxel_pyramid as vp
+
+# total number of measurement points of the benchmarked scenes
+scales = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+# size of the room of the synthetic scene in meters
+ROOM_SIZE = (12.0, 9.0, 3.0)
+# number of levels of the benchmarked grid pyramids, level 0 being the grid itself
+PYRAMID_LEVELS = 3
+
+
+def write_scene_csv(path, interior_walls=10, seed=None):
+    """
+    Function writing a synthetic scene in the input format of toy_example_generator.generate_parallelograms: the
+    floor, the ceiling and the four walls of a room with vertical interior walls at random places.
+    :param path: path of the CSV file
+    :param interior_walls: number of interior walls
+    :param seed: seed of the random generator placing the interior walls
+    """
+    x, y, z = ROOM_SIZE
+    walls = [[0, 0, 0, x, 0, 0, x, y, 0], [0, 0, z, x, 0, z, x, y, z],
+             [0, 0, z, 0, 0, 0, x, 0, 0], [x, 0, z, x, 0, 0, x, y, 0],
+             [x, y, z, x, y, 0, 0, y, 0], [0, y, z, 0, y, 0, 0, 0, 0]]
+    rng = np.random.default_rng(seed)
+    for _ in range(interior_walls):
+        start = rng.uniform([0, 0], [x, y])
+        end = np.clip(start + rng.normal(0, min(x, y) / 4, 2), [0, 0], [x, y])
+        height = rng.uniform(z / 2, z)
+        walls.append([start[0], start[1], height, start[0], start[1], 0, end[0], end[1], 0])
+    with open(path, 'w') as outfile:
+        for wall in walls:
+            outfile.write(','.join('%r' % float(v) for v in wall) + '\n')
+
+
+def measure(function, *args, trace_memory=True):
+    """
+    Function calling a function and measuring its wall clock time and the peak of the memory it allocates.
+    :param function: function to call
+    :param args: arguments of the function
+    :param trace_memory: if False the memory is not measured, tracemalloc slows down the code allocating many Python
+    objects
+    :return: result of the function, time in seconds and peak of the traced memory in bytes (None if not traced)
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def write_dense_pyramid(grid, levels, resolution, file_name, targetpath):
+    # pyramid of the dense grid written from its level 1, level 0 being the dense grid map
+    jh.save_dense_pyramid_as_jason(vp.dense_pyramid(grid, levels), resolution, 1, file_name, targetpath)
+
+
+def write_sparse_pyramid(sparse_grid, levels, shape, resolution, file_name, targetpath):
+    # pyramid of the sparse grid written from its level 1, level 0 being the sparse grid map
+    jh.save_sparse_pyramid_as_jason(vp.sparse_pyramid(sparse_grid, levels), shape, resolution, 1, file_name, targetpath)
+
+
+def benchmark_scene(scene_file, point_count, target, resolution=0.25, seed=0, trace_memory=True, validate=True,
+                    pyramid_levels=PYRAMID_LEVELS):
+    """
+    Function benchmarking every stage of the map generation on a scene: the point generation, the grids, the exact
+    voxelization of the walls, the octrees, the indexing of the mesh, the JSON writers and the full and streaming
+    validators of the written maps.
+    :param scene_file: CSV file of the parallelograms of the scene
+    :param point_count: number of measurement points, shared among the walls by their surface
+    :param target: directory the maps are written to
+    :param resolution: size of the grid voxels
+    :param seed: seed of the random generator of the points
+    :param trace_memory: if False the memory is not measured
+    :param validate: if False the written maps are not validated
+    :param pyramid_levels: number of levels of the grid pyramids, the levels above 0 are written
+    :return: list of dictionaries with the number of points, the stage, its time in seconds, its peak memory in bytes
+    and the size of the written files in bytes for the writers or the outcome of the validation for the validators
+    """
+    paras = tg.generate_parallelograms(scene_file)
+    corners = sv.parallelogram_corners(paras)
+    area = np.linalg.norm(np.cross(corners[:, 0] - corners[:, 1], corners[:, 2] - corners[:, 1]), axis=1).sum()
+    num_points = tg.compute_wall_point_counts(paras, points_per_m2=point_count / area)
+    points_total = int(num_points.sum())
+    prefix = os.path.join(target, '')
+    records = []
+
+    def run(stage, function, *args):
+        result, seconds, peak = measure(function, *args, trace_memory=trace_memory)
+        records.append({'points': points_total, 'stage': stage, 'seconds': seconds, 'peak_memory': peak})
+        return result
+
+    def generate():
+        chunks = list(tg.iter_pseudo_measurement_chunks(paras, num_points, 0.05, 1000000,
+                                                        np.random.default_rng(seed)))
+        if not chunks:
+            return np.empty((0, 3)), np.empty(0, dtype=int)
+        return np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks])
+
+    def build_oct_tree():
+        tree = oc.OctTree(points, 20, contiguous=True)
+        tree.build_tree()
+        return tree
+
+    points, labels = run('generate_points', generate)
+    cube = he.compute_max_cube(points)
+    edges = he.grid_edges(cube, resolution)
+    h, _ = run('dense_grid', tg.compute_pseudo_dens_grid_chunked, tg.shared_chunks(points, labels, 1000000), cube,
+               resolution)
+    sparse = run('sparse_grid', tg.compute_pseudo_sparse_grid_chunked, tg.shared_chunks(points, labels, 1000000),
+                 cube, resolution)
+    run('voxelize_walls', sv.sparse_grid_from_parallelograms, paras, edges)
+    tree = run('oct_tree', build_oct_tree)
+    occupancy_tree = run('occupancy_oct_tree', tg.build_occupancy_oct_tree, tg.shared_chunks(points, labels, 1000000),
+                         cube, resolution, oc.MAX_DEPTH)
+
+    mesh = [{'par': w, 'points': []} for w in paras]
+    mesh_arrays = run('index_mesh', he.index_mesh, he.mesh_polygons(mesh))
+
+    shape = [len(e) - 1 for e in edges]
+    levels = ['_level%d' % level for level in range(1, pyramid_levels)]
+    # name of the stage, writer, its arguments and the suffixes of the written files
+    writers = [('dense_grid', jh.save_dense_grid_as_jason, (h.shape, h.ravel(order='F'), [resolution] * 3), ['']),
+               ('dense_pyramid', write_dense_pyramid, (h, pyramid_levels, [resolution] * 3), levels),
+               ('sparse_grid', jh.save_sparse_grid_as_jason, (shape, sparse, [resolution] * 3), ['']),
+               ('sparse_pyramid', write_sparse_pyramid, (sparse, pyramid_levels, shape, [resolution] * 3), levels),
+               ('point_cloud', jh.save_point_cloud_chunks_as_jason, (tg.shared_chunks(points, labels, 1000000),), ['']),
+               ('oct', jh.save_oct_map_as_jason, (tree, [cube['x_max'] - cube['x_min']] * 3), ['']),
+               ('occupancy_oct', jh.save_oct_map_as_jason, (occupancy_tree, [cube['x_max'] - cube['x_min']] * 3), ['']),
+               ('mesh', jh.save_mesh_as_json, (mesh,), ['']),
+               ('indexed_mesh', jh.save_indexed_mesh_as_json, mesh_arrays, [''])]
+    for name, writer, args, suffixes in writers:
+        run('write_' + name, functools.partial(writer, file_name=name, targetpath=prefix), *args)
+        records[-1]['output_bytes'] = sum(os.path.getsize(prefix + name + suffix + '_map.json') for suffix in suffixes)
+    if validate:
+        for name, _, _, suffixes in writers:
+            files = [prefix + name + suffix + '_map.json' for suffix in suffixes]
+            for stage, streaming in (('validate_' + name, False), ('validate_' + name + '_streaming', True)):
+                summary = run(stage, vm.validate_files, files, None, 1, streaming)
+                records[-1]['valid'] = summary['invalid'] == 0
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the generation, export and validation of the maps.')
+    parser.add_argument('--scales', type=int, nargs='+', default=scales[:3],
+                        help='numbers of points of the benchmarked scenes, from %d to %d' % (scales[0], scales[-1]))
+    parser.add_argument('--resolution', type=float, default=0.25, help='size of the grid voxels in meters')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the scene and of the points')
+    parser.add_argument('--scene', type=str, default=None,
+                        help='CSV file of the parallelograms, a synthetic room is generated by default')
+    parser.add_argument('--validate-max-points', type=int, default=10 ** 6,
+                        help='largest scale whose maps are validated')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='only measure the time, tracing the memory slows down the Python heavy stages')
+    parser.add_argument('--maps-dir', type=str, default=None,
+                        help='directory keeping the written maps, a temporary directory by default')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='file receiving the results')
+    args = parser.parse_args()
+    if min(args.scales) < 1:
+        parser.error("--scales must be positive")
+
+    results = {'created': dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+               'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+               'encoder': dict(jh.encoder), 'seed': args.seed, 'resolution': args.resolution,
+               'memory_traced': not args.no_memory, 'records': []}
+    with tempfile.TemporaryDirectory() as temporary:
+        scene = args.scene
+        if scene is None:
+            scene = os.path.join(temporary, 'scene.csv')
+            write_scene_csv(scene, seed=args.seed)
+        target = args.maps_dir if args.maps_dir is not None else temporary
+        os.makedirs(target, exist_ok=True)
+        for point_count in args.scales:
+            records = benchmark_scene(scene, point_count, target, args.resolution, args.seed, not args.no_memory,
+                                      point_count <= args.validate_max_points)
+            for record in records:
+                memory = '' if record['peak_memory'] is None else '%10.1f MB' % (record['peak_memory'] / 2 ** 20)
+                print('%10d %-34s %9.3f s %s' % (record['points'], record['stage'], record['seconds'], memory))
+            results['records'].extend(records)
+            # every scale is saved, so the results of a long run are kept if it is interrupted
+            with open(args.output, 'w') as outfile:
+                json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import json
+import struct
+
+import numpy as np
+
+import json_helpers as jh
+import map_loaders as ml
+
+# file layout: MAGIC, little-endian uint64 length of the JSON header, the JSON header padded with spaces, then the raw
+# little-endian arrays, every array starting at a multiple of ALIGNMENT bytes from the beginning of the file
+MAGIC = b'MDR3DBIN'
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_binary_map(path, map_type, fields, arrays):
+    """
+    Function saving a local map into the binary container.
+    :param path: path of the file
+    :param map_type: one of map_loaders.map_types
+    :param fields: dictionary with the header fields of the map, as in the JSON file
+    :param arrays: dictionary of arrays holding the list fields of the map
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    descriptions = {name: {'dtype': array.dtype.newbyteorder('<').str, 'shape': list(array.shape)}
+                    for name, array in arrays.items()}
+
+    # the offsets depend on the header length, which depends on the offsets: reserve room for them first
+    header = {'map_type': map_type, 'fields': fields, 'arrays': descriptions}
+    for description in descriptions.values():
+        description['offset'] = 0
+    header_length = len(json.dumps(header).encode()) + 32 * len(arrays)
+    offset = _aligned(len(MAGIC) + 8 + header_length)
+    for name, array in arrays.items():
+        descriptions[name]['offset'] = offset
+        offset = _aligned(offset + array.nbytes)
+    encoded = json.dumps(header).encode().ljust(header_length)
+
+    with open(path, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(struct.pack('<Q', header_length))
+        outfile.write(encoded)
+        for name, array in arrays.items():
+            outfile.write(b'\0' * (descriptions[name]['offset'] - outfile.tell()))
+            outfile.write(array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes())
+
+
+def load_binary_map(path):
+    """
+    Function loading a local map from the binary container. The arrays are memory mapped, nothing is read before it
+    is accessed.
+    :param path: path of the file
+    :return: map type, dictionary with the header fields and dictionary of read-only arrays
+    :raises ValueError: if the file is not a binary local map
+    """
+    with open(path, 'rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a binary local map" % path)
+        header_length, = struct.unpack('<Q', infile.read(8))
+        header = json.loads(infile.read(header_length).decode())
+
+    arrays = {}
+    for name, description in header['arrays'].items():
+        shape = tuple(description['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=description['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=description['dtype'], mode='r', offset=description['offset'],
+                                     shape=shape)
+    return header['map_type'], header['fields'], arrays
+
+
+def arrays_to_blocks(map_type, arrays):
+    """
+    Function converting the arrays of a local map to the list and raw fields of write_map_json.
+    :param map_type: one of map_loaders.map_types
+    :param arrays: dictionary of arrays, as returned by map_loaders.load_map_arrays or load_binary_map
+    :return: list of pairs of a field name and an iterator over blocks of its items and list of pairs of a field name
+    and an iterator over the fragments of its JSON text
+    """
+    block = jh.BLOCK_SIZE
+    if map_type == 'densegrid':
+        voxels = arrays['voxels']
+        return [('list_of_voxels', ((voxels[s:s + block],) for s in range(0, len(voxels), block)))], []
+    if map_type in ['sparsegrid', 'pointcloud']:
+        coords = arrays['coordinates']
+        values = arrays['values' if map_type == 'sparsegrid' else 'characteristics']
+        key = 'list_of_voxels' if map_type == 'sparsegrid' else 'list_of_points'
+        return [(key, ((coords[s:s + block], values[s:s + block]) for s in range(0, len(coords), block)))], []
+    if map_type == 'octree':
+        return [], [('tree', jh.oct_tree_fragments(arrays['node_characteristics'], arrays['child_counts']))]
+    coords = arrays['coordinates']
+    values = arrays['characteristics']
+    polygons = jh.polygon_items(arrays['polygon_offsets'], arrays['polygon_indices'], arrays['polygon_characteristics'])
+    return [('list_of_points', ((coords[s:s + block], values[s:s + block]) for s in range(0, len(coords), block))),
+            ('list_of_polygons', jh.iter_blocks(polygons))], []
+
+
+def json_to_binary(json_path, binary_path):
+    """
+    Function converting a local map from the JSON file to the binary container.
+    :param json_path: path of the JSON file
+    :param binary_path: path of the binary file
+    """
+    save_binary_map(binary_path, *ml.load_map_arrays(json_path))
+
+
+def binary_to_json(binary_path, json_path):
+    """
+    Function converting a local map from the binary container to the JSON file. With the json backend and exact floats
+    of json_helpers the file is identical to the one written by json_helpers.
+    :param binary_path: path of the binary file
+    :param json_path: path of the JSON file
+    """
+    map_type, fields, arrays = load_binary_map(binary_path)
+    jh.write_map_json(json_path, fields, *arrays_to_blocks(map_type, arrays))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converter between JSON local maps and the binary container.')
+    parser.add_argument('direction', choices=['to_binary', 'to_json'], help='direction of the conversion')
+    parser.add_argument('input_file', type=str, help='file to convert')
+    parser.add_argument('output_file', type=str, help='converted file')
+    args = parser.parse_args()
+
+    if args.direction == 'to_binary':
+        json_to_binary(args.input_file, args.output_file)
+    else:
+        binary_to_json(args.input_file, args.output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
+import itertools
+from multiprocessing import shared_memory
+
 import numpy as np
 
+# largest distance between the vertices of the polygons merged by index_mesh, in meters
+MESH_TOLERANCE = 1e-6
+
 
 def divide_cube(cube):
     x_mid = cube['x_min'] + (cube['x_max'] - cube['x_min']) / 2
@@ -24,43 +30,383 @@ def divide_cube(cube):
     return cubes
 
 
-def in_cube(points, cube):
+def in_cube_mask(points, cube):
     """
+    Function testing which points lie in the cube, the lower faces of the cube are inclusive, the upper exclusive.
+    :param points: (N,3) array of points
+    :param cube: dictionary with the corners of the cube
+    :return: (N,) boolean mask
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    lower = np.array([cube['x_min'], cube['y_min'], cube['z_min']])
+    upper = np.array([cube['x_max'], cube['y_max'], cube['z_max']])
+    return np.logical_and(points >= lower, points < upper).all(axis=1)
+
 
-    :param points:
-    :param cube:
-    :return:
-    """
-    x = np.array([item[0] for item in points])
-    y = np.array([item[1] for item in points])
-    z = np.array([item[2] for item in points])
-    x_flag = np.logical_and(x >= cube['x_min'], x < cube['x_max'])
-    y_flag = np.logical_and(y >= cube['y_min'], y < cube['y_max'])
-    z_flag = np.logical_and(z >= cube['z_min'], z < cube['z_max'])
-    flag = np.logical_and(np.logical_and(x_flag, y_flag), z_flag)
-    points_in = []
-    for point, flag in zip(points, flag):
-        if flag:
-            points_in.append(point)
+def in_cube_indices(points, cube):
+    """
+    Function returning the indices of the points lying in the cube.
+    :param points: (N,3) array of points
+    :param cube: dictionary with the corners of the cube
+    :return: array of indices
+    """
+    return np.flatnonzero(in_cube_mask(points, cube))
+
+
+def in_cube(points, cube):
+    """
+    Function selecting the points lying in the cube.
+    :param points: list or (N,3) array of points
+    :param cube: dictionary with the corners of the cube
+    :return: the points in the cube (an array if the input is an array, a list otherwise) and their number
+    """
+    flag = in_cube_mask(points, cube)
+    if isinstance(points, np.ndarray):
+        points_in = points[flag]
+    else:
+        points_in = list(itertools.compress(points, flag))
     return points_in, len(points_in)
 
 
+def octant_indices(points, cube):
+    """
+    Function computing for every point the octant of the cube it lies in, numbered as in divide_cube.
+    :param points: (N,3) array of points
+    :param cube: dictionary with the corners of the cube
+    :return: (N,) integer array of octants, -1 for the points outside of the cube
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    lower = np.array([cube['x_min'], cube['y_min'], cube['z_min']])
+    upper = np.array([cube['x_max'], cube['y_max'], cube['z_max']])
+    high = points >= lower + (upper - lower) / 2
+    octants = high[:, 0] + 2 * high[:, 1] + 4 * high[:, 2]
+    octants[~in_cube_mask(points, cube)] = -1
+    return octants
+
+
+def divide_points(points, cube):
+    """
+    Function distributing the points into the 8 octants of divide_cube in a single pass.
+    :param points: (N,3) array of points
+    :param cube: dictionary with the corners of the cube
+    :return: dictionary mapping the octant number to the array of indices of its points
+    """
+    octants = octant_indices(points, cube)
+    order = np.argsort(octants, kind='stable')
+    counts = np.bincount(octants + 1, minlength=9)
+    bounds = np.cumsum(counts)
+    return {oc_id: order[bounds[oc_id]:bounds[oc_id + 1]] for oc_id in range(8)}
+
+
 def compute_max_cube(points):
-    cm = [np.mean([item[0] for item in points]), np.mean([item[1] for item in points]),
-          np.mean([item[2] for item in points])]
-    max_dim = np.abs(max([item[0] for item in points]) - cm[0])
-    max_dim = max(np.abs(min([item[0] for item in points]) - cm[0]), max_dim)
-    max_dim = max(np.abs(max([item[1] for item in points]) - cm[1]), max_dim)
-    max_dim = max(np.abs(min([item[1] for item in points]) - cm[1]), max_dim)
-    max_dim = max(np.abs(max([item[2] for item in points]) - cm[2]), max_dim)
-    max_dim = max(np.abs(min([item[2] for item in points]) - cm[2]), max_dim)
-    cube = {'x_max': cm[0] + max_dim, 'x_min': cm[0] - max_dim, 'y_max': cm[1] + max_dim, 'y_min': cm[1] - max_dim,
-            'z_max': cm[2] + max_dim, 'z_min': cm[2] - max_dim}
+    """
+    Function computing the smallest cube centered in the mean of the points that contains all of them.
+    :param points: list or (N,3) array of points
+    :return: dictionary with the corners of the cube
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    cm = points.mean(axis=0)
+    max_dim = max(np.abs(points.max(axis=0) - cm).max(), np.abs(points.min(axis=0) - cm).max())
+    cube = {'x_max': float(cm[0] + max_dim), 'x_min': float(cm[0] - max_dim), 'y_max': float(cm[1] + max_dim),
+            'y_min': float(cm[1] - max_dim), 'z_max': float(cm[2] + max_dim), 'z_min': float(cm[2] - max_dim)}
     return cube
 
 
+def compute_max_cube_from_chunks(chunks):
+    """
+    Function computing the cube of compute_max_cube from a stream of point chunks, keeping only running sums and
+    extremes in memory.
+    :param chunks: iterator over pairs of (n,3) array of points and their labels
+    :return: dictionary with the corners of the cube
+    """
+    count = 0
+    total = np.zeros(3)
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    for points, _ in chunks:
+        if len(points) == 0:
+            continue
+        count += len(points)
+        total += points.sum(axis=0)
+        np.minimum(lower, points.min(axis=0), out=lower)
+        np.maximum(upper, points.max(axis=0), out=upper)
+    cm = total / count
+    max_dim = max(np.abs(upper - cm).max(), np.abs(lower - cm).max())
+    cube = {'x_max': float(cm[0] + max_dim), 'x_min': float(cm[0] - max_dim), 'y_max': float(cm[1] + max_dim),
+            'y_min': float(cm[1] - max_dim), 'z_max': float(cm[2] + max_dim), 'z_min': float(cm[2] - max_dim)}
+    return cube
+
+
+def grid_edges(cube, resolution):
+    """
+    Function computing the voxel edges of a grid covering the cube with a padding of two voxels.
+    :param cube: dictionary with the corners of the cube
+    :param resolution: size of the voxel (it is assumed it is a cube)
+    :return: list of three arrays with the edges along x, y and z
+    """
+    return [np.arange(cube['x_min'] - 2 * resolution, cube['x_max'] + 2 * resolution, resolution),
+            np.arange(cube['y_min'] - 2 * resolution, cube['y_max'] + 2 * resolution, resolution),
+            np.arange(cube['z_min'] - 2 * resolution, cube['z_max'] + 2 * resolution, resolution)]
+
+
+def extend_grid_edges(edges, points):
+    """
+    Function extending the voxel edges of a grid so that it contains the points. An axis is extended by at least its
+    current number of voxels on the side of the points outside of it, so a growing grid is extended a logarithmic number
+    of times. The existing edges are kept unchanged.
+    :param edges: list of three arrays with the edges along x, y and z
+    :param points: (N,3) array of points
+    :return: list of the extended edges and (3,) array of the number of voxels added below the grid along each axis
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    extended = []
+    shift = np.zeros(3, dtype=np.int64)
+    for axis, axis_edges in enumerate(edges):
+        if len(points) == 0:
+            extended.append(axis_edges)
+            continue
+        resolution = axis_edges[1] - axis_edges[0]
+        below = int(np.ceil((axis_edges[0] - points[:, axis].min()) / resolution))
+        above = int(np.ceil((points[:, axis].max() - axis_edges[-1]) / resolution))
+        below = max(below, len(axis_edges) - 1) if below > 0 else 0
+        above = max(above, len(axis_edges) - 1) if above > 0 else 0
+        extended.append(np.concatenate([axis_edges[0] - resolution * np.arange(below, 0, -1), axis_edges,
+                                        axis_edges[-1] + resolution * np.arange(1, above + 1)]))
+        shift[axis] = below
+    return extended, shift
+
+
+def voxel_indices(points, edges):
+    """
+    Function computing the voxel of every point, with the same binning as numpy.histogramdd.
+    :param points: (N,3) array of points
+    :param edges: list of three arrays with the edges along x, y and z
+    :return: (M,3) integer array of voxel indices of the points inside the grid and the (N,) mask of these points
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    indices = np.empty(points.shape, dtype=np.int64)
+    valid = np.ones(len(points), dtype=bool)
+    for axis, axis_edges in enumerate(edges):
+        indices[:, axis] = np.searchsorted(axis_edges, points[:, axis], side='right') - 1
+        # the last edge is included in the last voxel
+        indices[points[:, axis] == axis_edges[-1], axis] -= 1
+        valid &= (indices[:, axis] >= 0) & (indices[:, axis] < len(axis_edges) - 1)
+    return indices[valid], valid
+
+
+def count_voxels(points, edges):
+    """
+    Function counting the points per occupied voxel. The voxels are identified by their linear index in the C ordered
+    grid, so the cost depends on the number of points and occupied voxels only, not on the volume of the grid.
+    :param points: (N,3) array of points
+    :param edges: list of three arrays with the edges along x, y and z
+    :return: sorted array of the linear indices of the occupied voxels and the array of their point counts
+    """
+    indices, _ = voxel_indices(points, edges)
+    keys = np.ravel_multi_index(indices.T, [len(e) - 1 for e in edges])
+    return np.unique(keys, return_counts=True)
+
+
+def merge_voxel_counts(keys_a, counts_a, keys_b, counts_b):
+    """
+    Function summing two sets of voxel counts as returned by count_voxels.
+    :return: sorted array of the linear indices of the voxels and the array of their summed counts
+    """
+    keys, inverse = np.unique(np.concatenate([keys_a, keys_b]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts_a, counts_b]), minlength=len(keys))
+    return keys, counts.astype(np.result_type(counts_a, counts_b))
+
+
+def unique_sorted(values):
+    """
+    Function computing the sorted unique values of an array by sorting it, which is much faster than the hash based
+    np.unique of recent numpy versions for large integer arrays.
+    :param values: 1D array
+    :return: sorted array of the unique values
+    """
+    values = np.sort(values, axis=None)
+    if len(values) == 0:
+        return values
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+
+def create_shared_array(shape, dtype):
+    """
+    Function allocating an array in shared memory, which other processes attach with attach_shared_array. The creating
+    process closes and unlinks the block once the array is no longer needed.
+    :param shape: shape of the array
+    :param dtype: type of the elements
+    :return: SharedMemory block, the array in it and the description of the array passed to the other processes
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shm, array, (shm.name, tuple(shape), np.dtype(dtype).str)
+
+
+def attach_shared_array(description):
+    """
+    Function attaching an array created by create_shared_array in a process started by the creating one. The block
+    is closed, not unlinked, once the array is no longer needed.
+    :param description: description of the array returned by create_shared_array
+    :return: SharedMemory block and the array in it
+    """
+    name, shape, dtype = description
+    # the processes of a pool share the resource tracker of their parent, which unlinks the block if it is leaked
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
 def get_points_from_mesh(pw):
     x = [pw['par']['a'][0], pw['par']['b'][0], pw['par']['c'][0], pw['par']['d'][0]]
     y = [pw['par']['a'][1], pw['par']['b'][1], pw['par']['c'][1], pw['par']['d'][1]]
     z = [pw['par']['a'][2], pw['par']['b'][2], pw['par']['c'][2], pw['par']['d'][2]]
     return x, y, z
+
+
+def _lookup(values, queries):
+    # positions of the queries in the sorted unique values, -1 for the queries not found
+    position = np.minimum(np.searchsorted(values, queries), len(values) - 1)
+    return np.where(values[position] == queries, position, -1)
+
+
+def _close_pairs(points, tolerance):
+    # pairs (i, j), i < j, of the points closer than the tolerance, found by hashing the points on a grid of cells of
+    # the tolerance size and comparing every point with the points of its cell and of the 26 neighbouring cells. The
+    # cells are numbered axis after axis so that their numbers fit in int64 however large the grid is
+    keys = np.floor(points / tolerance).astype(np.int64)
+    axes = [np.unique(keys[:, axis]) for axis in range(3)]
+    ranks = [_lookup(axes[axis], keys[:, axis]) for axis in range(3)]
+    rows = np.unique(ranks[0] * len(axes[1]) + ranks[1])
+    cells, cell_of = np.unique(_lookup(rows, ranks[0] * len(axes[1]) + ranks[1]) * len(axes[2]) + ranks[2],
+                               return_inverse=True)
+    order = np.argsort(cell_of, kind='stable')
+    sizes = np.bincount(cell_of, minlength=len(cells))
+    cell_starts = np.cumsum(sizes) - sizes
+    shifts = [{step: _lookup(axes[axis], keys[:, axis] + step) for step in (-1, 0, 1)} for axis in range(3)]
+    first, second = [], []
+    # the pairs of points of neighbouring cells are searched from one of the two cells only
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        if offset < (0, 0, 0):
+            continue
+        shifted = [shifts[axis][offset[axis]] for axis in range(3)]
+        candidates = np.flatnonzero(np.logical_and.reduce([shift >= 0 for shift in shifted]))
+        row = _lookup(rows, shifted[0][candidates] * len(axes[1]) + shifted[1][candidates])
+        candidates, row = candidates[row >= 0], row[row >= 0]
+        found = _lookup(cells, row * len(axes[2]) + shifted[2][candidates])
+        points_found, found = candidates[found >= 0], found[found >= 0]
+        count = sizes[found]
+        i = np.repeat(points_found, count)
+        j = order[np.repeat(cell_starts[found] - np.cumsum(count) + count, count) + np.arange(len(i))]
+        close = np.logical_and(np.logical_or(i < j, offset != (0, 0, 0)),
+                               np.linalg.norm(points[i] - points[j], axis=1) <= tolerance)
+        first.append(np.minimum(i, j)[close])
+        second.append(np.maximum(i, j)[close])
+    return np.concatenate(first), np.concatenate(second)
+
+
+def index_mesh(polygons, tolerance=MESH_TOLERANCE):
+    """
+    Function building an indexed mesh from polygons given by the coordinates of their vertices. The vertices closer
+    than the tolerance are merged, also through chains of close vertices, into the first of them.
+    :param polygons: list of the polygons, each a list or an (n,3) array of its vertices
+    :param tolerance: largest distance between merged vertices
+    :return: (V,3) array of the merged vertices in the order they first appear, (P+1,) array of the polygon offsets and
+    array of the polygon indices, polygon i being vertices[polygon_indices[polygon_offsets[i]:polygon_offsets[i + 1]]]
+    """
+    if isinstance(polygons, np.ndarray):
+        lengths = np.full(len(polygons), polygons.shape[1] if polygons.ndim == 3 else 0, dtype=np.int64)
+        corners = polygons.astype(float).reshape(-1, 3)
+    else:
+        lengths = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+        corners = np.array([v for polygon in polygons for v in polygon], dtype=float).reshape(-1, 3)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    if len(corners) == 0:
+        return corners, offsets, np.empty(0, dtype=np.int64)
+    # the identical vertices are merged first, the distinct ones numbered in the order they first appear
+    _, first, inverse = np.unique(corners, axis=0, return_index=True, return_inverse=True)
+    ranked = np.argsort(first)
+    rank = np.empty_like(ranked)
+    rank[ranked] = np.arange(len(ranked))
+    points = corners[first[ranked]]
+    inverse = rank[inverse.ravel()]
+    # every vertex takes the smallest number of the vertices connected to it by close pairs
+    i, j = _close_pairs(points, tolerance)
+    label = np.arange(len(points))
+    while True:
+        low = label.copy()
+        np.minimum.at(low, i, label[j])
+        np.minimum.at(low, j, label[i])
+        low = low[low]
+        if np.array_equal(low, label):
+            break
+        label = low
+    roots, merged = np.unique(label, return_inverse=True)
+    return points[roots], offsets, merged[inverse]
+
+
+def mesh_polygons(mesh):
+    """
+    Function returning the vertices of the walls of a pseudo mesh as polygons.
+    :param mesh: list of walls, each a dictionary with the parallelogram under 'par'
+    :return: (P,4,3) array of the vertices of the walls
+    """
+    return np.array([[pw['par'][corner][:3] for corner in 'abcd'] for pw in mesh], dtype=float).reshape(-1, 4, 3)
+
+
+def quantize_to_cube(points, cube, depth):
+    """
+    Function mapping points to integer cell coordinates of a regular 2^depth subdivision of the cube.
+    :param points: (N,3) array of points
+    :param cube: dictionary with the corners of the cube
+    :param depth: number of subdivision levels
+    :return: (N,3) uint64 array of cell coordinates, points on or outside the border are clipped to the closest cell
+    """
+    lower = np.array([cube['x_min'], cube['y_min'], cube['z_min']])
+    edge = np.array([cube['x_max'], cube['y_max'], cube['z_max']]) - lower
+    scale = np.divide(float(2 ** depth), edge, out=np.zeros(3), where=edge > 0)
+    cells = np.floor((np.asarray(points, dtype=float) - lower) * scale)
+    np.clip(cells, 0, 2 ** depth - 1, out=cells)
+    return cells.astype(np.uint64)
+
+
+def _spread_bits(v):
+    v = v & np.uint64(0x1fffff)
+    v = (v | v << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    v = (v | v << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    v = (v | v << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    v = (v | v << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | v << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return v
+
+
+def morton_encode(cells):
+    """
+    Function interleaving the bits of cell coordinates into Morton (Z-order) codes. The lowest three bits of the code
+    follow the numbering of the octants returned by divide_cube (x, then y, then z).
+    :param cells: (N,3) array of non-negative cell coordinates, at most 21 bits each
+    :return: (N,) uint64 array of Morton codes
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    return _spread_bits(cells[:, 0]) | _spread_bits(cells[:, 1]) << np.uint64(1) | _spread_bits(
+        cells[:, 2]) << np.uint64(2)
+
+
+def _compact_bits(v):
+    v = v & np.uint64(0x1249249249249249)
+    v = (v | v >> np.uint64(2)) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | v >> np.uint64(4)) & np.uint64(0x100f00f00f00f00f)
+    v = (v | v >> np.uint64(8)) & np.uint64(0x1f0000ff0000ff)
+    v = (v | v >> np.uint64(16)) & np.uint64(0x1f00000000ffff)
+    v = (v | v >> np.uint64(32)) & np.uint64(0x1fffff)
+    return v
+
+
+def morton_decode(codes):
+    """
+    Function splitting Morton codes back into cell coordinates, the inverse of morton_encode.
+    :param codes: (N,) array of Morton codes
+    :return: (N,3) uint64 array of cell coordinates
+    """
+    codes = np.asarray(codes, dtype=np.uint64)
+    return np.stack([_compact_bits(codes), _compact_bits(codes >> np.uint64(1)), _compact_bits(codes >> np.uint64(2))],
+                    axis=1)
@@ -1,36 +1,266 @@
 import datetime as dt
+import itertools
 import json
 
+import numpy as np
+
 import helpers as he
+import nd_sparse_matrix as sp
+import voxel_pyramid as vp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# number of list items encoded at once by the streaming writer
+BLOCK_SIZE = 65536
+
+json_backends = ['json', 'orjson']
+# settings of the encoder used by all the writers, see set_encoder
+encoder = {'backend': 'json', 'precision': None}
+
+OCCUPANCY_CHARACTERISTICS = [{'C_name': 'occupancy',
+                              'C_description': '0 if the cell is empty, 1 if the cell is occupied, -1 if the value is '
+                                               'unknown',
+                              'C_values': '0 1 -1'}]
+
+
+def map_header(file_name, description, **fields):
+    """
+    Function creating the header fields common to all local maps.
+    :param file_name: name of the map, used as its id
+    :param description: description of the map
+    :param fields: additional fields, written after the common ones
+    :return: dictionary with the header fields
+    """
+    header = {'localmap_id': file_name, 'time': dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+              'map_description': description, 'coordinate_system': 'relative'}
+    header.update(fields)
+    return header
+
+
+def set_encoder(backend=None, precision=None):
+    """
+    Function configuring the encoder used by all the writers.
+    :param backend: 'json' for the standard library or 'orjson' (faster, written without spaces), None keeps the
+    current one
+    :param precision: number of significant digits of the floats stored in arrays, None for the exact values
+    :raises ValueError: if the backend is unknown or not installed
+    """
+    if backend is not None:
+        if backend not in json_backends:
+            raise ValueError("%s is an invalid JSON backend" % backend)
+        if backend == 'orjson' and orjson is None:
+            raise ValueError("orjson is not installed")
+        encoder['backend'] = backend
+    encoder['precision'] = precision
+
+
+def encode_json(value):
+    """
+    Function encoding a value with the configured backend.
+    :param value: JSON serializable value, numpy arrays and scalars are accepted by the orjson backend
+    :return: JSON string
+    """
+    if encoder['backend'] == 'orjson':
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(value)
+
+
+def encode_array_block(arrays):
+    """
+    Function encoding rows of arrays as a comma separated sequence of JSON lists, without the enclosing brackets.
+    With a single array every row is encoded as a list, e.g. [1.0, 2.0], with several arrays every row is encoded as a
+    list of the rows of the arrays, e.g. [[1, 2, 3], [4.0]]. The rows are formatted in bulk instead of being converted
+    to Python lists.
+    :param arrays: tuple of 2D arrays with the same number of rows
+    :return: JSON string
+    :raises ValueError: if a float array holds nan or infinite values, which are not valid JSON
+    """
+    rows = len(arrays[0])
+    if rows == 0:
+        return ''
+    for a in arrays:
+        if a.dtype.kind == 'f' and not np.isfinite(a).all():
+            raise ValueError("nan and infinite values cannot be written as JSON")
+    if encoder['backend'] == 'orjson' and encoder['precision'] is None:
+        encoded = [orjson.dumps(np.ascontiguousarray(a), option=orjson.OPT_SERIALIZE_NUMPY)[2:-2].decode().split(
+            '],[') for a in arrays]
+        if len(arrays) == 1:
+            return '[' + '],['.join(encoded[0]) + ']'
+        columns = [None] * (rows * len(arrays))
+        for i, column in enumerate(encoded):
+            columns[i::len(arrays)] = column
+        return ','.join([('[' + ','.join(['[%s]'] * len(arrays)) + ']')] * rows) % tuple(columns)
+
+    separator = ', ' if encoder['backend'] == 'json' else ','
+    float_format = '%r' if encoder['precision'] is None else '%%.%dg' % encoder['precision']
+    row_formats = [separator.join([float_format if a.dtype.kind == 'f' else '%d'] * a.shape[1]) for a in arrays]
+    if len(arrays) == 1:
+        item_format = '[' + row_formats[0] + ']'
+    else:
+        item_format = '[' + separator.join('[' + f + ']' for f in row_formats) + ']'
+    values = np.concatenate([np.asarray(a, dtype=float) for a in arrays], axis=1) if len(arrays) > 1 else arrays[0]
+    return separator.join([item_format] * rows) % tuple(values.ravel().tolist())
+
+
+def iter_blocks(items, block_size=BLOCK_SIZE):
+    """
+    Generator splitting a list, an array or an iterator of items into lists of at most block_size items.
+    :param items: the items, rows of an array are converted to lists
+    :param block_size: maximal number of items in a block
+    :return: iterator over lists of items
+    """
+    if isinstance(items, np.ndarray):
+        for start in range(0, len(items), block_size):
+            yield items[start:start + block_size].tolist()
+        return
+    items = iter(items)
+    while True:
+        block = list(itertools.islice(items, block_size))
+        if not block:
+            return
+        yield block
+
+
+def write_map_json(path, header, lists, raw_fields=()):
+    """
+    Function writing a local map into JSON file. The header fields are written first, then the list fields are
+    streamed block by block, so only one block of items is held in memory. With the json backend and exact floats the
+    output is the same as the one of json.dump on the complete dictionary.
+    :param path: path of the file
+    :param header: dictionary with the fields written before the lists
+    :param lists: list of pairs of a field name and an iterator over blocks of the items of this field, a block is
+    either a list of items or a tuple of arrays encoded by encode_array_block
+    :param raw_fields: list of pairs of a field name and an iterator over the fragments of the JSON text of its value,
+    written after the lists
+    """
+    separator = ', ' if encoder['backend'] == 'json' else ','
+    colon = ': ' if encoder['backend'] == 'json' else ':'
+    with open(path, 'w') as outfile:
+        outfile.write(encode_json(header)[:-1])
+        for key, blocks in lists:
+            outfile.write(separator + encode_json(key) + colon + '[')
+            item_separator = ''
+            for block in blocks:
+                if isinstance(block, tuple):
+                    encoded = encode_array_block(block)
+                else:
+                    encoded = encode_json(block)[1:-1]
+                if not encoded:
+                    continue
+                outfile.write(item_separator)
+                outfile.write(encoded)
+                item_separator = separator
+            outfile.write(']')
+        for key, fragments in raw_fields:
+            outfile.write(separator + encode_json(key) + colon)
+            for fragment in fragments:
+                outfile.write(fragment)
+        outfile.write('}')
+
+
+def oct_tree_fragments(characteristics, child_counts, block_size=BLOCK_SIZE):
+    """
+    Generator of the JSON text of a nested tree of nodes, each node being an object with its node_characteristics and
+    its node_children. The nodes are given in depth first order and written with an explicit stack of the open nodes,
+    so neither the recursion limit nor a nested dictionary bounds the depth and the size of the tree.
+    :param characteristics: (M,k) array of the characteristics of the nodes in depth first order
+    :param child_counts: (M,) array of the number of children of the nodes
+    :param block_size: number of nodes encoded at once
+    :return: iterator over fragments of the JSON text of the root node
+    """
+    separator = ', ' if encoder['backend'] == 'json' else ','
+    colon = ': ' if encoder['backend'] == 'json' else ':'
+    node_format = '{"node_characteristics"' + colon + '[%s]' + separator + '"node_children"' + colon + '['
+    row_separator = ']' + separator + '['
+    # number of children still to be written of every open node
+    left = []
+    needs_separator = False
+    for start in range(0, len(child_counts), block_size):
+        rows = encode_array_block((characteristics[start:start + block_size],))[1:-1].split(row_separator)
+        parts = []
+        for row, count in zip(rows, child_counts[start:start + block_size].tolist()):
+            if needs_separator:
+                parts.append(separator)
+            if left:
+                left[-1] -= 1
+            parts.append(node_format % row)
+            if count:
+                left.append(count)
+                needs_separator = False
+                continue
+            parts.append(']}')
+            while left and left[-1] == 0:
+                left.pop()
+                parts.append(']}')
+            needs_separator = True
+        yield ''.join(parts)
+
+
+def dense_voxel_blocks(voxels):
+    """
+    Generator of blocks of dense grid voxels, each voxel being the list of its characteristics.
+    :param voxels: array or list of voxels, a voxel is a single value or a list of values
+    """
+    if isinstance(voxels, np.ndarray):
+        voxels = voxels.reshape(len(voxels), -1)
+        for start in range(0, len(voxels), BLOCK_SIZE):
+            yield voxels[start:start + BLOCK_SIZE],
+        return
+    for block in iter_blocks(voxels):
+        yield [list(v) if isinstance(v, (list, tuple)) else [v] for v in block]
+
+
+def sparse_voxel_blocks(voxels):
+    """
+    Generator of blocks of sparse grid voxels, each voxel being the pair of its coordinates and its characteristics.
+    :param voxels: NDSparseMatrix or list of tuples (x, y, z, characteristics...)
+    """
+    if isinstance(voxels, sp.NDSparseMatrix):
+        coords = voxels.coordinates()
+        values = voxels.values.reshape(-1, 1)
+        for start in range(0, len(coords), BLOCK_SIZE):
+            yield coords[start:start + BLOCK_SIZE], values[start:start + BLOCK_SIZE]
+        return
+    for block in iter_blocks(voxels):
+        yield [[list(v[:3]), list(v[3:])] for v in block]
+
+
+def point_blocks(chunks):
+    """
+    Generator of blocks of points, each point being the pair of its coordinates and its label.
+    :param chunks: iterator over pairs of (n,3) array of points and (n,) array of labels
+    """
+    for points, labels in chunks:
+        points = np.asarray(points).reshape(-1, 3)
+        labels = np.asarray(labels).reshape(-1, 1)
+        for start in range(0, len(points), BLOCK_SIZE):
+            yield points[start:start + BLOCK_SIZE], labels[start:start + BLOCK_SIZE]
 
 
 def save_dense_grid_as_jason(size, voxels, resolution=None, file_name="test_dense_grid", targetpath=""):
     """
     Function saving the dense grid as a local map into JSON file.
     :param size: three element list representing the size of the map as number of voxels along each dimension
-    :param voxels: list of voxels
+    :param voxels: list or array of voxels, ordered with x changing fastest as required by the schema
     :param resolution: three elemnt list describing the size of a voxel a long each dimension
     :param file_name: name of the file to be saved as
     :param targetpath: directory where the map will be saved
     """
     if resolution is None:
         resolution = [1, 1, 1]
-    myJSON = {'localmap_id': file_name, 'time': dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-              'map_description': 'Densegrid local map of ' + file_name, 'coordinate_system': 'relative',
-              'resolution': resolution, 'size': size, 'list_of_characteristics': [{'C_name': 'occupancy',
-                                                                                   'C_description': '0 if the cell is empty, 1 if the cell is occupied, -1 if the value is unknown',
-                                                                                   'C_values': '0 1 -1'}],
-              'list_of_voxels': list(voxels)}
-
-    with open(targetpath + file_name + '_map.json', 'w') as outfile:
-        json.dump(myJSON, outfile)
+    header = map_header(file_name, 'Densegrid local map of ' + file_name, resolution=resolution,
+                        size=[int(s) for s in size], list_of_characteristics=OCCUPANCY_CHARACTERISTICS)
+    write_map_json(targetpath + file_name + '_map.json', header, [('list_of_voxels', dense_voxel_blocks(voxels))])
 
 
 def save_sparse_grid_as_jason(size, voxels, resolution=None, file_name="test_sparse_grid", targetpath=""):
     """
     Function saving the sparse grid as a local map into JSON file.
     :param size: three element list representing the size of the map in meters
-    :param voxels: list of sparse voxels
+    :param voxels: NDSparseMatrix or list of sparse voxels (x, y, z, characteristics...)
     :param resolution: three elemnt list describing the size of a voxel a long each dimension
     :param file_name: name of the file to be saved as
     :param targetpath: directory where the map will be saved
@@ -38,80 +268,132 @@ def save_sparse_grid_as_jason(size, voxels, resolution=None, file_name="test_spa
     """
     if resolution is None:
         resolution = [1, 1, 1]
+    header = map_header(file_name, 'Sparse grid local map of ' + file_name, resolution=resolution,
+                        size=[int(s) for s in size], list_of_characteristics=OCCUPANCY_CHARACTERISTICS)
+    write_map_json(targetpath + file_name + '_map.json', header, [('list_of_voxels', sparse_voxel_blocks(voxels))])
 
-    myJSON = {'localmap_id': file_name, 'time': dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-              'map_description': 'Sparse grid local map of ' + file_name, 'coordinate_system': 'relative',
-              'resolution': resolution, 'size': size, 'list_of_characteristics': [{'C_name': 'occupancy',
-                                                                                   'C_description': '0 if the cell is empty, 1 if the cell is occupied, -1 if the value is unknown',
-                                                                                   'C_values': '0 1 -1'}]}
 
-    my_voxels = [list(v) for v in voxels]
-    myJSON['list_of_voxels'] = my_voxels
+def save_dense_pyramid_as_jason(pyramid, resolution=None, first_level=0, file_name="test_dense_grid", targetpath=""):
+    """
+    Function saving the levels of a dense grid pyramid as dense grid local maps, level l into the file
+    file_name_level<l>_map.json.
+    :param pyramid: list of the arrays of the levels, as returned by voxel_pyramid.dense_pyramid
+    :param resolution: three elemnt list describing the size of a voxel of level 0 a long each dimension
+    :param first_level: first level saved, the finer ones are skipped
+    :param file_name: name of the files to be saved as, completed with the level
+    :param targetpath: directory where the maps will be saved
+    """
+    if resolution is None:
+        resolution = [1, 1, 1]
+    for level in range(first_level, len(pyramid)):
+        grid = pyramid[level]
+        save_dense_grid_as_jason(grid.shape[:3], grid.reshape(int(np.prod(grid.shape[:3])), -1, order='F'),
+                                 vp.level_resolution(resolution, level), file_name + '_level%d' % level, targetpath)
 
-    with open(targetpath + file_name + '_map.json', 'w') as outfile:
-        json.dump(myJSON, outfile)
+
+def save_sparse_pyramid_as_jason(pyramid, size, resolution=None, first_level=0, file_name="test_sparse_grid",
+                                 targetpath=""):
+    """
+    Function saving the levels of a sparse grid pyramid as sparse grid local maps, level l into the file
+    file_name_level<l>_map.json.
+    :param pyramid: list of the NDSparseMatrix of the levels, as returned by voxel_pyramid.sparse_pyramid
+    :param size: three element list of the number of voxels of level 0 along each dimension, level l having
+    ceil(size / 2 ** l) voxels
+    :param resolution: three elemnt list describing the size of a voxel of level 0 a long each dimension
+    :param first_level: first level saved, the finer ones are skipped
+    :param file_name: name of the files to be saved as, completed with the level
+    :param targetpath: directory where the maps will be saved
+    """
+    if resolution is None:
+        resolution = [1, 1, 1]
+    for level in range(first_level, len(pyramid)):
+        save_sparse_grid_as_jason(vp.level_shape(size, level), pyramid[level], vp.level_resolution(resolution, level),
+                                  file_name + '_level%d' % level, targetpath)
 
 
-def save_point_cloud_as_jason(points, file_name="test_point_cloud", targetpath=""):
+def save_point_cloud_as_jason(points, file_name="test_point_cloud", targetpath="", labels=None):
     """
-    Function saving the sparse grid as a local map into JSON file.
+    Function saving the point cloud as a local map into JSON file.
     :param points: List of point coordiantes to be saved
     :param file_name: name of the file to be saved as
     :param targetpath: directory where the map will be saved
+    :param labels: label_id of every point, 0 for all points if None
     """
-    myJSON = {'localmap_id': file_name, 'time': dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-              'map_description': 'Pointcloud of' + file_name, 'coordinate_system': 'relative',
-              'list_of_characteristics': [{'C_name': 'label_id'}], 'list_of_points': points}
+    if labels is None:
+        labels = np.zeros(len(points), dtype=int)
+    save_point_cloud_chunks_as_jason([(points, labels)], file_name, targetpath)
 
-    with open(targetpath + file_name + '_map.json', 'w') as outfile:
-        json.dump(myJSON, outfile)
+
+def save_point_cloud_chunks_as_jason(chunks, file_name="test_point_cloud", targetpath=""):
+    """
+    Function saving a stream of labeled point chunks as a point cloud local map into JSON file. Only one chunk is held
+    in memory at a time, each point is saved with its label as the label_id characteristic.
+    :param chunks: iterator over pairs of (n,3) array of points and (n,) array of labels
+    :param file_name: name of the file to be saved as
+    :param targetpath: directory where the map will be saved
+    """
+    header = map_header(file_name, 'Pointcloud of' + file_name, list_of_characteristics=[{'C_name': 'label_id'}])
+    write_map_json(targetpath + file_name + '_map.json', header, [('list_of_points', point_blocks(chunks))])
 
 
 def save_oct_map_as_jason(tree, size, file_name="test_oct", targetpath=""):
     """
-    Function saving the oct-map as a local map into JSON file.
-    :param tree: the oct tree represneted as a list of nodes
+    Function saving the oct-map as a local map into JSON file. The tree is written as nested nodes, each node having
+    its occupancy as characteristic and either no or 8 children.
+    :param tree: the built OctTree or an OccupancyOctTree
     :param size: The size of the map dented in meters
     :param file_name: name of the file to be saved as
     :param targetpath: directory where the map will be saved
     """
-    myJSON = {'localmap_id': file_name, 'time': dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-              'map_description': 'Octree local map of ' + file_name, 'coordinate_system': 'relative', 'size': size,
-              'list_of_characteristics': [{'C_name': 'occupancy',
-                                           'C_description': '0 if the cell is empty, 1 if the cell is occupied, -1 if the value is unknown',
-                                           'C_values': '0 1 -1'}]}
+    header = map_header(file_name, 'Octree local map of ' + file_name, size=size,
+                        list_of_characteristics=OCCUPANCY_CHARACTERISTICS)
+    characteristics, child_counts = tree.export_arrays()
+    write_map_json(targetpath + file_name + '_map.json', header, [],
+                   [('tree', oct_tree_fragments(characteristics, child_counts))])
 
-    temp_tree = []
-    for node in tree:
-        temp_node = {'node_id': node.oct_id, 'children': node.children}
-        temp_tree.append(temp_node)
 
-    myJSON['tree'] = temp_tree
-    with open(targetpath + file_name + '_map.json', 'w') as outfile:
-        json.dump(myJSON, outfile)
+def polygon_items(polygon_offsets, polygon_indices, characteristics=None):
+    """
+    Generator of the polygons of an indexed mesh as items of list_of_polygons.
+    :param polygon_offsets: (P+1,) array of the offsets of the polygons in polygon_indices
+    :param polygon_indices: array of the indices of the vertices of the polygons in list_of_points
+    :param characteristics: (P,k) array of the characteristics of the polygons, none if None
+    """
+    offsets = np.asarray(polygon_offsets).tolist()
+    indices = np.asarray(polygon_indices).tolist()
+    characteristics = [[]] * (len(offsets) - 1) if characteristics is None else np.asarray(characteristics).tolist()
+    for c, start, end in zip(characteristics, offsets[:-1], offsets[1:]):
+        yield {'polygon_characteristics': c, 'list_of_vertices': indices[start:end]}
 
 
-def save_mesh_as_json(mesh, file_name="test_mesh", targetpath=""):
+def save_indexed_mesh_as_json(vertices, polygon_offsets, polygon_indices, file_name="test_mesh", targetpath=""):
     """
-    Function saving the mesh as a local map into JSON file.
-    :param mesh: The input list of polygons building map.
+    Function saving an indexed mesh as a local map into JSON file. The vertices are saved once in list_of_points and
+    the polygons reference them by their index.
+    :param vertices: (V,3) array of the vertices
+    :param polygon_offsets: (P+1,) array of the offsets of the polygons in polygon_indices
+    :param polygon_indices: array of the indices of the vertices of the polygons, as returned by helpers.index_mesh
     :param file_name: name of the file to be saved as
     :param targetpath: directory where the map will be saved
     """
-    myJSON = {'localmap_id': file_name, 'time': dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-              'map_description': 'Polygonmesh local map of ' + file_name, 'coordinate_system': 'relative',
-              'list_of_characteristics_point': [], 'list_of_characteristics_polygon': []}
+    header = map_header(file_name, 'Polygonmesh local map of ' + file_name, list_of_characteristics_point=[],
+                        list_of_characteristics_polygon=[])
+    vertices = np.asarray(vertices, dtype=float).reshape(-1, 3)
+    points = ((vertices[s:s + BLOCK_SIZE], np.empty((len(vertices[s:s + BLOCK_SIZE]), 0)))
+              for s in range(0, len(vertices), BLOCK_SIZE))
+    write_map_json(targetpath + file_name + '_map.json', header,
+                   [('list_of_points', points), ('list_of_polygons', iter_blocks(polygon_items(polygon_offsets,
+                                                                                               polygon_indices)))])
 
-    polys = []
-    verts_all = []
-    for pw in mesh:
-        x, y, z = he.get_points_from_mesh(pw)
-        l_vert = list(zip(x, y, z))
-        verts_all.extend(l_vert)
-        polys.append(l_vert)
 
-    myJSON['list_of_polygons'] = polys
-    myJSON['list_of_vertices'] = verts_all
-
-    with open(targetpath + file_name + '_map.json', 'w') as outfile:
-        json.dump(myJSON, outfile)
+def save_mesh_as_json(mesh, file_name="test_mesh", targetpath="", tolerance=he.MESH_TOLERANCE):
+    """
+    Function saving the mesh as a local map into JSON file. The corners shared by the walls are saved once, see
+    helpers.index_mesh.
+    :param mesh: The input list of polygons building map.
+    :param file_name: name of the file to be saved as
+    :param targetpath: directory where the map will be saved
+    :param tolerance: largest distance between merged vertices
+    """
+    save_indexed_mesh_as_json(*he.index_mesh(he.mesh_polygons(mesh), tolerance), file_name=file_name,
+                              targetpath=targetpath)
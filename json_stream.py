@@ -0,0 +1,136 @@
+import json
+import re
+
+# size of the chunks read from the file
+BUFFER_SIZE = 1 << 20
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+# characters a number may contain, a number reaching the end of the buffer may continue in the file
+_number = re.compile(r'-?[0-9]*\.?[0-9]*(?:[eE][-+]?[0-9]*)?')
+_decoder = json.JSONDecoder()
+
+
+class JsonStreamReader:
+    """
+    Pull parser reading a JSON document from a text file without loading it at once. Objects and arrays can be entered
+    and walked with iter_object and iter_array, any value can be decoded completely with read_value. Only the part of
+    the file holding the value being decoded is kept in memory.
+
+    The generators of iter_object and iter_array yield before every member, the caller has to consume the member (with
+    read_value, skip_value or by entering it) before asking for the next one.
+    """
+
+    def __init__(self, infile, buffer_size=BUFFER_SIZE):
+        self.infile = infile
+        self.buffer_size = buffer_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.infile.read(self.buffer_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Function skipping the whitespaces and returning the next character without consuming it.
+        :return: the next character, an empty string at the end of the file
+        """
+        while True:
+            self.pos = _whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        """
+        Function consuming the next character, which has to be char.
+        :raises ValueError: if the next character is another one
+        """
+        found = self.peek()
+        if found != char:
+            raise ValueError("expected %r at offset %d, found %r" % (char, self.pos, found))
+        self.pos += 1
+
+    def read_value(self):
+        """
+        Function decoding the next value completely.
+        :return: the decoded value
+        :raises ValueError: if the value is not valid JSON
+        """
+        char = self.peek()
+        while True:
+            if char in '-0123456789' and _number.match(self.buffer, self.pos).end() == len(self.buffer) and \
+                    not self.eof and self._fill():
+                continue
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # the value may continue after the end of the buffer
+                if self._fill():
+                    continue
+                raise
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """
+        Function skipping the next value.
+        """
+        self.read_value()
+
+    def _members(self, closing):
+        first = True
+        while True:
+            char = self.peek()
+            if char == closing:
+                self.pos += 1
+                return
+            if not first:
+                self.expect(',')
+            first = False
+            yield
+
+    def iter_object(self):
+        """
+        Generator entering the next object and yielding its keys.
+        :return: iterator over the keys, the value of every key has to be consumed before the next key
+        """
+        self.expect('{')
+        for _ in self._members('}'):
+            key = self.read_value()
+            self.expect(':')
+            yield key
+
+    def iter_array(self):
+        """
+        Generator entering the next array and yielding the index of each of its items.
+        :return: iterator over the indices, every item has to be consumed before the next index
+        """
+        self.expect('[')
+        for index, _ in enumerate(self._members(']')):
+            yield index
+
+    def iter_values(self):
+        """
+        Generator entering the next array and decoding its items one by one.
+        :return: iterator over the decoded items
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError("expected ',' or ']' at offset %d, found %r" % (self.pos - 1, char))
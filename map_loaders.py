@@ -0,0 +1,312 @@
+import numpy as np
+
+import json_stream as js
+import nd_sparse_matrix as sp
+
+# number of list items converted to arrays at once
+BLOCK_SIZE = 65536
+
+map_types = ['densegrid', 'sparsegrid', 'pointcloud', 'octree', 'polygonmesh']
+# list fields of each map type, loaded as arrays
+list_fields = {'densegrid': ['list_of_voxels'], 'sparsegrid': ['list_of_voxels'], 'pointcloud': ['list_of_points'],
+               'octree': ['tree'], 'polygonmesh': ['list_of_points', 'list_of_polygons']}
+# arrays of a map type without any item
+empty_arrays = {'densegrid': {'voxels': ((0, 0), float)},
+                'sparsegrid': {'coordinates': ((0, 3), np.int64), 'values': ((0, 0), float)},
+                'pointcloud': {'coordinates': ((0, 3), float), 'characteristics': ((0, 0), float)},
+                'octree': {'node_characteristics': ((0, 0), float), 'child_counts': ((0,), np.int64)},
+                'polygonmesh': {'coordinates': ((0, 3), float), 'characteristics': ((0, 0), float),
+                                'polygon_lengths': ((0,), np.int64), 'polygon_indices': ((0,), np.int64),
+                                'polygon_characteristics': ((0, 0), float)}}
+
+
+def detect_map_type(local_map):
+    """
+    Function detecting the type of a local map from its fields.
+    :param local_map: dictionary of the map, at least its header fields and the first item of its list fields
+    :return: one of map_types
+    :raises ValueError: if the type cannot be detected
+    """
+    if not isinstance(local_map, dict):
+        raise ValueError("a local map must be a JSON object")
+    if 'tree' in local_map:
+        return 'octree'
+    if 'list_of_polygons' in local_map:
+        return 'polygonmesh'
+    if 'list_of_points' in local_map:
+        return 'pointcloud'
+    if 'list_of_voxels' in local_map:
+        voxels = local_map['list_of_voxels']
+        # malformed voxels are detected as a dense grid, whose schema reports them
+        if isinstance(voxels, list) and len(voxels) > 0:
+            first = voxels[0]
+            return 'sparsegrid' if isinstance(first, list) and first and isinstance(first[0], list) else 'densegrid'
+        description = local_map.get('map_description')
+        return 'sparsegrid' if isinstance(description, str) and 'sparse' in description.lower() else 'densegrid'
+    raise ValueError("unknown local map type")
+
+
+def voxel_arrays(voxels):
+    if isinstance(voxels[0][0], list):
+        return {'coordinates': np.array([v[0] for v in voxels], dtype=np.int64).reshape(-1, 3),
+                'values': np.array([v[1] for v in voxels]).reshape(len(voxels), -1)}
+    return {'voxels': np.array(voxels).reshape(len(voxels), -1)}
+
+
+def point_arrays(points):
+    return {'coordinates': np.array([p[0] for p in points], dtype=float).reshape(-1, 3),
+            'characteristics': np.array([p[1] for p in points]).reshape(len(points), -1)}
+
+
+def tree_arrays(root):
+    # nodes in depth first order, walked with an explicit stack of the nodes still to visit
+    characteristics = []
+    child_counts = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        characteristics.append(node['node_characteristics'])
+        child_counts.append(len(node['node_children']))
+        stack.extend(reversed(node['node_children']))
+    return {'node_characteristics': np.array(characteristics).reshape(len(characteristics), -1),
+            'child_counts': np.array(child_counts, dtype=np.int64)}
+
+
+def polygon_arrays(polygons):
+    vertices = [polygon['list_of_vertices'] for polygon in polygons]
+    return {'polygon_lengths': np.array([len(v) for v in vertices], dtype=np.int64),
+            'polygon_indices': np.array([i for v in vertices for i in v], dtype=np.int64),
+            'polygon_characteristics': np.array([polygon.get('polygon_characteristics', []) for polygon in polygons]
+                                                ).reshape(len(polygons), -1)}
+
+
+# functions converting a non-empty list of items of a list field (the root node of a tree) to arrays
+item_converters = {'list_of_voxels': voxel_arrays, 'list_of_points': point_arrays, 'tree': tree_arrays,
+                   'list_of_polygons': polygon_arrays}
+
+
+def finish_arrays(map_type, arrays):
+    """
+    Function completing the arrays of a map: the arrays of empty lists are created and the polygon lengths are
+    replaced by offsets.
+    :param map_type: one of map_types
+    :param arrays: dictionary of arrays converted from the items
+    :return: the completed dictionary
+    """
+    for name, (shape, dtype) in empty_arrays[map_type].items():
+        if name not in arrays:
+            arrays[name] = np.empty(shape, dtype=dtype)
+    if 'polygon_lengths' in arrays:
+        arrays['polygon_offsets'] = np.concatenate([[0], np.cumsum(arrays.pop('polygon_lengths'))])
+    return arrays
+
+
+def map_to_arrays(local_map):
+    """
+    Function converting the list fields of an already decoded local map to arrays.
+    :param local_map: dictionary of the map, as loaded from the JSON file
+    :return: map type, dictionary with the header fields and dictionary of arrays
+    """
+    map_type = detect_map_type(local_map)
+    fields = {key: value for key, value in local_map.items() if key not in list_fields[map_type]}
+    arrays = {}
+    for key in list_fields[map_type]:
+        if local_map.get(key):
+            arrays.update(item_converters[key](local_map[key]))
+    return map_type, fields, finish_arrays(map_type, arrays)
+
+
+def read_list_arrays(reader, convert, block_size=BLOCK_SIZE):
+    """
+    Function decoding the next array of the reader block by block into numpy arrays, so at most one block of items is
+    held as Python objects.
+    :param reader: JsonStreamReader positioned before the array
+    :param convert: function converting a list of items to a dictionary of arrays
+    :param block_size: number of items converted at once
+    :return: dictionary of arrays (empty for an empty list) and the list of the first item (empty for an empty list)
+    """
+    blocks = {}
+    block = []
+    first = []
+    for item in reader.iter_values():
+        block.append(item)
+        if len(block) == block_size:
+            first = first or block[:1]
+            for name, array in convert(block).items():
+                blocks.setdefault(name, []).append(array)
+            block = []
+    if block:
+        first = first or block[:1]
+        for name, array in convert(block).items():
+            blocks.setdefault(name, []).append(array)
+    return {name: np.concatenate(arrays) for name, arrays in blocks.items()}, first
+
+
+def _grow(array, size):
+    if size <= len(array):
+        return array
+    grown = np.empty((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def read_tree_arrays(reader):
+    """
+    Function decoding the next nested tree of the reader into arrays, node by node with an explicit stack of the open
+    nodes, without building the nested dictionaries.
+    :param reader: JsonStreamReader positioned before the root node
+    :return: dictionary with the (M,k) array of the node_characteristics and the (M,) array of the child_counts of the
+    nodes in depth first order
+    """
+    characteristics = None
+    child_counts = np.zeros(BLOCK_SIZE, dtype=np.int64)
+    node_count = 1
+    # every open node: its index, the iterator over its members and the iterator over its children being read
+    stack = [[0, reader.iter_object(), None]]
+    while stack:
+        index, members, children = stack[-1]
+        if children is not None:
+            if next(children, None) is None:
+                stack[-1][2] = None
+            else:
+                child_counts[index] += 1
+                child_counts = _grow(child_counts, node_count + 1)
+                child_counts[node_count] = 0
+                stack.append([node_count, reader.iter_object(), None])
+                node_count += 1
+            continue
+        member = next(members, None)
+        if member is None:
+            stack.pop()
+        elif member == 'node_children':
+            stack[-1][2] = reader.iter_array()
+        elif member == 'node_characteristics':
+            row = np.asarray(reader.read_value())
+            if characteristics is None:
+                characteristics = np.zeros((len(child_counts), row.size), dtype=row.dtype)
+            characteristics = _grow(characteristics.astype(np.result_type(characteristics, row), copy=False),
+                                    len(child_counts))
+            characteristics[index] = row
+        else:
+            reader.skip_value()
+    if characteristics is None:
+        characteristics = np.zeros((node_count, 0))
+    return {'node_characteristics': characteristics[:node_count], 'child_counts': child_counts[:node_count]}
+
+
+def load_map_arrays(path):
+    """
+    Function loading a local map JSON file into arrays. The list fields are parsed incrementally, so the memory is
+    dominated by the resulting arrays instead of intermediate Python lists and dicts.
+    :param path: path of the JSON file
+    :return: map type, dictionary with the header fields and dictionary of arrays (see map_to_arrays)
+    """
+    fields = {}
+    arrays = {}
+    first_items = {}
+    with open(path, 'r') as infile:
+        reader = js.JsonStreamReader(infile)
+        for key in reader.iter_object():
+            if key == 'tree':
+                arrays.update(read_tree_arrays(reader))
+                first_items[key] = None
+            elif key in item_converters:
+                key_arrays, first_items[key] = read_list_arrays(reader, item_converters[key])
+                arrays.update(key_arrays)
+            else:
+                fields[key] = reader.read_value()
+    map_type = detect_map_type(dict(fields, **first_items))
+    return map_type, fields, finish_arrays(map_type, arrays)
+
+
+def _check_type(path, map_type, expected):
+    if map_type != expected:
+        raise ValueError("%s is a %s, not a %s" % (path, map_type, expected))
+
+
+def load_dense_grid(path):
+    """
+    Function loading a dense grid local map.
+    :param path: path of the JSON file
+    :return: dictionary with the header fields and the grid as an array indexed by (x, y, z), with a last axis for the
+    characteristics if there are more than one
+    :raises ValueError: if the file holds another map type
+    """
+    map_type, fields, arrays = load_map_arrays(path)
+    _check_type(path, map_type, 'densegrid')
+    voxels = arrays['voxels']
+    size = tuple(fields['size'])
+    grid = np.stack([voxels[:, c].reshape(size, order='F') for c in range(voxels.shape[1])], axis=-1)
+    return fields, grid[..., 0] if grid.shape[-1] == 1 else grid
+
+
+def load_sparse_grid(path):
+    """
+    Function loading a sparse grid local map.
+    :param path: path of the JSON file
+    :return: dictionary with the header fields and the NDSparseMatrix of the first characteristic
+    :raises ValueError: if the file holds another map type
+    """
+    map_type, fields, arrays = load_map_arrays(path)
+    _check_type(path, map_type, 'sparsegrid')
+    sparse_grid = sp.NDSparseMatrix()
+    if len(arrays['coordinates']):
+        sparse_grid.add_values(arrays['coordinates'], arrays['values'][:, 0])
+    return fields, sparse_grid
+
+
+def load_point_cloud(path):
+    """
+    Function loading a point cloud local map.
+    :param path: path of the JSON file
+    :return: dictionary with the header fields, (N,3) array of points and (N,k) array of their characteristics
+    :raises ValueError: if the file holds another map type
+    """
+    map_type, fields, arrays = load_map_arrays(path)
+    _check_type(path, map_type, 'pointcloud')
+    return fields, arrays['coordinates'], arrays['characteristics']
+
+
+def load_oct_map(path):
+    """
+    Function loading an octree local map into flat arrays.
+    :param path: path of the JSON file
+    :return: dictionary with the header fields and dictionary with the node_characteristics, child_counts, parent and
+    children (padded with -1) arrays, the nodes being numbered in the depth first order of the file
+    :raises ValueError: if the file holds another map type
+    """
+    map_type, fields, arrays = load_map_arrays(path)
+    _check_type(path, map_type, 'octree')
+    child_counts = arrays['child_counts']
+    parent = np.full(len(child_counts), -1, dtype=np.int64)
+    # every open node: its index and the number of its children still to come
+    stack = []
+    for index, count in enumerate(child_counts.tolist()):
+        if stack:
+            parent[index] = stack[-1][0]
+            stack[-1][1] -= 1
+            if stack[-1][1] == 0:
+                stack.pop()
+        if count:
+            stack.append([index, count])
+    has_parent = np.flatnonzero(parent >= 0)
+    offsets = np.concatenate([[0], np.cumsum(child_counts)])
+    # the children of a node come in increasing order of their index
+    order = has_parent[np.argsort(parent[has_parent], kind='stable')]
+    children = np.full((len(child_counts), int(child_counts.max()) if len(child_counts) else 0), -1, dtype=np.int64)
+    children[parent[order], np.arange(len(order)) - offsets[parent[order]]] = order
+    return fields, dict(arrays, parent=parent, children=children)
+
+
+def load_mesh(path):
+    """
+    Function loading a polygon mesh local map.
+    :param path: path of the JSON file
+    :return: dictionary with the header fields and dictionary with the (V,3) coordinates and (V,k) characteristics of
+    the points, the polygon_indices and polygon_offsets arrays and the (P,l) polygon_characteristics, the vertices of
+    polygon i being coordinates[polygon_indices[polygon_offsets[i]:polygon_offsets[i + 1]]]
+    :raises ValueError: if the file holds another map type
+    """
+    map_type, fields, arrays = load_map_arrays(path)
+    _check_type(path, map_type, 'polygonmesh')
+    return fields, arrays
@@ -1,22 +1,283 @@
+import collections.abc
+
 import numpy as np
 
+# the packed keys are signed 64 bit integers, leaving 63 bits for the coordinates
+KEY_BITS = 63
+# number of buffered single values above which they are merged into the columns, grows with the matrix
+PENDING_LIMIT = 4096
+
 
 class NDSparseMatrix:
-    def __init__(self):
-        self.elements = {}
+    """
+    Sparse matrix with non-negative integer coordinates stored in columns: a sorted array of keys, in which the
+    coordinates are packed into a single 64 bit integer (KEY_BITS // ndim bits each, first coordinate in the highest
+    bits, so the key order is the C order of the dense matrix), and an array of values.
+
+    Single values set with addValue are buffered and merged into the columns in bulk. The elements attribute gives the
+    dict-like access of the original implementation.
+    """
+
+    class ElementsView(collections.abc.MutableMapping):
+        """
+        Dict-like view of the elements of the matrix, with coordinate tuples as keys.
+        """
+
+        def __init__(self, matrix):
+            self._matrix = matrix
+
+        def __getitem__(self, key):
+            found, value = self._matrix.lookup(key)
+            if not found:
+                raise KeyError(key)
+            return value
+
+        def __setitem__(self, key, value):
+            self._matrix.addValue(key, value)
+
+        def __delitem__(self, key):
+            if not self._matrix.removeValue(key):
+                raise KeyError(key)
+
+        def __iter__(self):
+            return (key for key, _ in self._matrix.items())
+
+        def __len__(self):
+            return len(self._matrix)
+
+        def items(self):
+            return self._matrix.items()
+
+    def __init__(self, ndim=3, dtype=float):
+        self.ndim = ndim
+        self.bits = KEY_BITS // ndim
+        self.keys = np.empty(0, dtype=np.int64)
+        self.values = np.empty(0, dtype=dtype)
+        self._pending = {}
+
+    @property
+    def elements(self):
+        return self.ElementsView(self)
+
+    def pack(self, coords):
+        """
+        Function packing coordinates into keys.
+        :param coords: (N,ndim) array of non-negative integer coordinates
+        :return: (N,) int64 array of keys
+        """
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, self.ndim)
+        if len(coords) and (coords.min() < 0 or coords.max() >= 1 << self.bits):
+            raise ValueError("coordinates must lie in [0, %d)" % (1 << self.bits))
+        keys = np.zeros(len(coords), dtype=np.int64)
+        for axis in range(self.ndim):
+            keys |= coords[:, axis] << np.int64(self.bits * (self.ndim - 1 - axis))
+        return keys
+
+    def unpack(self, keys):
+        """
+        Function unpacking keys into coordinates.
+        :param keys: (N,) array of keys
+        :return: (N,ndim) int64 array of coordinates
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        mask = np.int64((1 << self.bits) - 1)
+        return np.stack([(keys >> np.int64(self.bits * (self.ndim - 1 - axis))) & mask for axis in range(self.ndim)],
+                        axis=-1).reshape(-1, self.ndim)
+
+    def add_values(self, coords, values, accumulate=False):
+        """
+        Function inserting many values at once.
+        :param coords: (N,ndim) array of coordinates
+        :param values: (N,) array of values or a single value
+        :param accumulate: if True the values are added to the stored ones (and duplicates summed), otherwise they
+        replace them (the last of duplicated coordinates wins)
+        """
+        self._flush()
+        keys = self.pack(coords)
+        values = np.broadcast_to(np.asarray(values), keys.shape)
+        if accumulate:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            values = np.bincount(inverse, weights=values, minlength=len(keys)).astype(
+                np.result_type(values, self.values))
+        else:
+            # keep the last occurrence of every key
+            order = np.argsort(keys[::-1], kind='stable')
+            keys, first = np.unique(keys[::-1][order], return_index=True)
+            values = values[::-1][order][first]
+
+        self._merge(keys, values, accumulate)
+
+    def remove_values(self, coords):
+        """
+        Function removing many values at once.
+        :param coords: (N,ndim) array of coordinates, the ones without stored value are ignored
+        :return: number of removed values
+        """
+        self._flush()
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, self.ndim)
+        inside = np.logical_and(coords >= 0, coords < 1 << self.bits).all(axis=1)
+        keys = self.pack(coords[inside])
+        position = np.searchsorted(self.keys, keys)
+        found = position < len(self.keys)
+        found[found] = self.keys[position[found]] == keys[found]
+        position = np.unique(position[found])
+        self.keys = np.delete(self.keys, position)
+        self.values = np.delete(self.values, position)
+        return len(position)
+
+    def shift(self, offset):
+        """
+        Function translating all the stored elements. The order of the keys is kept, so they are repacked without
+        sorting.
+        :param offset: (ndim,) array of integers added to the coordinates
+        :raises ValueError: if a coordinate leaves [0, 2 ** bits)
+        """
+        self._flush()
+        self.keys = self.pack(self.unpack(self.keys) + np.asarray(offset, dtype=np.int64))
+
+    def _merge(self, keys, values, accumulate=False):
+        # keys are sorted and unique
+        position = np.searchsorted(self.keys, keys)
+        existing = position < len(self.keys)
+        existing[existing] = self.keys[position[existing]] == keys[existing]
+        self.values = self.values.astype(np.result_type(self.values, values), copy=False)
+        if accumulate:
+            self.values[position[existing]] += values[existing]
+        else:
+            self.values[position[existing]] = values[existing]
+        new = ~existing
+        self.keys = np.insert(self.keys, position[new], keys[new])
+        self.values = np.insert(self.values, position[new], values[new])
+
+    def _flush(self):
+        if self._pending:
+            pending = self._pending
+            self._pending = {}
+            keys = np.fromiter(pending.keys(), dtype=np.int64, count=len(pending))
+            order = np.argsort(keys)
+            self._merge(keys[order], np.array(list(pending.values()))[order])
+
+    def read_values(self, coords, default=0):
+        """
+        Function reading many values at once.
+        :param coords: (N,ndim) array of coordinates
+        :param default: value returned for the coordinates without stored value
+        :return: (N,) array of values
+        """
+        self._flush()
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, self.ndim)
+        inside = np.logical_and(coords >= 0, coords < 1 << self.bits).all(axis=1)
+        keys = self.pack(coords[inside])
+        position = np.searchsorted(self.keys, keys)
+        found = position < len(self.keys)
+        found[found] = self.keys[position[found]] == keys[found]
+        values = np.full(len(coords), default, dtype=np.result_type(self.values, np.asarray(default)))
+        values[np.flatnonzero(inside)[found]] = self.values[position[found]]
+        return values
+
+    def lookup(self, tuple):
+        """
+        Function looking up a single value.
+        :param tuple: coordinates of the value
+        :return: pair of a flag telling if a value is stored and the value
+        """
+        key = self._key(tuple)
+        if key is None:
+            return False, None
+        if key in self._pending:
+            return True, self._pending[key]
+        position = np.searchsorted(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            return True, self.values[position].item()
+        return False, None
+
+    def _key(self, tuple):
+        if len(tuple) != self.ndim or any(c < 0 or c >= 1 << self.bits for c in tuple):
+            return None
+        key = 0
+        for c in tuple:
+            key = key << self.bits | int(c)
+        return key
 
     def from_dense(self, matrix):
+        matrix = np.asarray(matrix)
+        if len(self) == 0:
+            self.ndim = matrix.ndim
+            self.bits = KEY_BITS // matrix.ndim
         inds = np.array(np.nonzero(matrix)).T
-        for ind in inds:
-            self.addValue(tuple(map(int, ind)), matrix[tuple(ind)])
+        self.add_values(inds, matrix[tuple(inds.T)])
+
+    def to_dense(self, shape=None):
+        """
+        Function converting the matrix to a dense array.
+        :param shape: shape of the dense array, by default the smallest one containing all the elements
+        :return: dense array with zeros for the missing elements
+        """
+        self._flush()
+        if shape is None:
+            shape = self.bounds()[1] + 1 if len(self) else np.zeros(self.ndim, dtype=int)
+        dense = np.zeros(tuple(int(s) for s in shape), dtype=self.values.dtype)
+        dense[tuple(self.coordinates().T)] = self.values
+        return dense
+
+    def coordinates(self):
+        """
+        Function returning the coordinates of the stored elements, in key order.
+        :return: (N,ndim) array of coordinates
+        """
+        self._flush()
+        return self.unpack(self.keys)
+
+    def bounds(self):
+        """
+        Function computing the bounding box of the stored elements.
+        :return: pair of (ndim,) arrays with the minimal and maximal coordinates, None for an empty matrix
+        """
+        coords = self.coordinates()
+        if len(coords) == 0:
+            return None
+        return coords.min(axis=0), coords.max(axis=0)
+
+    def items(self):
+        """
+        Generator over the stored elements in key order.
+        :return: iterator over pairs of coordinate tuples and values
+        """
+        self._flush()
+        return zip(map(tuple, self.coordinates().tolist()), self.values.tolist())
+
+    def __len__(self):
+        self._flush()
+        return len(self.keys)
 
     def addValue(self, tuple, value):
-        self.elements[tuple] = value
+        key = self._key(tuple)
+        if key is None:
+            raise ValueError("coordinates must be %d non-negative integers below %d" % (self.ndim, 1 << self.bits))
+        self._pending[key] = value
+        if len(self._pending) > PENDING_LIMIT + len(self.keys) // 4:
+            self._flush()
 
     def readValue(self, tuple):
-        try:
-            value = self.elements[tuple]
-        except KeyError:
+        found, value = self.lookup(tuple)
+        if not found:
             # could also be 0.0 if using floats...
             value = 0
         return value
+
+    def removeValue(self, tuple):
+        """
+        Function removing a single value.
+        :param tuple: coordinates of the value
+        :return: True if a value was removed
+        """
+        self._flush()
+        key = self._key(tuple)
+        if key is None:
+            return False
+        position = np.searchsorted(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            self.keys = np.delete(self.keys, position)
+            self.values = np.delete(self.values, position)
+            return True
+        return False
@@ -1,53 +1,1034 @@
+import numpy as np
+
 import helpers as he
 
+# three coordinates of 21 bits each fill a 64 bit Morton code
+MAX_DEPTH = 21
+# the occupancy octree stores its codes and the spans of its leaves as int64, which hold 8 ** 20 but not 8 ** 21
+OCCUPANCY_MAX_DEPTH = 20
+# number of points encoded at once, bounds the temporary arrays of the build
+CODE_CHUNK = 1 << 20
+# log-odds of the occupancy updates, clamped to [LOG_ODDS_MIN, LOG_ODDS_MAX], cells above OCCUPANCY_THRESHOLD are
+# occupied
+LOG_ODDS_HIT = 0.85
+LOG_ODDS_MISS = -0.4
+LOG_ODDS_MIN = -2.0
+LOG_ODDS_MAX = 3.5
+OCCUPANCY_THRESHOLD = 0.0
+# number of rays cast at once, bounds the temporary arrays of the ray casting
+RAY_CHUNK = 1 << 16
+# number of radius queries answered at once, bounds the candidate points held in memory
+QUERY_CHUNK = 1 << 14
+
+
+def depth_first_order(first_child, depth):
+    """
+    Function computing the depth first order of the nodes of a tree stored in breadth first order, level by level from
+    the subtree sizes.
+    :param first_child: (M,) array of the id of the first of the 8 consecutive children of every node, -1 for leaves
+    :param depth: (M,) array of the depth of every node
+    :return: array of the node ids in depth first order
+    """
+    inner = np.flatnonzero(first_child >= 0)
+    children = first_child[inner][:, None] + np.arange(8)
+    inner_depth = depth[inner]
+    levels = range(int(inner_depth.max()) + 1 if len(inner) else 0)
+
+    size = np.ones(len(first_child), dtype=np.int64)
+    for level in reversed(levels):
+        at_level = inner_depth == level
+        size[inner[at_level]] += size[children[at_level]].sum(axis=1)
+
+    position = np.zeros(len(first_child), dtype=np.int64)
+    for level in levels:
+        at_level = inner_depth == level
+        child_size = size[children[at_level]]
+        position[children[at_level]] = position[inner[at_level]][:, None] + 1 + np.cumsum(child_size, axis=1) - \
+            child_size
+    order = np.empty(len(first_child), dtype=np.int64)
+    order[position] = np.arange(len(first_child))
+    return order
+
 
 class OctTree:
+    """
+    Octree stored in flat arrays. Node i is described by parent[i], first_child[i] (its 8 children have consecutive ids
+    starting there, -1 for leaves), the range point_start[i]:point_end[i] of the points sorted by Morton code, its
+    depth, its bounds (x_min, y_min, z_min, x_max, y_max, z_max) and the leaf flag. build_tree numbers the nodes in
+    breadth first order, as in the original list based implementation, insert appends the nodes it creates.
+
+    With contiguous=True the tree owns a single (N,3) float array of the points, permuted by build_tree into Morton
+    order, and the points of a node are returned as a view of this array. Otherwise the input points are left untouched
+    and gathered through the order permutation.
+    """
+
+    # arrays holding one row per node
+    node_arrays = ['parent', 'first_child', 'point_start', 'point_end', 'depth', 'bounds', 'leaf', 'node_codes']
+
     class OctNode:
-        def __init__(self):
-            self.corners = []
-            self.children = []
-            self.points = []
-            self.oct_id = -1
-            self.parent = []
-            self.leaf = False
+        """
+        Thin view of a single node of the tree, kept for the code consuming the tree as a list of nodes.
+        """
+
+        def __init__(self, tree, oct_id):
+            self._tree = tree
+            self.oct_id = oct_id
+
+        @property
+        def corners(self):
+            b = self._tree.bounds[self.oct_id]
+            return {'x_min': float(b[0]), 'y_min': float(b[1]), 'z_min': float(b[2]), 'x_max': float(b[3]),
+                    'y_max': float(b[4]), 'z_max': float(b[5])}
 
-    def __init__(self, points, point_threshold):
+        @property
+        def children(self):
+            first = int(self._tree.first_child[self.oct_id])
+            if first < 0:
+                return []
+            return list(range(first, first + 8))
+
+        @property
+        def points(self):
+            return self._tree.node_points(self.oct_id)
+
+        @property
+        def point_range(self):
+            return int(self._tree.point_start[self.oct_id]), int(self._tree.point_end[self.oct_id])
+
+        @property
+        def parent(self):
+            return int(self._tree.parent[self.oct_id])
+
+        @property
+        def leaf(self):
+            return bool(self._tree.leaf[self.oct_id])
+
+    def __init__(self, points, point_threshold, max_depth=MAX_DEPTH, contiguous=False):
 
         self.point_threshold = point_threshold
+        self.max_depth = min(max_depth, MAX_DEPTH)
+        self.contiguous = contiguous
 
         self.corners = he.compute_max_cube(points)
-        self.tree = []
+        if contiguous:
+            points = np.array(points, dtype=float).reshape(-1, 3)
         self.points = points
-        new_root = self.OctNode()
-        new_root.corners = self.corners
-        new_root.points = points
-        new_root.oct_id = 0
-        new_root.parent = -1
-        self.tree.append(new_root)
+        self.order = np.arange(len(points))
+
+        self.parent = np.array([-1])
+        self.first_child = np.array([-1])
+        self.point_start = np.array([0])
+        self.point_end = np.array([len(points)])
+        self.depth = np.array([0])
+        self.bounds = np.array([[self.corners['x_min'], self.corners['y_min'], self.corners['z_min'],
+                                 self.corners['x_max'], self.corners['y_max'], self.corners['z_max']]])
+        self.leaf = np.array([False])
+        # sorted Morton codes of the points at max_depth and smallest code of every node, kept by build_tree for the
+        # updates
+        self.codes = None
+        self.node_codes = None
+        # index given to the next inserted point
+        self.next_index = len(points)
+        self._set_grid()
+        self._nodes = None
+
+    @property
+    def tree(self):
+        """
+        List of node views, in the order of their ids.
+        """
+        if self._nodes is None:
+            self._nodes = [self.OctNode(self, i) for i in range(len(self.parent))]
+        return self._nodes
+
+    def node_points(self, oct_id):
+        """
+        Function returning the points contained in the node.
+        :param oct_id: id of the node
+        :return: view of the contiguous point array or list of points
+        """
+        if self.contiguous:
+            return self.points[self.point_start[oct_id]:self.point_end[oct_id]]
+        return [self.points[i] for i in self.order[self.point_start[oct_id]:self.point_end[oct_id]]]
+
+    def occupancy(self):
+        """
+        Function computing the occupancy of the nodes.
+        :return: array with 1 for the nodes containing points and 0 for the empty ones
+        """
+        return (self.point_end > self.point_start).astype(int)
+
+    def preorder(self):
+        """
+        Function computing the depth first order of the nodes, in which a node is followed by the subtrees of its
+        children. It is the order of the nested export.
+        :return: array of the node ids in depth first order
+        """
+        return depth_first_order(self.first_child, self.depth)
+
+    def export_arrays(self):
+        """
+        Function computing the arrays of the nested export.
+        :return: (M,1) array of the occupancy and (M,) array of the number of children of the nodes in depth first order
+        """
+        order = self.preorder()
+        return self.occupancy()[order].reshape(-1, 1), np.where(self.first_child[order] >= 0, 8, 0)
+
+    def _point_coordinates(self, positions):
+        # coordinates of the points at the given positions of the Morton order
+        if self.contiguous:
+            return self.points[positions]
+        return np.asarray(self.points, dtype=float).reshape(-1, 3)[self.order[positions]]
+
+    def _set_grid(self):
+        # grid of the cells at max_depth in which build_tree quantizes the points, kept when the root grows
+        self.grid_lower = np.array([self.corners['x_min'], self.corners['y_min'], self.corners['z_min']])
+        edge = np.array([self.corners['x_max'], self.corners['y_max'], self.corners['z_max']]) - self.grid_lower
+        self.grid_scale = np.divide(float(2 ** self.max_depth), edge, out=np.zeros(3), where=edge > 0)
+        # number of cells between the lower corner of the root and of the grid, halved with the cells by _coarsen
+        self.grid_offset = np.zeros(3)
+
+    def _point_cells(self, points):
+        # as helpers.quantize_to_cube in the grid of build_tree, shifted to the grown root
+        cells = np.floor((np.asarray(points, dtype=float).reshape(-1, 3) - self.grid_lower) * self.grid_scale +
+                         self.grid_offset)
+        np.clip(cells, 0, 2 ** self.max_depth - 1, out=cells)
+        return cells.astype(np.uint64)
+
+    def _point_codes(self, points):
+        return he.morton_encode(self._point_cells(points))
+
+    def _inside(self, points):
+        return np.logical_and(points >= self.bounds[0, :3], points <= self.bounds[0, 3:]).all(axis=1)
+
+    def _descend(self, codes, levels):
+        # nodes reached from the root following the Morton codes at max_depth, down to the given levels or to a leaf
+        node = np.zeros(len(codes), dtype=np.int64)
+        for level in range(self.max_depth):
+            inner = np.flatnonzero(np.logical_and(self.first_child[node] >= 0, levels > level))
+            if len(inner) == 0:
+                break
+            octant = (codes[inner] >> np.uint64(3 * (self.max_depth - level - 1))) & np.uint64(7)
+            node[inner] = self.first_child[node[inner]] + octant.astype(np.int64)
+        return node
+
+    def _start_pairs(self, lowers, uppers):
+        # pairs of a query and a node to start its descent from: the box of every query, widened by one cell at
+        # max_depth so that boxes touching the border of a cell also cover the neighbouring cell, spans at most 2 cells
+        # per axis at the level of its size, the nodes of its corners at that level cover it
+        size = 2 ** self.max_depth
+        low = np.maximum(self._point_cells(lowers).astype(np.int64) - 1, 0)
+        high = np.minimum(self._point_cells(uppers).astype(np.int64) + 1, size - 1)
+        levels = self.max_depth - np.frexp((high - low).max(axis=1))[1]
+        octants = np.arange(8)
+        corner = np.stack([octants & 1, (octants >> 1) & 1, (octants >> 2) & 1], axis=1).astype(bool)
+        cells = np.where(corner[None, :, :], high[:, None, :], low[:, None, :]).reshape(-1, 3)
+        nodes = self._descend(he.morton_encode(cells), np.repeat(levels, 8))
+        # the corners of a query may reach the same node
+        pairs = he.unique_sorted(np.repeat(np.arange(len(low)), 8) * len(self.parent) + nodes)
+        return pairs // len(self.parent), pairs % len(self.parent)
+
+    def _traverse(self, lowers, uppers, keep):
+        # level by level descent of the pairs of a query and a node, from the nodes covering the box of every query;
+        # keep(query, node) selects the pairs to go on with, only nodes holding points are visited
+        query, node = self._start_pairs(lowers, uppers)
+        leaf_query = [query[:0]]
+        leaf_node = [node[:0]]
+        while len(query):
+            selected = np.logical_and(self.point_end[node] > self.point_start[node], keep(query, node))
+            query = query[selected]
+            node = node[selected]
+            is_leaf = self.first_child[node] < 0
+            leaf_query.append(query[is_leaf])
+            leaf_node.append(node[is_leaf])
+            query = np.repeat(query[~is_leaf], 8)
+            node = (self.first_child[node[~is_leaf]][:, None] + np.arange(8)).ravel()
+        return np.concatenate(leaf_query), np.concatenate(leaf_node)
+
+    @staticmethod
+    def _offsets(query, query_count):
+        return np.concatenate([[0], np.cumsum(np.bincount(query, minlength=query_count))])
+
+    def locate_batch(self, points):
+        """
+        Function finding the leaves containing points. Points on the border of two leaves belong to the leaf of the
+        build, the upper one.
+        :param points: (N,3) array of points
+        :return: (N,) array of leaf ids, -1 for points outside the cube
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        node = self._descend(self._point_codes(points), np.full(len(points), self.max_depth))
+        node[~self._inside(points)] = -1
+        return node
+
+    def locate(self, point):
+        """
+        Function finding the leaf containing a point.
+        :param point: point (x, y, z)
+        :return: id of the leaf, -1 outside the cube
+        """
+        return int(self.locate_batch([point])[0])
+
+    def box_query_batch(self, lowers, uppers):
+        """
+        Function finding the occupied leaves intersecting axis aligned boxes.
+        :param lowers: (N,3) array of the lower corners of the boxes
+        :param uppers: (N,3) array of the upper corners of the boxes
+        :return: (N+1,) array of offsets and array of leaf ids, the leaves of box i being ids[offsets[i]:offsets[i + 1]]
+        in increasing order
+        """
+        lowers = np.asarray(lowers, dtype=float).reshape(-1, 3)
+        uppers = np.asarray(uppers, dtype=float).reshape(-1, 3)
+
+        def intersects(query, node):
+            bounds = self.bounds[node]
+            return np.logical_and(bounds[:, :3] <= uppers[query], bounds[:, 3:] >= lowers[query]).all(axis=1)
+
+        query, node = self._traverse(lowers, uppers, intersects)
+        order = np.lexsort((node, query))
+        return self._offsets(query, len(lowers)), node[order]
+
+    def box_query(self, lower, upper):
+        """
+        Function finding the occupied leaves intersecting an axis aligned box.
+        :param lower: lower corner (x, y, z) of the box
+        :param upper: upper corner (x, y, z) of the box
+        :return: array of leaf ids in increasing order
+        """
+        return self.box_query_batch([lower], [upper])[1]
+
+    def radius_query_batch(self, points, radii):
+        """
+        Function finding the stored points within a distance of query points.
+        :param points: (N,3) array of query points
+        :param radii: radius of all the queries or (N,) array of radii
+        :return: (N+1,) array of offsets, array of indices of the stored points and array of their distances, the
+        points found for query i being indices[offsets[i]:offsets[i + 1]] sorted by distance
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), len(points))
+        counts = []
+        indices = []
+        distances = []
+        for chunk in range(0, len(points), QUERY_CHUNK):
+            chunk_offsets, chunk_indices, chunk_distances = self._radius_chunk(points[chunk:chunk + QUERY_CHUNK],
+                                                                               radii[chunk:chunk + QUERY_CHUNK])
+            counts.append(np.diff(chunk_offsets))
+            indices.append(chunk_indices)
+            distances.append(chunk_distances)
+        if not counts:
+            return np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate([[0], np.cumsum(np.concatenate(counts))]), np.concatenate(indices), \
+            np.concatenate(distances)
+
+    def _radius_chunk(self, points, radii):
+        def near(query, node):
+            bounds = self.bounds[node]
+            centers = points[query]
+            gap = np.maximum(np.maximum(bounds[:, :3] - centers, centers - bounds[:, 3:]), 0)
+            return np.einsum('ij,ij->i', gap, gap) <= radii[query] ** 2
+
+        query, node = self._traverse(points - radii[:, None], points + radii[:, None], near)
+        # every point of the selected leaves is a candidate
+        counts = self.point_end[node] - self.point_start[node]
+        query = np.repeat(query, counts)
+        positions = np.repeat(self.point_start[node] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        differences = self._point_coordinates(positions) - points[query]
+        distances = np.einsum('ij,ij->i', differences, differences)
+        within = distances <= radii[query] ** 2
+        query, positions, distances = query[within], positions[within], np.sqrt(distances[within])
+        # sorted by distance then, stably, by query
+        order = np.argsort(distances, kind='stable')
+        order = order[np.argsort(query[order], kind='stable')]
+        return self._offsets(query, len(points)), self.order[positions[order]], distances[order]
+
+    def radius_query(self, point, radius):
+        """
+        Function finding the stored points within a distance of a query point.
+        :param point: query point (x, y, z)
+        :param radius: radius of the query
+        :return: array of indices of the stored points and array of their distances, sorted by distance
+        """
+        _, indices, distances = self.radius_query_batch([point], radius)
+        return indices, distances
+
+    def knn_query_batch(self, points, k):
+        """
+        Function finding the k nearest stored points of query points. The radius of every query starts from the point
+        density of the leaf of its point and grows until k points are found or all of them are within it.
+        :param points: (N,3) array of query points
+        :param k: number of neighbours
+        :return: (N,k) array of indices of the stored points and (N,k) array of their distances, sorted by distance
+        and padded with -1 and inf if fewer than k points are stored
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        indices = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.inf)
+        leaf = self.locate_batch(points)
+        sizes = (self.bounds[:, 3:] - self.bounds[:, :3]).max(axis=1)
+        lower, upper = self.bounds[0, :3], self.bounds[0, 3:]
+        outside = np.linalg.norm(np.maximum(np.maximum(lower - points, points - upper), 0), axis=1)
+        # beyond the farthest corner of the cube every point is within the radius, with a margin for the rounding
+        farthest = np.linalg.norm(np.maximum(np.abs(points - lower), np.abs(points - upper)), axis=1) * (1 + 1e-9)
+        # a radius expected to hold k points at the density of the leaf of the query
+        counts = self.point_end[np.maximum(leaf, 0)] - self.point_start[np.maximum(leaf, 0)]
+        radii = np.where(leaf >= 0, sizes[np.maximum(leaf, 0)] * np.cbrt(0.75 * k / (np.pi * np.maximum(counts, 1))),
+                         outside + sizes[0] * 2.0 ** -self.max_depth)
+        radii = np.maximum(radii, farthest * 2.0 ** -self.max_depth)
+        pending = np.arange(len(points)) if k > 0 else np.empty(0, dtype=np.int64)
+        while len(pending):
+            offsets, found, found_distances = self.radius_query_batch(points[pending], radii[pending])
+            counts = np.diff(offsets)
+            done = np.logical_or(counts >= k, radii[pending] >= farthest[pending])
+            query = np.repeat(np.arange(len(pending)), counts)
+            rank = np.arange(len(found)) - offsets[query]
+            selected = np.logical_and(done[query], rank < k)
+            indices[pending[query[selected]], rank[selected]] = found[selected]
+            distances[pending[query[selected]], rank[selected]] = found_distances[selected]
+            # grown as if the density within the radius were uniform, at most doubled
+            growth = np.minimum(2.0, 1.25 * np.cbrt(k / np.maximum(counts[~done], 1)))
+            pending = pending[~done]
+            radii[pending] *= growth
+        return indices, distances
+
+    def knn_query(self, point, k):
+        """
+        Function finding the k nearest stored points of a query point.
+        :param point: query point (x, y, z)
+        :param k: number of neighbours
+        :return: array of at most k indices of the stored points and array of their distances, sorted by distance
+        """
+        indices, distances = self.knn_query_batch([point], k)
+        found = indices[0] >= 0
+        return indices[0][found], distances[0][found]
 
     def build_tree(self):
-        explore = True
-        while explore:
-            explore = False
-            for node in self.tree:
-                if not node.leaf and len(node.children) == 0:
-                    explore = True
-                    self.attempt_split(node)
-
-    def attempt_split(self, node):
-        sub_cubes = he.divide_cube(node.corners)
-        attempted_nodes = []
-        children_ids = []
-        for sc_id, sc_corners in sub_cubes.items():
-            att_node = self.OctNode()
-            att_node.corners = sc_corners
-            att_node.parent = node.oct_id
-            att_node.oct_id = self.tree[-1].oct_id + 1 + sc_id
-            children_ids.append(self.tree[-1].oct_id + 1 + sc_id)
-            points_in, points_count = he.in_cube(node.points, sc_corners)
-            if points_count < self.point_threshold:
-                att_node.leaf = True
-            att_node.points = points_in
-            attempted_nodes.append(att_node)
-        self.tree.extend(attempted_nodes)
-        node.children = children_ids
+        """
+        Function building the tree. The points are sorted once by their Morton code, then the tree is built level by
+        level, the points of each child being a contiguous range of the points of its parent. Nodes holding fewer than
+        point_threshold points and nodes at max_depth are leaves.
+        """
+        depth = self.max_depth
+        self._set_grid()
+        points = self.points if self.contiguous else np.asarray(self.points, dtype=float).reshape(-1, 3)
+        codes = np.empty(len(points), dtype=np.uint64)
+        for chunk in range(0, len(points), CODE_CHUNK):
+            codes[chunk:chunk + CODE_CHUNK] = he.morton_encode(
+                he.quantize_to_cube(points[chunk:chunk + CODE_CHUNK], self.corners, depth))
+        del points
+        self.order = np.argsort(codes, kind='stable')
+        codes = codes[self.order]
+        self.codes = codes
+        if self.contiguous:
+            # one column at a time, so the permutation needs a single column of temporary memory
+            for axis in range(3):
+                self.points[:, axis] = self.points[self.order, axis]
+
+        lower = self.bounds[0, :3]
+        edge = self.bounds[0, 3:] - lower
+        octants = np.arange(8, dtype=np.uint64)
+        octant_offsets = np.stack([octants & 1, (octants >> 1) & 1, (octants >> 2) & 1], axis=1)
+
+        # per level chunks of the node arrays, concatenated once at the end
+        parent = [np.array([-1])]
+        first_child = [np.array([-1])]
+        start = [np.array([0])]
+        end = [np.array([len(codes)])]
+        depths = [np.array([0])]
+        leaf = [np.array([depth == 0])]
+        level_cells = [np.zeros((1, 3), dtype=np.uint64)]
+        level_codes = [np.zeros(1, dtype=np.uint64)]
+
+        node_count = 1
+        frontier = np.array([0]) if depth > 0 else np.array([], dtype=int)
+        for level in range(depth):
+            if len(frontier) == 0:
+                break
+            prefix = codes >> np.uint64(3 * (depth - level - 1))
+            child_codes = ((level_codes[-1][frontier] << np.uint64(3))[:, None] | octants).ravel()
+            child_start = np.searchsorted(prefix, child_codes, side='left')
+            child_end = np.searchsorted(prefix, child_codes, side='right')
+            del prefix
+
+            first_child[-1][frontier] = node_count + 8 * np.arange(len(frontier))
+            parent.append(np.repeat(frontier + node_count - len(level_codes[-1]), 8))
+            first_child.append(np.full(len(child_codes), -1))
+            start.append(child_start)
+            end.append(child_end)
+            depths.append(np.full(len(child_codes), level + 1))
+            leaf.append(np.logical_or(child_end - child_start < self.point_threshold, level + 1 == depth))
+            level_cells.append((level_cells[-1][frontier][:, None, :] * np.uint64(2) + octant_offsets).reshape(-1, 3))
+            level_codes.append(child_codes)
+
+            node_count += len(child_codes)
+            frontier = np.flatnonzero(~leaf[-1])
+
+        self.parent = np.concatenate(parent)
+        self.first_child = np.concatenate(first_child)
+        self.point_start = np.concatenate(start)
+        self.point_end = np.concatenate(end)
+        self.depth = np.concatenate(depths)
+        self.leaf = np.concatenate(leaf)
+        self.node_codes = np.concatenate(level_codes) << (np.uint64(3) * (depth - self.depth).astype(np.uint64))
+        cells = np.concatenate(level_cells).astype(float)
+        step = edge / (2.0 ** self.depth)[:, None]
+        self.bounds = np.concatenate([lower + cells * step, lower + (cells + 1) * step], axis=1)
+        self._nodes = None
+
+    def _append_nodes(self, **rows):
+        for name in self.node_arrays:
+            setattr(self, name, np.concatenate([getattr(self, name), rows[name]]))
+
+    def _node_bounds(self, node_codes, depth):
+        # bounds of nodes from their smallest code, computed as in build_tree
+        lower = self.bounds[0, :3]
+        step = (self.bounds[0, 3:] - lower) / (2.0 ** depth)[:, None]
+        cells = he.morton_decode(node_codes) >> (np.uint64(self.max_depth) - depth.astype(np.uint64))[:, None]
+        cells = cells.astype(float)
+        return np.concatenate([lower + cells * step, lower + (cells + 1) * step], axis=1)
+
+    def _coarsen(self):
+        # drops the deepest level of cells: the nodes at max_depth are merged into their parents and the codes lose
+        # their last digit, so the order of the points and the ranges of the other nodes are unchanged
+        deepest = np.flatnonzero(self.depth == self.max_depth)
+        parents = he.unique_sorted(self.parent[deepest])
+        self.first_child[parents] = -1
+        self.leaf[parents] = True
+        self._compact(deepest)
+        self.codes = self.codes >> np.uint64(3)
+        self.node_codes = self.node_codes >> np.uint64(3)
+        self.max_depth -= 1
+        self.grid_scale = self.grid_scale / 2
+        self.grid_offset = self.grid_offset / 2
+
+    def _grow(self, points):
+        # doubles the root towards the points outside of it until it contains them, the old root becoming one of the 8
+        # children of the new one at node 0, so the cells at max_depth are unchanged. At MAX_DEPTH the deepest level
+        # is dropped first, the cells becoming twice as large
+        grown = False
+        while True:
+            lower = self.bounds[0, :3]
+            upper = self.bounds[0, 3:]
+            below = (points < lower).any(axis=0)
+            if not below.any() and not (points > upper).any():
+                return grown
+            if not (upper > lower).all():
+                raise ValueError("a tree without volume cannot grow")
+            if self.max_depth == MAX_DEPTH:
+                self._coarsen()
+            grown = True
+            octant = int(below[0]) + 2 * int(below[1]) + 4 * int(below[2])
+            # the codes of the old tree get the octant of the old root as their highest digit
+            prefix = np.uint64(octant) << np.uint64(3 * self.max_depth)
+            self.codes = self.codes | prefix
+            self.node_codes = self.node_codes | prefix
+            self.grid_offset = self.grid_offset + below * 2 ** self.max_depth
+            self.depth = self.depth + 1
+            self.max_depth += 1
+            new_lower = lower - (upper - lower) * below
+            new_upper = new_lower + 2 * (upper - lower)
+            self.corners = {'x_min': float(new_lower[0]), 'y_min': float(new_lower[1]), 'z_min': float(new_lower[2]),
+                            'x_max': float(new_upper[0]), 'y_max': float(new_upper[1]), 'z_max': float(new_upper[2])}
+
+            size = len(self.parent)
+            child_codes = np.arange(8, dtype=np.uint64) << np.uint64(3 * (self.max_depth - 1))
+            old_root = {name: np.copy(getattr(self, name)[0]) for name in self.node_arrays}
+            self._append_nodes(parent=np.zeros(8, dtype=self.parent.dtype),
+                               first_child=np.full(8, -1, dtype=self.first_child.dtype),
+                               point_start=np.searchsorted(self.codes, child_codes),
+                               point_end=np.searchsorted(self.codes, child_codes + (child_codes[1] - child_codes[0])),
+                               depth=np.ones(8, dtype=self.depth.dtype), bounds=np.zeros((8, 6)),
+                               leaf=np.ones(8, dtype=bool), node_codes=child_codes)
+            for name in self.node_arrays:
+                getattr(self, name)[size + octant] = old_root[name]
+            self.parent[size + octant] = 0
+            if self.first_child[0] >= 0:
+                self.parent[self.first_child[0]:self.first_child[0] + 8] = size + octant
+            self.parent[0] = -1
+            self.first_child[0] = size
+            self.point_start[0] = 0
+            self.point_end[0] = len(self.codes)
+            self.depth[0] = 0
+            self.bounds[0] = np.concatenate([new_lower, new_upper])
+            self.leaf[0] = False
+            self.node_codes[0] = 0
+            siblings = np.setdiff1d(np.arange(size, size + 8), [size + octant])
+            self.bounds[siblings] = self._node_bounds(self.node_codes[siblings], self.depth[siblings])
+
+    def _split(self, frontier):
+        # splits the leaves of the frontier holding at least point_threshold points above max_depth, then their
+        # children, level by level
+        while len(frontier):
+            frontier = frontier[np.logical_and(self.point_end[frontier] - self.point_start[frontier] >=
+                                               self.point_threshold, self.depth[frontier] < self.max_depth)]
+            if len(frontier) == 0:
+                return
+            size = len(self.parent)
+            self.first_child[frontier] = size + 8 * np.arange(len(frontier))
+            self.leaf[frontier] = False
+            depth = np.repeat(self.depth[frontier] + 1, 8)
+            span = np.uint64(8) ** (np.uint64(self.max_depth) - depth.astype(np.uint64))
+            node_codes = np.repeat(self.node_codes[frontier], 8) + np.tile(np.arange(8, dtype=np.uint64),
+                                                                           len(frontier)) * span
+            start = np.searchsorted(self.codes, node_codes)
+            end = np.searchsorted(self.codes, node_codes + span)
+            self._append_nodes(parent=np.repeat(frontier, 8), first_child=np.full(len(depth), -1),
+                               point_start=start, point_end=end, depth=depth,
+                               bounds=self._node_bounds(node_codes, depth),
+                               leaf=np.logical_or(end - start < self.point_threshold, depth == self.max_depth),
+                               node_codes=node_codes)
+            frontier = np.arange(size, len(self.parent))
+
+    def _compact(self, drop):
+        # removes nodes, whole groups of siblings, and renumbers the others in the same order
+        keep = np.ones(len(self.parent), dtype=bool)
+        keep[drop] = False
+        new_id = np.cumsum(keep) - 1
+        for name in self.node_arrays:
+            setattr(self, name, getattr(self, name)[keep])
+        self.parent = np.where(self.parent >= 0, new_id[self.parent], -1)
+        self.first_child = np.where(self.first_child >= 0, new_id[self.first_child], -1)
+
+    def _merge_points(self, points, indices):
+        # merges points into the Morton order, the coordinates of the non contiguous points are already stored
+        codes = self._point_codes(points)
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        positions = np.searchsorted(self.codes, codes, side='right')
+        # every node gets the new points of its range of codes
+        span = np.uint64(8) ** (np.uint64(self.max_depth) - self.depth.astype(np.uint64))
+        self.point_start = self.point_start + np.searchsorted(codes, self.node_codes)
+        self.point_end = self.point_end + np.searchsorted(codes, self.node_codes + span)
+        self.codes = np.insert(self.codes, positions, codes)
+        self.order = np.insert(self.order, positions, indices[order])
+        if self.contiguous:
+            self.points = np.insert(self.points, positions, points[order], axis=0)
+        return codes
+
+    def _delete_positions(self, positions):
+        # removes the points at the sorted positions of the Morton order, the nodes are kept
+        self.point_start = self.point_start - np.searchsorted(positions, self.point_start)
+        self.point_end = self.point_end - np.searchsorted(positions, self.point_end)
+        self.codes = np.delete(self.codes, positions)
+        self.order = np.delete(self.order, positions)
+        if self.contiguous:
+            self.points = np.delete(self.points, positions, axis=0)
+
+    def insert(self, points):
+        """
+        Function adding a batch of points to the tree, built first if needed. The root is doubled until it contains the
+        points, the points are merged into the Morton order and only the leaves receiving points are split, level by
+        level, as in build_tree. The new points get the indices next_index, next_index + 1, ... in their order.
+        :param points: (N,3) array of points
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if self.codes is None:
+            self.build_tree()
+        if len(points) == 0:
+            return
+        indices = self.next_index + np.arange(len(points))
+        self.next_index += len(points)
+        # the contiguous points are stored by _merge_points
+        if not self.contiguous:
+            if isinstance(self.points, np.ndarray):
+                self.points = np.concatenate([np.asarray(self.points, dtype=float).reshape(-1, 3), points])
+            else:
+                self.points = list(self.points) + list(points)
+
+        if self._grow(points):
+            # the points on the upper faces of the old root were clipped into it and the cells of a dropped level are
+            # quantized anew, the points whose code changed move to their own cell
+            moved = np.flatnonzero(self._point_codes(self._point_coordinates(np.arange(len(self.codes)))) != self.codes)
+            if len(moved):
+                points = np.concatenate([self._point_coordinates(moved), points])
+                indices = np.concatenate([self.order[moved], indices])
+                self._delete_positions(moved)
+        codes = self._merge_points(points, indices)
+        self._split(he.unique_sorted(self._descend(codes, np.full(len(codes), self.max_depth))))
+        self._nodes = None
+
+    def remove(self, points):
+        """
+        Function removing from the tree, built first if needed, the stored points equal to any of the given points. The
+        inner nodes left with fewer than point_threshold points along the paths of the removed points become leaves.
+        The indices of the remaining points are unchanged.
+        :param points: (N,3) array of points
+        :return: number of removed points
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if self.codes is None:
+            self.build_tree()
+        points = points[self._inside(points)]
+        codes = self._point_codes(points)
+        start = np.searchsorted(self.codes, codes, side='left')
+        counts = np.searchsorted(self.codes, codes, side='right') - start
+        query = np.repeat(np.arange(len(points)), counts)
+        positions = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        removed = he.unique_sorted(positions[(self._point_coordinates(positions) == points[query]).all(axis=1)])
+        if len(removed) == 0:
+            return 0
+        codes = he.unique_sorted(self.codes[removed])
+        self._delete_positions(removed)
+
+        # the root stays inner, as in build_tree, the highest inner node of a path below the threshold is collapsed
+        collapsed = []
+        node = np.zeros(len(codes), dtype=np.int64)
+        for level in range(self.max_depth):
+            inner = self.first_child[node] >= 0
+            node, codes = node[inner], codes[inner]
+            if len(node) == 0:
+                break
+            octant = (codes >> np.uint64(3 * (self.max_depth - level - 1))) & np.uint64(7)
+            node = self.first_child[node] + octant.astype(np.int64)
+            small = np.logical_and(self.first_child[node] >= 0,
+                                   self.point_end[node] - self.point_start[node] < self.point_threshold)
+            collapsed.append(node[small])
+            node, codes = node[~small], codes[~small]
+        collapsed = he.unique_sorted(np.concatenate(collapsed)) if collapsed else np.empty(0, dtype=np.int64)
+        drop = []
+        frontier = collapsed
+        while len(frontier):
+            children = (self.first_child[frontier][:, None] + np.arange(8)).ravel()
+            drop.append(children)
+            frontier = children[self.first_child[children] >= 0]
+        self.first_child[collapsed] = -1
+        self.leaf[collapsed] = True
+        if drop:
+            self._compact(np.concatenate(drop))
+        self._nodes = None
+        return len(removed)
+
+
+class OccupancyOctTree:
+    """
+    Probabilistic occupancy octree of fixed depth, in the manner of OctoMap. The leaves are stored as sorted disjoint
+    intervals of Morton codes of the cells at max_depth: leaf i covers the codes starts[i]:starts[i] + 8 ** (max_depth -
+    levels[i]) and holds the log-odds values[i] of its occupancy. The space outside the leaves is unknown.
+
+    Scans are inserted in batches: the cells of the end points are updated once as hits, then the cells crossed by the
+    rays from the sensor origin are updated as misses, except the hit cells. The misses are merged into the tree every
+    RAY_CHUNK rays, a cell being updated at most once per chunk, so the memory does not grow with the length of the
+    rays. Subtrees whose 8 children are leaves with the same value are pruned into a single leaf.
+    """
+
+    def __init__(self, corners, max_depth=16, hit=LOG_ODDS_HIT, miss=LOG_ODDS_MISS, clamp=(LOG_ODDS_MIN, LOG_ODDS_MAX)):
+        if not 0 <= max_depth <= OCCUPANCY_MAX_DEPTH:
+            raise ValueError("max_depth must lie in [0, %d]" % OCCUPANCY_MAX_DEPTH)
+        self.corners = corners
+        self.max_depth = max_depth
+        self.hit = hit
+        self.miss = miss
+        self.clamp = clamp
+        self.lower = np.array([corners['x_min'], corners['y_min'], corners['z_min']], dtype=float)
+        self.edge = np.array([corners['x_max'], corners['y_max'], corners['z_max']], dtype=float) - self.lower
+
+        self.starts = np.empty(0, dtype=np.int64)
+        self.levels = np.empty(0, dtype=np.int8)
+        self.values = np.empty(0, dtype=np.float32)
+
+    @property
+    def resolution(self):
+        """
+        Size of the cells at max_depth along each axis.
+        """
+        return self.edge / 2 ** self.max_depth
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _span(self, levels):
+        return np.left_shift(np.int64(1), 3 * (self.max_depth - levels.astype(np.int64)))
+
+    def _grid(self, points):
+        # coordinates in units of cells at max_depth
+        scale = np.divide(float(2 ** self.max_depth), self.edge, out=np.zeros(3), where=self.edge > 0)
+        return (np.asarray(points, dtype=float).reshape(-1, 3) - self.lower) * scale
+
+    def _codes(self, cells):
+        return he.morton_encode(cells).astype(np.int64)
+
+    def _find(self, codes):
+        # index of the leaf containing every code, -1 for the unknown ones
+        index = np.searchsorted(self.starts, codes, side='right') - 1
+        found = index >= 0
+        found[found] = codes[found] < self.starts[index[found]] + self._span(self.levels[index[found]])
+        return np.where(found, index, -1)
+
+    def _traverse(self, start, direction, first, last):
+        # sorted codes of the cells crossed by the rays start + t * direction from the cell first to the cell last, as
+        # the cells visited by a stepped 3D DDA: the crossings of the cell boundaries along all the axes are ordered by
+        # t, the ties by axis so a diagonal move visits the cells of its steps, and every crossing moves the cell of
+        # its ray by one step along its axis. The crossings of all the rays are computed at once instead of stepping
+        # the rays
+        step = np.sign(direction).astype(np.int64)
+        moves = np.abs(last - first)
+        visited = he.unique_sorted(self._codes(first))
+        # the rays are split so that every batch creates at most RAY_CHUNK * 64 cells
+        batch = RAY_CHUNK * 64
+        bounds = np.searchsorted(np.cumsum(moves.sum(axis=1)), np.arange(1, moves.sum() // batch + 1) * batch)
+        for rays in np.split(np.arange(len(first)), bounds):
+            count = moves[rays].ravel()
+            ray = np.repeat(np.repeat(rays, 3), count)
+            axis = np.repeat(np.tile(np.arange(3), len(rays)), count)
+            crossing = np.arange(len(ray)) - np.repeat(np.cumsum(count) - count, count)
+            # boundary crossed along the axis, on the far side of the cell left
+            boundary = first[ray, axis] + step[ray, axis] * crossing + (step[ray, axis] > 0)
+            t = (boundary - start[axis]) / direction[ray, axis]
+            # t lies in [0, 1], so adding the index of the ray keeps the rays apart and the order of their crossings,
+            # the crossings closer than the precision of the sum counting as ties
+            order = np.argsort((ray - rays[:1]) + t, kind='stable')
+            ray = ray[order]
+            axis = axis[order]
+            # steps made by every ray up to each of its crossings
+            steps = np.zeros((len(ray) + 1, 3), dtype=np.int64)
+            steps[np.arange(1, len(ray) + 1), axis] = step[ray, axis]
+            np.cumsum(steps, axis=0, out=steps)
+            ray_count = moves[rays].sum(axis=1)
+            steps = steps[1:] - steps[np.repeat(np.cumsum(ray_count) - ray_count, ray_count)]
+            # the cells are deduplicated after every batch, so only the distinct cells are kept
+            visited = he.unique_sorted(np.concatenate([visited, self._codes(first[ray] + steps)]))
+        return visited
+
+    def _ray_ends(self, origin, points, max_range):
+        # ends of the rays in units of cells, shortened to max_range, and whether they are hits: the end points inside
+        # the cube and not beyond max_range
+        hits = np.ones(len(points), dtype=bool)
+        if max_range is not None:
+            lengths = np.linalg.norm(points - origin, axis=1)
+            too_far = lengths > max_range
+            points = points.copy()
+            points[too_far] = origin + (points[too_far] - origin) * (max_range / lengths[too_far])[:, None]
+            hits = ~too_far
+        end = self._grid(points)
+        hits &= np.logical_and(end >= 0, end < 2 ** self.max_depth).all(axis=1)
+        return end, hits
+
+    def _free_codes(self, start, end):
+        # sorted unique codes of the cells crossed by the rays from start to end, the segments being clipped to the
+        # grid with the slab method
+        grid_size = 2 ** self.max_depth
+        direction = end - start
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0 = -start / direction
+            t1 = (grid_size - start) / direction
+        inside = np.logical_and(start >= 0, start <= grid_size)
+        t_low = np.where(direction != 0, np.minimum(t0, t1), np.where(inside, -np.inf, np.inf))
+        t_high = np.where(direction != 0, np.maximum(t0, t1), np.where(inside, np.inf, -np.inf))
+        t_enter = np.maximum(t_low.max(axis=1), 0.0)
+        t_exit = np.minimum(t_high.min(axis=1), 1.0)
+        valid = t_enter <= t_exit
+        direction = direction[valid]
+        enter = start + t_enter[valid, None] * direction
+        leave = np.where((t_exit[valid] >= 1.0)[:, None], end[valid], start + t_exit[valid, None] * direction)
+
+        # on a cell boundary the ray enters the cell on the side of its direction and leaves the cell on the other side
+        first = np.floor(enter) - np.logical_and(enter == np.floor(enter), direction < 0)
+        last = np.floor(leave) - np.logical_and(leave == np.floor(leave), direction > 0)
+        first = np.clip(first, 0, grid_size - 1).astype(np.int64)
+        last = np.clip(last, 0, grid_size - 1).astype(np.int64)
+        # the rays only touching the grid on its faces, edges or corners cross no cell
+        crossing = ((last - first) * np.sign(direction) >= 0).all(axis=1)
+        return self._traverse(start, direction[crossing], first[crossing], last[crossing])
+
+    def cast_rays(self, origin, points, max_range=None):
+        """
+        Function computing the cells hit by the end points and crossed by the rays of a scan, all the rays being
+        traversed at once. The rays are clipped to the cube, end points outside the cube or beyond max_range are not
+        hits.
+        :param origin: (3,) position of the sensor
+        :param points: (N,3) array of measured points
+        :param max_range: maximal length of the rays in meters, unlimited if None
+        :return: sorted unique Morton codes of the hit cells and of the free cells, the hit cells excluded
+        """
+        origin = np.asarray(origin, dtype=float).reshape(3)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        start = self._grid(origin)[0]
+        hit_codes = []
+        free_codes = np.empty(0, dtype=np.int64)
+        for chunk in range(0, len(points), RAY_CHUNK):
+            end, hits = self._ray_ends(origin, points[chunk:chunk + RAY_CHUNK], max_range)
+            hit_codes.append(self._codes(np.floor(end[hits])))
+            free_codes = he.unique_sorted(np.concatenate([free_codes, self._free_codes(start, end)]))
+        hit_codes = he.unique_sorted(np.concatenate(hit_codes)) if hit_codes else np.empty(0, dtype=np.int64)
+        return hit_codes, np.setdiff1d(free_codes, hit_codes, assume_unique=True)
+
+    def insert_scan(self, origin, points, max_range=None):
+        """
+        Function updating the tree with a scan: the hit cells first, then the free cells of every RAY_CHUNK rays.
+        :param origin: (3,) position of the sensor
+        :param points: (N,3) array of measured points
+        :param max_range: maximal length of the rays in meters, unlimited if None
+        """
+        origin = np.asarray(origin, dtype=float).reshape(3)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        start = self._grid(origin)[0]
+        end, hits = self._ray_ends(origin, points, max_range)
+        hit_codes = he.unique_sorted(self._codes(np.floor(end[hits])))
+        self.update_cells(hit_codes, np.full(len(hit_codes), self.hit, dtype=np.float32))
+        for chunk in range(0, len(end), RAY_CHUNK):
+            free_codes = np.setdiff1d(self._free_codes(start, end[chunk:chunk + RAY_CHUNK]), hit_codes,
+                                      assume_unique=True)
+            self.update_cells(free_codes, np.full(len(free_codes), self.miss, dtype=np.float32))
+
+    def update_cells(self, codes, updates):
+        """
+        Function adding log-odds updates to cells at max_depth, expanding the pruned leaves containing them and pruning
+        the subtrees made uniform by the update.
+        :param codes: sorted unique Morton codes of the cells
+        :param updates: log-odds added to the cells, unknown cells starting at 0
+        """
+        if len(codes) == 0:
+            return
+        self._expand(codes)
+        index = self._find(codes)
+        known = index >= 0
+        values = np.zeros(len(codes), dtype=np.float32)
+        values[known] = self.values[index[known]]
+        values = np.clip(values + updates, *self.clamp).astype(np.float32)
+        self.values[index[known]] = values[known]
+        position = np.searchsorted(self.starts, codes[~known])
+        self.starts = np.insert(self.starts, position, codes[~known])
+        self.levels = np.insert(self.levels, position, np.int8(self.max_depth))
+        self.values = np.insert(self.values, position, values[~known])
+        self._prune(codes)
+
+    def _expand(self, codes):
+        # splits the pruned leaves containing codes down to max_depth along the paths to the codes
+        index = he.unique_sorted(self._find(codes))
+        index = index[index >= 0]
+        index = index[self.levels[index] < self.max_depth]
+        if len(index) == 0:
+            return
+        starts = self.starts[index]
+        levels = self.levels[index].astype(np.int64)
+        values = self.values[index]
+        new_starts = []
+        new_levels = []
+        new_values = []
+        while len(starts):
+            span = self._span(levels + 1)
+            starts = (starts[:, None] + np.arange(8) * span[:, None]).ravel()
+            levels = np.repeat(levels + 1, 8)
+            values = np.repeat(values, 8)
+            span = np.repeat(span, 8)
+            contains = np.searchsorted(codes, starts) < np.searchsorted(codes, starts + span)
+            split = contains & (levels < self.max_depth)
+            new_starts.append(starts[~split])
+            new_levels.append(levels[~split])
+            new_values.append(values[~split])
+            starts = starts[split]
+            levels = levels[split]
+            values = values[split]
+        keep = np.ones(len(self.starts), dtype=bool)
+        keep[index] = False
+        starts = np.concatenate([self.starts[keep]] + new_starts)
+        order = np.argsort(starts)
+        self.starts = starts[order]
+        self.levels = np.concatenate([self.levels[keep]] + new_levels).astype(np.int8)[order]
+        self.values = np.concatenate([self.values[keep]] + new_values).astype(np.float32)[order]
+
+    def _prune(self, codes):
+        # merges the uniform groups of 8 sibling leaves, bottom up along the paths to the updated codes
+        for level in range(self.max_depth, 0, -1):
+            shift = 3 * (self.max_depth - level + 1)
+            parents = he.unique_sorted(codes >> shift)
+            first = np.searchsorted(self.starts, parents << shift)
+            count = np.searchsorted(self.starts, (parents + 1) << shift) - first
+            candidate = count == 8
+            first = first[candidate]
+            parents = parents[candidate]
+            if len(first) == 0:
+                continue
+            siblings = first[:, None] + np.arange(8)
+            uniform = np.logical_and((self.levels[siblings] == level).all(axis=1),
+                                     (self.values[siblings] == self.values[first][:, None]).all(axis=1))
+            if not uniform.any():
+                continue
+            first = first[uniform]
+            keep = np.ones(len(self.starts), dtype=bool)
+            keep[(first[:, None] + np.arange(1, 8)).ravel()] = False
+            self.starts[first] = parents[uniform] << shift
+            self.levels[first] = level - 1
+            self.starts = self.starts[keep]
+            self.levels = self.levels[keep]
+            self.values = self.values[keep]
+
+    def log_odds(self, points):
+        """
+        Function reading the log-odds of the cells containing points.
+        :param points: (N,3) array of points
+        :return: (N,) array of log-odds, nan for unknown cells and points outside the cube
+        """
+        grid = self._grid(points)
+        inside = np.logical_and(grid >= 0, grid < 2 ** self.max_depth).all(axis=1)
+        result = np.full(len(grid), np.nan)
+        index = self._find(self._codes(np.floor(grid[inside])))
+        result[np.flatnonzero(inside)[index >= 0]] = self.values[index[index >= 0]]
+        return result
+
+    def occupancy(self, points):
+        """
+        Function classifying the cells containing points.
+        :param points: (N,3) array of points
+        :return: (N,) array with 1 for occupied, 0 for free and -1 for unknown cells
+        """
+        values = self.log_odds(points)
+        return np.where(np.isnan(values), -1, (values > OCCUPANCY_THRESHOLD).astype(int))
+
+    def leaf_bounds(self):
+        """
+        Function computing the bounds of the leaves.
+        :return: (L,6) array of the bounds (x_min, y_min, z_min, x_max, y_max, z_max) of the leaves
+        """
+        cells = self._cells(self.starts)
+        size = (2.0 ** (self.max_depth - self.levels.astype(float)))[:, None]
+        step = self.resolution
+        return np.concatenate([self.lower + cells * step, self.lower + (cells + size) * step], axis=1)
+
+    def _cells(self, codes):
+        cells = np.zeros((len(codes), 3), dtype=np.int64)
+        for bit in range(self.max_depth):
+            for axis in range(3):
+                cells[:, axis] |= ((codes >> (3 * bit + axis)) & 1) << bit
+        return cells
+
+    def export_arrays(self):
+        """
+        Function computing the arrays of the nested export. The tree is expanded level by level from the root: a node
+        without leaf is an unknown leaf (-1), a node that is a leaf is occupied (1) or free (0), every other node has 8
+        children and the maximum of their occupancies.
+        :return: (M,1) array of the occupancy and (M,) array of the number of children of the nodes in depth first order
+        """
+        occupancy = []
+        first_child = []
+        depth = []
+        prefixes = np.zeros(1, dtype=np.int64)
+        node_count = 1
+        for level in range(self.max_depth + 1):
+            shift = 3 * (self.max_depth - level)
+            first = np.searchsorted(self.starts, prefixes << shift)
+            count = np.searchsorted(self.starts, (prefixes + 1) << shift) - first
+            is_leaf = count == 1
+            is_leaf[is_leaf] = self.levels[first[is_leaf]] == level
+            inner = np.logical_and(count > 0, ~is_leaf)
+            level_occupancy = np.full(len(prefixes), -1)
+            level_occupancy[is_leaf] = self.values[first[is_leaf]] > OCCUPANCY_THRESHOLD
+            level_first_child = np.full(len(prefixes), -1, dtype=np.int64)
+            level_first_child[inner] = node_count + 8 * np.arange(np.count_nonzero(inner))
+            occupancy.append(level_occupancy)
+            first_child.append(level_first_child)
+            depth.append(np.full(len(prefixes), level))
+            node_count += 8 * np.count_nonzero(inner)
+            prefixes = ((prefixes[inner] << 3)[:, None] + np.arange(8)).ravel()
+            if len(prefixes) == 0:
+                break
+
+        occupancy = np.concatenate(occupancy)
+        first_child = np.concatenate(first_child)
+        depth = np.concatenate(depth)
+        inner = np.flatnonzero(first_child >= 0)
+        for level in range(int(depth.max()), -1, -1):
+            at_level = inner[depth[inner] == level]
+            occupancy[at_level] = occupancy[first_child[at_level][:, None] + np.arange(8)].max(axis=1)
+        order = depth_first_order(first_child, depth)
+        return occupancy[order].reshape(-1, 1), np.where(first_child[order] >= 0, 8, 0)
@@ -0,0 +1,156 @@
+import numpy as np
+
+import helpers as he
+import nd_sparse_matrix as sp
+import oct_tree as oc
+
+# number of voxel columns of a wall tested at once
+COLUMN_CHUNK = 1 << 16
+# relative slack of the closed overlap tests, so walls lying on voxel faces are not lost to rounding
+OVERLAP_SLACK = 1e-9
+
+
+def parallelogram_corners(paras):
+    """
+    Function converting the parallelograms to an array of their corners.
+    :param paras: list of parallelograms as returned by toy_example_generator.generate_parallelograms
+    :return: (P,4,3) array of the corners a, b, c and d of every parallelogram
+    """
+    return np.array([[para[corner][:3] for corner in 'abcd'] for para in paras], dtype=float).reshape(-1, 4, 3)
+
+
+def _cell_range(axis_edges, lower, upper):
+    # cells of the axis overlapping [lower, upper] with a margin of one cell, clipped to the grid
+    first = max(int(np.searchsorted(axis_edges, lower, side='right')) - 2, 0)
+    last = min(int(np.searchsorted(axis_edges, upper, side='right')), len(axis_edges) - 2)
+    return np.arange(first, last + 1)
+
+
+def _overlaps(corners, lower, upper, last):
+    # separating axis test of the parallelogram against the boxes: the box faces, the normal of the parallelogram and
+    # the cross products of the box edges with the parallelogram edges. Along the box faces the voxels are half-open
+    # as the bins of voxel_indices, the last voxel of an axis including its upper face
+    low = corners.min(axis=0)
+    high = corners.max(axis=0)
+    keep = np.all((high >= lower) & ((low < upper) | (last & (low <= upper))), axis=1)
+    center = (lower + upper) / 2
+    half = (upper - lower) / 2
+    u = corners[0] - corners[1]
+    v = corners[2] - corners[1]
+    axes = [np.cross(u, v)] + [np.cross(box_axis, edge) for box_axis in np.eye(3) for edge in (u, v)]
+    for axis in axes:
+        if not axis.any():
+            continue
+        projection = corners @ axis
+        box_center = center @ axis
+        radius = half @ np.abs(axis)
+        slack = OVERLAP_SLACK * (np.abs(box_center) + radius)
+        keep &= (projection.min() <= box_center + radius + slack) & (projection.max() >= box_center - radius - slack)
+    return keep
+
+
+def _wall_cells(corners, edges):
+    # candidate voxels of a wall: the voxels of the bounding box for a degenerate wall, otherwise along the dominant
+    # axis of its normal the voxels between the lowest and highest point of its plane over every column of voxels of
+    # the two other axes
+    low = corners.min(axis=0)
+    high = corners.max(axis=0)
+    ranges = [_cell_range(axis_edges, low[axis], high[axis]) for axis, axis_edges in enumerate(edges)]
+    if any(len(r) == 0 for r in ranges):
+        return np.empty((0, 3), dtype=np.int64)
+    normal = np.cross(corners[0] - corners[1], corners[2] - corners[1])
+    if not normal.any():
+        cells = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+        return cells[_overlaps(corners, *_voxel_boxes(cells, edges))]
+
+    k = int(np.argmax(np.abs(normal)))
+    p, q = [axis for axis in range(3) if axis != k]
+    offset = normal @ corners[1]
+    found = []
+    rows = max(1, COLUMN_CHUNK // len(ranges[q]))
+    for start in range(0, len(ranges[p]), rows):
+        column_p, column_q = np.meshgrid(ranges[p][start:start + rows], ranges[q], indexing='ij')
+        column_p = column_p.ravel()
+        column_q = column_q.ravel()
+        # height of the plane at the 4 corners of every column
+        x = np.stack([edges[p][column_p], edges[p][column_p + 1]], axis=1)
+        y = np.stack([edges[q][column_q], edges[q][column_q + 1]], axis=1)
+        heights = (offset - normal[p] * x[:, [0, 0, 1, 1]] - normal[q] * y[:, [0, 1, 0, 1]]) / normal[k]
+        bottom = np.maximum(heights.min(axis=1), low[k])
+        top = np.minimum(heights.max(axis=1), high[k])
+        first = np.maximum(np.searchsorted(edges[k], bottom, side='right') - 2, ranges[k][0])
+        last = np.minimum(np.searchsorted(edges[k], top, side='right'), ranges[k][-1])
+        count = np.maximum(last - first + 1, 0)
+        cells = np.empty((int(count.sum()), 3), dtype=np.int64)
+        cells[:, p] = np.repeat(column_p, count)
+        cells[:, q] = np.repeat(column_q, count)
+        cells[:, k] = np.repeat(first, count) + np.arange(len(cells)) - np.repeat(np.cumsum(count) - count, count)
+        found.append(cells[_overlaps(corners, *_voxel_boxes(cells, edges))])
+    return np.concatenate(found) if found else np.empty((0, 3), dtype=np.int64)
+
+
+def _voxel_boxes(cells, edges):
+    lower = np.stack([edges[axis][cells[:, axis]] for axis in range(3)], axis=1)
+    upper = np.stack([edges[axis][cells[:, axis] + 1] for axis in range(3)], axis=1)
+    last = np.stack([cells[:, axis] == len(edges[axis]) - 2 for axis in range(3)], axis=1)
+    return lower, upper, last
+
+
+def voxelize_parallelograms(paras, edges):
+    """
+    Function computing the voxels intersected by the parallelograms, without sampling points on them. The candidate
+    voxels of every wall are the voxels around its plane, tested exactly with a separating axis test.
+    :param paras: list of parallelograms as returned by toy_example_generator.generate_parallelograms
+    :param edges: list of three arrays with the edges along x, y and z
+    :return: sorted linear indices of the intersected voxels in the C ordered grid, as the keys of
+    helpers.count_voxels
+    """
+    shape = [len(e) - 1 for e in edges]
+    if min(shape) < 1:
+        return np.empty(0, dtype=np.int64)
+    keys = [np.ravel_multi_index(_wall_cells(corners, edges).T, shape) for corners in parallelogram_corners(paras)]
+    return he.unique_sorted(np.concatenate(keys)) if keys else np.empty(0, dtype=np.int64)
+
+
+def dense_grid_from_parallelograms(paras, edges):
+    """
+    Function computing the dense occupancy grid of the parallelograms.
+    :param paras: list of parallelograms as returned by toy_example_generator.generate_parallelograms
+    :param edges: list of three arrays with the edges along x, y and z
+    :return: 3D matrix with 1 for the voxels intersected by a wall and 0 elsewhere
+    """
+    h = np.zeros([len(e) - 1 for e in edges])
+    h.ravel()[voxelize_parallelograms(paras, edges)] = 1
+    return h
+
+
+def sparse_grid_from_parallelograms(paras, edges):
+    """
+    Function computing the sparse occupancy grid of the parallelograms.
+    :param paras: list of parallelograms as returned by toy_example_generator.generate_parallelograms
+    :param edges: list of three arrays with the edges along x, y and z
+    :return: NDSparseMatrix with 1 for the voxels intersected by a wall
+    """
+    keys = voxelize_parallelograms(paras, edges)
+    sparse_grid = sp.NDSparseMatrix()
+    sparse_grid.add_values(np.stack(np.unravel_index(keys, [len(e) - 1 for e in edges]), axis=1),
+                           np.ones(len(keys)))
+    return sparse_grid
+
+
+def occupancy_oct_tree_from_parallelograms(paras, cube, max_depth):
+    """
+    Function computing the occupancy octree of the parallelograms, the cells at max_depth intersected by a wall being
+    updated once as hits. The rest of the cube stays unknown.
+    :param paras: list of parallelograms as returned by toy_example_generator.generate_parallelograms
+    :param cube: dictionary with the corners of the cube of the tree
+    :param max_depth: depth of the leaves of the tree
+    :return: the OccupancyOctTree
+    """
+    tree = oc.OccupancyOctTree(cube, max_depth)
+    size = 2 ** max_depth
+    edges = [tree.lower[axis] + tree.edge[axis] * np.arange(size + 1) / size for axis in range(3)]
+    cells = np.stack(np.unravel_index(voxelize_parallelograms(paras, edges), [size] * 3), axis=1)
+    codes = np.sort(he.morton_encode(cells.astype(np.uint64)).astype(np.int64))
+    tree.update_cells(codes, np.full(len(codes), tree.hit, dtype=np.float32))
+    return tree
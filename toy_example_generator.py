@@ -1,7 +1,9 @@
 import argparse
 import csv
 import math
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
@@ -9,9 +11,11 @@ import helpers as he
 import json_helpers as jh
 import nd_sparse_matrix as sp
 import oct_tree as oc
+import surface_voxelization as sv
 import visualisation as vis
+import voxel_pyramid as vp
 
-map_types = ['dense_grid', 'sparse_grid', 'oct_map', 'mesh', 'pc', 'all']
+map_types = ['dense_grid', 'sparse_grid', 'oct_map', 'mesh', 'pc', 'all', 'none']
 output_types = ['json', 'plot', 'all']
 
 
@@ -92,6 +96,84 @@ def generate_pseudo_measurement_points(para, num_points, noise_max):
     return points
 
 
+def generate_pseudo_measurement_points_batch(paras, num_points, noise_max, rng=None):
+    """
+    Function generating pseudo measurement points on all parallelograms at once. The points follow the same
+    distribution as the ones of generate_pseudo_measurement_points.
+    :param paras: list of parallelograms as returned by generate_parallelograms
+    :param num_points: number of measurement points on each wall, a single number or one number per wall
+    :param noise_max: max noise perpendicular to the parallelogram surface
+    :param rng: numpy.random.Generator used for the sampling, a fresh unseeded one if None
+    :return: (N,3) array of points and (N,) array with the index of the wall of each point
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    a = np.array([para['a'][:3] for para in paras], dtype=float).reshape(-1, 3)
+    b = np.array([para['b'][:3] for para in paras], dtype=float).reshape(-1, 3)
+    c = np.array([para['c'][:3] for para in paras], dtype=float).reshape(-1, 3)
+    norm = np.cross(a - b, c - b)
+    norm *= noise_max / 2.0 / np.linalg.norm(norm, axis=1, keepdims=True)
+
+    labels = np.repeat(np.arange(len(paras)), np.broadcast_to(num_points, (len(paras),)))
+    p = rng.random((len(labels), 3))
+    points = b[labels]
+    points += (a - b)[labels] * p[:, 0:1]
+    points += (c - b)[labels] * p[:, 1:2]
+    points += norm[labels] * (p[:, 2:3] - 0.5)
+    return points, labels
+
+
+def compute_wall_point_counts(paras, points_per_wall=None, points_per_m2=None):
+    """
+    Function computing the number of measurement points of each wall.
+    :param paras: list of parallelograms as returned by generate_parallelograms
+    :param points_per_wall: fixed number of points on every wall, used if points_per_m2 is None
+    :param points_per_m2: number of points per square meter of the wall surface
+    :return: array with the number of points of each wall
+    """
+    if points_per_m2 is None:
+        return np.full(len(paras), points_per_wall, dtype=int)
+    a = np.array([para['a'][:3] for para in paras], dtype=float).reshape(-1, 3)
+    b = np.array([para['b'][:3] for para in paras], dtype=float).reshape(-1, 3)
+    c = np.array([para['c'][:3] for para in paras], dtype=float).reshape(-1, 3)
+    area = np.linalg.norm(np.cross(a - b, c - b), axis=1)
+    return np.rint(area * points_per_m2).astype(int)
+
+
+def iter_pseudo_measurement_chunks(paras, num_points, noise_max, chunk_size, rng=None):
+    """
+    Generator producing the pseudo measurement points wall by wall in chunks of at most chunk_size points. For the
+    same generator state the concatenated chunks equal the output of generate_pseudo_measurement_points_batch.
+    :param paras: list of parallelograms as returned by generate_parallelograms
+    :param num_points: number of measurement points on each wall, a single number or one number per wall
+    :param noise_max: max noise perpendicular to the parallelogram surface
+    :param chunk_size: maximal number of points in a chunk
+    :param rng: numpy.random.Generator used for the sampling, a fresh unseeded one if None
+    :return: iterator over pairs of (n,3) array of points and (n,) array of wall indices
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    for wall_id, (para, count) in enumerate(zip(paras, np.broadcast_to(num_points, (len(paras),)))):
+        for chunk_start in range(0, int(count), chunk_size):
+            points, labels = generate_pseudo_measurement_points_batch([para], min(chunk_size, count - chunk_start),
+                                                                      noise_max, rng)
+            yield points, labels + wall_id
+
+
+def write_points_csv(chunks, file_name):
+    """
+    Generator writing chunks of labeled points to a CSV file (x, y, z, wall index per row) as they pass through it.
+    :param chunks: iterator over pairs of (n,3) array of points and (n,) array of wall indices
+    :param file_name: path of the CSV file
+    :return: iterator over the same chunks
+    """
+    with open(file_name, 'w') as outfile:
+        for points, labels in chunks:
+            rows = np.column_stack([points, labels])
+            outfile.write(('%.6f,%.6f,%.6f,%d\n' * len(rows)) % tuple(rows.ravel()))
+            yield points, labels
+
+
 def compute_pseudo_dens_grid(points, resolution):
     """
     Function computing dense grid based on the input list of points.
@@ -102,26 +184,291 @@ def compute_pseudo_dens_grid(points, resolution):
     cube = he.compute_max_cube(points)
 
     points_np = np.array(points)
-    h, edges = np.histogramdd(points_np,
-                              [np.arange(cube['x_min'] - 2 * resolution, cube['x_max'] + 2 * resolution, resolution),
-                               np.arange(cube['y_min'] - 2 * resolution, cube['y_max'] + 2 * resolution, resolution),
-                               np.arange(cube['z_min'] - 2 * resolution, cube['z_max'] + 2 * resolution, resolution)])
+    h, edges = np.histogramdd(points_np, he.grid_edges(cube, resolution))
+    return h, edges
+
+
+def compute_pseudo_dens_grid_chunked(chunks, cube, resolution):
+    """
+    Function computing the dense grid of compute_pseudo_dens_grid from a stream of point chunks.
+    :param chunks: iterator over pairs of (n,3) array of points and their labels
+    :param cube: bounding cube of all the points, as returned by compute_max_cube_from_chunks
+    :param resolution: size of the voxel (it is assumed it is a cube)
+    :return: 3D matrix with number of points per voxel and the edges of the voxels
+    """
+    edges = he.grid_edges(cube, resolution)
+    h = np.zeros([len(e) - 1 for e in edges])
+    # the counts of the occupied voxels are added in place, the keys being the linear indices of the C ordered grid
+    voxels = h.ravel()
+    for points, _ in chunks:
+        keys, counts = he.count_voxels(points, edges)
+        voxels[keys] += counts
     return h, edges
 
 
+def sparse_grid_from_voxel_counts(keys, counts, edges):
+    """
+    Function building the sparse grid from the counts of the occupied voxels.
+    :param keys: linear indices of the occupied voxels, as returned by helpers.count_voxels
+    :param counts: number of points in each of the voxels
+    :param edges: list of three arrays with the edges along x, y and z
+    :return: returs object of type NDSparseMatrix
+    """
+    sparse_grid = sp.NDSparseMatrix()
+    sparse_grid.add_values(np.stack(np.unravel_index(keys, [len(e) - 1 for e in edges]), axis=1),
+                           counts.astype(float))
+    return sparse_grid
+
+
 def compute_pseudo_sparse_grid(points, resolution):
     """
-    Function computing the sparse grid representation based on the input points.
+    Function computing the sparse grid representation based on the input points. The points are quantized directly to
+    voxel keys, the dense grid is never built.
     :param points: list of measurments points
     :param resolution: size of the voxel (it is assumed it is a cube)
     :return: returs object of type NDSparseMatrix
     """
-    h, edges = compute_pseudo_dens_grid(points, resolution)
+    cube = he.compute_max_cube(points)
+    edges = he.grid_edges(cube, resolution)
+    keys, counts = he.count_voxels(points, edges)
+    return sparse_grid_from_voxel_counts(keys, counts, edges)
+
+
+def compute_pseudo_sparse_grid_chunked(chunks, cube, resolution):
+    """
+    Function computing the sparse grid of compute_pseudo_sparse_grid from a stream of point chunks, without building
+    the dense grid.
+    :param chunks: iterator over pairs of (n,3) array of points and their labels
+    :param cube: bounding cube of all the points, as returned by compute_max_cube_from_chunks
+    :param resolution: size of the voxel (it is assumed it is a cube)
+    :return: returs object of type NDSparseMatrix
+    """
+    edges = he.grid_edges(cube, resolution)
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    for points, _ in chunks:
+        keys, counts = he.merge_voxel_counts(keys, counts, *he.count_voxels(points, edges))
+    return sparse_grid_from_voxel_counts(keys, counts, edges)
+
+
+def update_pseudo_sparse_grid(sparse_grid, edges, points, remove=False):
+    """
+    Function adding a batch of points to a sparse grid of compute_pseudo_sparse_grid, or removing it. Only the voxels of
+    the points are updated. When points are added outside of the grid it is extended with helpers.extend_grid_edges and
+    the stored voxels are shifted if it grows below them; removed points outside of the grid are ignored and voxels
+    without points are dropped.
+    :param sparse_grid: NDSparseMatrix of the point counts
+    :param edges: list of three arrays with the edges along x, y and z of the grid
+    :param points: (N,3) array of points
+    :param remove: if True the points are removed from the counts instead of added
+    :return: the updated NDSparseMatrix and the edges of the grid
+    """
+    if not remove:
+        edges, shift = he.extend_grid_edges(edges, points)
+        if shift.any():
+            sparse_grid.shift(shift)
+    keys, counts = he.count_voxels(points, edges)
+    coords = np.stack(np.unravel_index(keys, [len(e) - 1 for e in edges]), axis=1)
+    if remove:
+        counts = -counts
+    sparse_grid.add_values(coords, counts.astype(float), accumulate=True)
+    if remove:
+        sparse_grid.remove_values(coords[sparse_grid.read_values(coords) <= 0])
+    return sparse_grid, edges
+
+
+def sparse_grid_from_dense_grid(h):
+    """
+    Function building the sparse grid from the dense grid of the same points, so the histogram is computed once when
+    both grids are needed.
+    :param h: 3D matrix with number of points per voxel, as returned by compute_pseudo_dens_grid_chunked
+    :return: returs object of type NDSparseMatrix
+    """
+    keys = np.flatnonzero(h)
     sparse_grid = sp.NDSparseMatrix()
-    sparse_grid.from_dense(h)
+    sparse_grid.add_values(np.stack(np.unravel_index(keys, h.shape), axis=1), h.ravel()[keys].astype(float))
     return sparse_grid
 
 
+def occupancy_depth(cube, resolution, max_depth):
+    """
+    Function computing the depth of an occupancy octree of the cube whose leaves are the smallest cells not smaller than
+    the grid voxels.
+    :param cube: dictionary with the corners of the cube
+    :param resolution: size of the grid voxels
+    :param max_depth: maximal depth of the octree, capped to oct_tree.OCCUPANCY_MAX_DEPTH
+    :return: depth of the leaves
+    """
+    edge = cube['x_max'] - cube['x_min']
+    return min(max_depth, oc.OCCUPANCY_MAX_DEPTH, max(0, int(np.ceil(np.log2(edge / resolution)))) if edge > 0 else 0)
+
+
+def build_occupancy_oct_tree(chunks, cube, resolution, max_depth, origin=None):
+    """
+    Function building the occupancy octree of the scene, casting rays from the sensor origin to the points chunk by
+    chunk. The leaves are the smallest cells not smaller than the grid voxels.
+    :param chunks: iterator over pairs of (n,3) array of points and their labels
+    :param cube: bounding cube of all the points, as returned by compute_max_cube_from_chunks
+    :param resolution: size of the grid voxels
+    :param max_depth: maximal depth of the octree
+    :param origin: origin of the rays, the center of the cube if None
+    :return: the OccupancyOctTree
+    """
+    tree = oc.OccupancyOctTree(cube, occupancy_depth(cube, resolution, max_depth))
+    if origin is None:
+        origin = [(cube['x_min'] + cube['x_max']) / 2, (cube['y_min'] + cube['y_max']) / 2,
+                  (cube['z_min'] + cube['z_max']) / 2]
+    for points, _ in chunks:
+        tree.insert_scan(origin, points)
+    return tree
+
+
+def save_dense_grid(h, resolution, pyramid_levels=1, reduction='sum'):
+    """
+    Function saving the dense grid and the coarser levels of its pyramid.
+    :param h: 3D matrix with number of points per voxel
+    :param resolution: size of the voxel (it is assumed it is a cube)
+    :param pyramid_levels: number of levels saved, level 0 being the grid itself
+    :param reduction: name of the reduction of voxel_pyramid.reductions
+    """
+    jh.save_dense_grid_as_jason(h.shape, h.ravel(order='F'), [resolution] * 3)
+    if pyramid_levels > 1:
+        jh.save_dense_pyramid_as_jason(vp.dense_pyramid(h, pyramid_levels, reduction), [resolution] * 3,
+                                       first_level=1)
+
+
+def save_sparse_grid(sparse, shape, resolution, pyramid_levels=1, reduction='sum'):
+    """
+    Function saving the sparse grid and the coarser levels of its pyramid.
+    :param sparse: NDSparseMatrix of the point counts
+    :param shape: number of voxels of the grid along each dimension
+    :param resolution: size of the voxel (it is assumed it is a cube)
+    :param pyramid_levels: number of levels saved, level 0 being the grid itself
+    :param reduction: name of the reduction of voxel_pyramid.reductions
+    """
+    jh.save_sparse_grid_as_jason(shape, sparse, [resolution] * 3)
+    if pyramid_levels > 1:
+        jh.save_sparse_pyramid_as_jason(vp.sparse_pyramid(sparse, pyramid_levels, reduction), shape,
+                                        [resolution] * 3, first_level=1)
+
+
+def save_oct_map(tree):
+    """
+    Function saving the octree, the size of the map being the size of its root.
+    :param tree: the built OctTree or an OccupancyOctTree
+    """
+    jh.save_oct_map_as_jason(tree, [tree.corners['x_max'] - tree.corners['x_min'],
+                                    tree.corners['y_max'] - tree.corners['y_min'],
+                                    tree.corners['z_max'] - tree.corners['z_min']])
+
+
+def shared_chunks(points, labels, chunk_size):
+    """
+    Generator producing the points held in memory in chunks of at most chunk_size points.
+    :param points: (N,3) array of points
+    :param labels: (N,) array of wall indices
+    :param chunk_size: maximal number of points in a chunk
+    :return: iterator over pairs of (n,3) array of points and (n,) array of wall indices
+    """
+    for start in range(0, len(points), chunk_size):
+        yield points[start:start + chunk_size], labels[start:start + chunk_size]
+
+
+def _histogram_task(points_description, labels_description, grid_description, cube, resolution, chunk_size):
+    points_shm, points = he.attach_shared_array(points_description)
+    labels_shm, labels = he.attach_shared_array(labels_description)
+    grid_shm, grid = he.attach_shared_array(grid_description)
+    grid[...] = compute_pseudo_dens_grid_chunked(shared_chunks(points, labels, chunk_size), cube, resolution)[0]
+    del points, labels, grid
+    for shm in (points_shm, labels_shm, grid_shm):
+        shm.close()
+
+
+def _grid_task(grid_description, map_type, resolution, pyramid_levels, reduction):
+    grid_shm, grid = he.attach_shared_array(grid_description)
+    if map_type == 'dense_grid':
+        save_dense_grid(grid, resolution, pyramid_levels, reduction)
+    else:
+        save_sparse_grid(sparse_grid_from_dense_grid(grid), grid.shape, resolution, pyramid_levels, reduction)
+    del grid
+    grid_shm.close()
+
+
+def _point_cloud_task(points_description, labels_description, chunk_size):
+    points_shm, points = he.attach_shared_array(points_description)
+    labels_shm, labels = he.attach_shared_array(labels_description)
+    jh.save_point_cloud_chunks_as_jason(shared_chunks(points, labels, chunk_size))
+    del points, labels
+    points_shm.close()
+    labels_shm.close()
+
+
+def _oct_map_task(points_description, labels_description, cube, args):
+    points_shm, points = he.attach_shared_array(points_description)
+    labels_shm, labels = he.attach_shared_array(labels_description)
+    if args.octree_occupancy:
+        tree = build_occupancy_oct_tree(shared_chunks(points, labels, args.chunk_size), cube, args.resolution,
+                                        args.octree_max_depth, args.sensor_origin)
+    else:
+        tree = oc.OctTree(points, args.octree_threshold, args.octree_max_depth)
+        tree.build_tree()
+    save_oct_map(tree)
+    del tree, points, labels
+    points_shm.close()
+    labels_shm.close()
+
+
+def _mesh_task(paras):
+    jh.save_mesh_as_json([{'par': w, 'points': []} for w in paras])
+
+
+def save_all_maps_parallel(chunks, point_count, paras, cube, args, workers):
+    """
+    Function saving every map type at once on a pool of processes. The points are generated once into shared memory,
+    the octree, point cloud and mesh writers run next to the histogram, which is shared by the dense and sparse grid
+    writers started once it is done.
+    :param chunks: iterator over pairs of (n,3) array of points and (n,) array of wall indices of the scene
+    :param point_count: total number of points of the chunks
+    :param paras: list of parallelograms as returned by generate_parallelograms
+    :param cube: bounding cube of all the points, as returned by compute_max_cube_from_chunks
+    :param args: parsed arguments of the program
+    :param workers: number of processes of the pool
+    """
+    shape = [len(e) - 1 for e in he.grid_edges(cube, args.resolution)]
+    blocks = []
+    try:
+        points_shm, points, points_description = he.create_shared_array((point_count, 3), float)
+        blocks.append(points_shm)
+        labels_shm, labels, labels_description = he.create_shared_array((point_count,), int)
+        blocks.append(labels_shm)
+        grid_shm, grid, grid_description = he.create_shared_array(shape, float)
+        blocks.append(grid_shm)
+        start = 0
+        for chunk_points, chunk_labels in chunks:
+            points[start:start + len(chunk_points)] = chunk_points
+            labels[start:start + len(chunk_points)] = chunk_labels
+            start += len(chunk_points)
+        del points, labels, grid
+
+        # the workers encode the JSON files as configured in this process
+        with ProcessPoolExecutor(workers, initializer=jh.set_encoder,
+                                 initargs=(jh.encoder['backend'], jh.encoder['precision'])) as pool:
+            histogram = pool.submit(_histogram_task, points_description, labels_description, grid_description, cube,
+                                    args.resolution, args.chunk_size)
+            futures = [pool.submit(_oct_map_task, points_description, labels_description, cube, args),
+                       pool.submit(_point_cloud_task, points_description, labels_description, args.chunk_size),
+                       pool.submit(_mesh_task, paras)]
+            histogram.result()
+            futures += [pool.submit(_grid_task, grid_description, map_type, args.resolution, args.pyramid_levels,
+                                    args.pyramid_reduction) for map_type in ('dense_grid', 'sparse_grid')]
+            for future in futures:
+                future.result()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Toy example generator for 3D-MDR standard.')
     parser.add_argument('parallelograms_file', type=str,
@@ -129,57 +476,154 @@ def main():
                              'vertices of each of the walls in the environment in a clockwise order')
     parser.add_argument('map_type', type=check_map_type, help='declare map type to save')
     parser.add_argument('output_type', type=check_output_type, help='declare map type to save')
+    density = parser.add_mutually_exclusive_group()
+    density.add_argument('--points-per-wall', type=int, default=1000, help='number of measurement points per wall')
+    density.add_argument('--points-per-m2', type=float, default=None,
+                         help='number of measurement points per square meter of wall surface')
+    parser.add_argument('--noise', type=float, default=0.05,
+                        help='max noise perpendicular to the wall surface in meters')
+    parser.add_argument('--resolution', type=float, default=1, help='size of the grid voxels in meters')
+    parser.add_argument('--pyramid-levels', type=int, default=1,
+                        help='number of levels of the grids, each level having voxels twice as large as the previous')
+    parser.add_argument('--pyramid-reduction', choices=list(vp.reductions), default='sum',
+                        help='reduction of the 2x2x2 voxels of a level into a voxel of the next level')
+    parser.add_argument('--octree-threshold', type=int, default=20,
+                        help='number of points above which an octree node is split')
+    parser.add_argument('--octree-max-depth', type=int, default=oc.MAX_DEPTH,
+                        help='maximal depth of the octree, at most %d' % oc.MAX_DEPTH)
+    parser.add_argument('--octree-occupancy', action='store_true',
+                        help='build a probabilistic occupancy octree by casting rays from the sensor origin to the '
+                             'points, with leaves of the grid resolution')
+    parser.add_argument('--voxelize-walls', action='store_true',
+                        help='compute the grids and an occupancy octree from the voxels intersected by the walls '
+                             'instead of the points')
+    parser.add_argument('--sensor-origin', type=float, nargs=3, default=None, metavar=('X', 'Y', 'Z'),
+                        help='origin of the rays of the occupancy octree, the center of the scene by default')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random generator')
+    parser.add_argument('--chunk-size', type=int, default=1000000,
+                        help='maximal number of points generated at once')
+    parser.add_argument('--points-file', type=str, default=None,
+                        help='CSV file the generated points are written to, chunk by chunk')
+    parser.add_argument('--no-plot', action='store_true', help='headless mode, never open a plot window')
+    parser.add_argument('--plot-voxel-budget', type=int, default=vis.DENSE_VOXEL_BUDGET,
+                        help='maximal number of voxels of the dense grid plot, larger grids are plotted coarser')
+    parser.add_argument('--json-backend', choices=jh.json_backends, default='json',
+                        help='library encoding the JSON files, orjson is faster if installed')
+    parser.add_argument('--float-precision', type=int, default=None,
+                        help='number of significant digits of the saved coordinates and values, exact by default')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of processes saving the maps of the all map type in headless mode, one for a '
+                             'sequential run')
 
     args = parser.parse_args()
+    try:
+        jh.set_encoder(args.json_backend, args.float_precision)
+    except ValueError as error:
+        parser.error(str(error))
+    if not 0 <= args.octree_max_depth <= oc.MAX_DEPTH:
+        parser.error("--octree-max-depth must lie in [0, %d]" % oc.MAX_DEPTH)
+    if args.pyramid_levels < 1:
+        parser.error("--pyramid-levels must be positive")
+    if args.workers < 1:
+        parser.error("--workers must be positive")
+    if args.plot_voxel_budget < 1:
+        parser.error("--plot-voxel-budget must be positive")
+    plot = not args.no_plot and (args.output_type == 'plot' or args.output_type == 'all')
+    save = args.output_type == 'json' or args.output_type == 'all'
+    resolution = args.resolution
 
     paras = generate_parallelograms(args.parallelograms_file)
-    pseudo_walls = []
-    point_cloud = []
+    num_points = compute_wall_point_counts(paras, args.points_per_wall, args.points_per_m2)
+    # every pass over the scene regenerates the same chunks from the same seed, nothing scene sized is kept
+    seed = np.random.SeedSequence(args.seed)
+
+    def scene_chunks():
+        return iter_pseudo_measurement_chunks(paras, num_points, args.noise, args.chunk_size,
+                                              np.random.default_rng(seed))
+
+    chunks = scene_chunks()
+    if args.points_file is not None:
+        chunks = write_points_csv(chunks, args.points_file)
+    cube = he.compute_max_cube_from_chunks(chunks)
 
-    for w in paras:
-        points = generate_pseudo_measurement_points(w, 1000, 0.05)
-        pseudo_walls.append({'par': w, 'points': points})
-        point_cloud.extend(points)
+    if args.map_type == 'none':
+        return
 
-    vis.show_pseudo_measurements(pseudo_walls)
+    if args.map_type == 'all' and args.no_plot and save and args.workers > 1 and not args.voxelize_walls:
+        save_all_maps_parallel(scene_chunks(), int(num_points.sum()), paras, cube, args, args.workers)
+        return
+
+    # only the point octree and the point plots need the whole scene in memory
+    occupancy_tree = args.octree_occupancy or args.voxelize_walls
+    point_tree = not occupancy_tree and (args.map_type == 'oct_map' or args.map_type == 'all')
+    if not args.no_plot or point_tree:
+        point_chunks = []
+        label_chunks = []
+        for points, labels in scene_chunks():
+            point_chunks.append(points)
+            label_chunks.append(labels)
+        point_cloud = np.concatenate(point_chunks) if point_chunks else np.empty((0, 3))
+        labels = np.concatenate(label_chunks) if label_chunks else np.empty(0, dtype=int)
+        del point_chunks, label_chunks
+        pseudo_walls = [{'par': w, 'points': point_cloud[labels == wall_id]} for wall_id, w in enumerate(paras)]
+    else:
+        pseudo_walls = [{'par': w, 'points': []} for w in paras]
+
+    if not args.no_plot:
+        vis.show_pseudo_measurements(pseudo_walls)
 
     if args.map_type == 'dense_grid' or args.map_type == 'all':
-        h, edges = compute_pseudo_dens_grid(point_cloud, 1)
-        if args.output_type == 'plot' or args.output_type == 'all':
-            vis.show_pseudo_dense_grid(h)
-        if args.output_type == 'json' or args.output_type == 'all':
-            jh.save_dense_grid_as_jason(h.shape, h.flatten(), [1, 1, 1])
+        if args.voxelize_walls:
+            h = sv.dense_grid_from_parallelograms(paras, he.grid_edges(cube, resolution))
+        else:
+            h, edges = compute_pseudo_dens_grid_chunked(scene_chunks(), cube, resolution)
+        if plot:
+            vis.show_pseudo_dense_grid(h, args.plot_voxel_budget)
+        if save:
+            save_dense_grid(h, resolution, args.pyramid_levels, args.pyramid_reduction)
 
     if args.map_type == 'sparse_grid' or args.map_type == 'all':
-        sparse = compute_pseudo_sparse_grid(point_cloud, 1)
-        if args.output_type == 'plot' or args.output_type == 'all':
+        if args.map_type == 'all':
+            sparse = sparse_grid_from_dense_grid(h)
+        elif args.voxelize_walls:
+            sparse = sv.sparse_grid_from_parallelograms(paras, he.grid_edges(cube, resolution))
+        else:
+            sparse = compute_pseudo_sparse_grid_chunked(scene_chunks(), cube, resolution)
+        if plot:
             vis.show_pseudo_sparse_grid(sparse)
-        if args.output_type == 'json' or args.output_type == 'all':
-            jh.save_sparse_grid_as_jason(
-                [max([k[0] for k in sparse.elements.keys()]), max([k[1] for k in sparse.elements.keys()]),
-                 max([k[2] for k in sparse.elements.keys()])], [k + (v,) for k, v in sparse.elements.items()],
-                [1, 1, 1])
+        if save:
+            save_sparse_grid(sparse, [len(e) - 1 for e in he.grid_edges(cube, resolution)], resolution,
+                             args.pyramid_levels, args.pyramid_reduction)
 
     if args.map_type == 'pc' or args.map_type == 'all':
-        if args.output_type == 'plot' or args.output_type == 'all':
+        if plot:
             vis.show_pseudo_pointcloud(point_cloud)
-        if args.output_type == 'json' or args.output_type == 'all':
-            jh.save_point_cloud_as_jason(point_cloud)
+        if save:
+            jh.save_point_cloud_chunks_as_jason(scene_chunks())
 
     if args.map_type == 'oct_map' or args.map_type == 'all':
-        tree = oc.OctTree(point_cloud, 20)
-        tree.build_tree()
-        if args.output_type == 'plot' or args.output_type == 'all':
-            vis.show_oct_tree(tree.tree)
-        if args.output_type == 'json' or args.output_type == 'all':
-            jh.save_oct_map_as_jason(tree.tree, [tree.corners['x_max'] - tree.corners['x_min'],
-                                                 tree.corners['y_max'] - tree.corners['y_min'],
-                                                 tree.corners['z_max'] - tree.corners['z_min']])
+        if args.voxelize_walls:
+            tree = sv.occupancy_oct_tree_from_parallelograms(paras, cube,
+                                                             occupancy_depth(cube, resolution, args.octree_max_depth))
+            if plot:
+                vis.show_occupancy_oct_tree(tree)
+        elif args.octree_occupancy:
+            tree = build_occupancy_oct_tree(scene_chunks(), cube, resolution, args.octree_max_depth,
+                                            args.sensor_origin)
+            if plot:
+                vis.show_occupancy_oct_tree(tree)
+        else:
+            tree = oc.OctTree(point_cloud, args.octree_threshold, args.octree_max_depth)
+            tree.build_tree()
+            if plot:
+                vis.show_oct_tree(tree)
+        if save:
+            save_oct_map(tree)
 
     if args.map_type == "mesh" or args.map_type == 'all':
-        if args.output_type == 'plot' or args.output_type == 'all':
-            vis.show_pseudo_mesh(pseudo_walls)
-        if args.output_type == 'json' or args.output_type == 'all':
+        if plot:
+            vis.show_pseudo_mesh(*he.index_mesh(he.mesh_polygons(pseudo_walls)))
+        if save:
             jh.save_mesh_as_json(pseudo_walls)
 
 
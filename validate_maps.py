@@ -0,0 +1,311 @@
+import argparse
+import concurrent.futures
+import copy
+import functools
+import itertools
+import json
+import os
+import sys
+import time
+
+import fastjsonschema
+
+import json_stream as js
+import map_loaders as ml
+
+schema_folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Json_schema', 'local_maps_JSON')
+schema_files = {'densegrid': 'densegrid.json', 'sparsegrid': 'sparsegrid.json', 'pointcloud': 'pointcloud.json',
+                'octree': 'octree.json', 'polygonmesh': 'polygonmesh.json'}
+
+_end = object()
+
+
+@functools.lru_cache(maxsize=None)
+def load_schema(map_type):
+    with open(os.path.join(schema_folder_path, schema_files[map_type]), 'r') as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def get_validator(map_type):
+    """
+    Function compiling the validator of a map type, once per process.
+    :param map_type: one of map_loaders.map_types
+    :return: compiled fastjsonschema validator
+    """
+    return fastjsonschema.compile(load_schema(map_type))
+
+
+def _node_shell(definition, ref):
+    # copy of a recursive definition accepting anything in place of the nested nodes, with the keys holding them
+    shell = copy.deepcopy(definition)
+    child_keys = set()
+    for key, prop in shell.get('properties', {}).items():
+        for branch in [prop] + prop.get('anyOf', []) + prop.get('oneOf', []):
+            if branch.get('items') == {'$ref': ref}:
+                branch['items'] = {}
+                child_keys.add(key)
+    return shell, child_keys
+
+
+@functools.lru_cache(maxsize=None)
+def get_stream_validators(map_type):
+    """
+    Function compiling the validators of the streaming validation of a map type, once per process. The large fields
+    streamed by stream_validate, the keys of map_loaders.item_converters, are validated one item or node at a time with
+    the subschema of the item or of the node, the other fields with the schema in which the streamed properties accept
+    anything.
+    :param map_type: one of map_loaders.map_types
+    :return: validator of the fields and dictionary of the streamed properties, mapping each of them to a tuple of its
+    kind ('items' or 'tree'), the keys holding the nested nodes of a tree and the validator of an item or of a node
+    without its nested nodes
+    """
+    schema = load_schema(map_type)
+    # the subschemas keep the id of the schema, their references are resolved against it instead of being fetched
+    base = {'$schema': schema.get('$schema'), '$id': schema.get('$id', ''),
+            'definitions': schema.get('definitions', {})}
+    fields_schema = copy.deepcopy(schema)
+    streamed = {}
+    for key, prop in schema.get('properties', {}).items():
+        if key not in ml.item_converters:
+            continue
+        if prop.get('type') == 'array' and isinstance(prop.get('items'), dict) and \
+                set(prop) <= {'type', 'items', 'description'}:
+            streamed[key] = ('items', None, fastjsonschema.compile(dict(base, **prop['items'])))
+        elif '$ref' in prop and prop['$ref'].startswith('#/definitions/'):
+            shell, child_keys = _node_shell(base['definitions'][prop['$ref'][len('#/definitions/'):]], prop['$ref'])
+            if not child_keys:
+                continue
+            streamed[key] = ('tree', child_keys, fastjsonschema.compile(dict(base, **shell)))
+        else:
+            continue
+        fields_schema['properties'][key] = {}
+    return fastjsonschema.compile(fields_schema), streamed
+
+
+def _invalid(location, error):
+    return fastjsonschema.JsonSchemaValueException("%s: %s" % (location, error))
+
+
+def _validate_items(key, items, validators, errors):
+    # validates the items against the item validators of all the candidate map types, a candidate is dropped at its
+    # first error, which is recorded in errors
+    live = dict(validators)
+    for index, item in enumerate(items):
+        for map_type, validate in list(live.items()):
+            try:
+                validate(item)
+            except fastjsonschema.JsonSchemaException as e:
+                errors[map_type] = _invalid("%s[%d]" % (key, index), e)
+                del live[map_type]
+        if validators and not live:
+            # invalid whatever the type of the map
+            raise errors[next(iter(validators))]
+
+
+def _validate_tree(reader, key, child_keys, validate):
+    # depth first walk with an explicit stack of the open nodes: the node read so far, its location, the iterator over
+    # its members and, while its nested nodes are read, the key holding them and the iterator over them
+    stack = [[{}, key, reader.iter_object(), None, None]]
+    while stack:
+        node, location, members, child_key, children = stack[-1]
+        if children is not None:
+            index = next(children, _end)
+            if index is _end:
+                stack[-1][3:] = [None, None]
+            else:
+                node[child_key].append(None)
+                stack.append([{}, "%s.%s[%d]" % (location, child_key, index), reader.iter_object(), None, None])
+            continue
+        member = next(members, _end)
+        if member is _end:
+            try:
+                validate(node)
+            except fastjsonschema.JsonSchemaException as e:
+                raise _invalid(location, e)
+            stack.pop()
+        elif member in child_keys and reader.peek() == '[':
+            node[member] = []
+            stack[-1][3:] = [member, reader.iter_array()]
+        else:
+            node[member] = reader.read_value()
+
+
+def stream_validate(path, map_type=None):
+    """
+    Function validating a local map file while parsing it, holding at most one item of its large arrays or one branch
+    of its tree in memory. The outcome is the same as the one of the validation of the loaded file.
+    :param path: path of the JSON file
+    :param map_type: one of map_loaders.map_types, detected from the file if None
+    :return: the map type
+    :raises fastjsonschema.JsonSchemaException: if the map is invalid
+    :raises ValueError: if the file is not valid JSON or if its type cannot be detected
+    """
+    fields = {}
+    first_items = {}
+    # first error of every candidate map type, the type is only known once the whole file is read
+    errors = {}
+    with open(path, 'r') as f:
+        reader = js.JsonStreamReader(f)
+        for key in reader.iter_object():
+            if key not in ml.item_converters:
+                fields[key] = reader.read_value()
+                continue
+            is_array = reader.peek() == '['
+            items = reader.iter_values() if is_array else iter(())
+            first_items[key] = list(itertools.islice(items, 1))
+            if map_type is not None:
+                candidates = [map_type]
+            elif key == 'list_of_voxels':
+                candidates = [ml.detect_map_type(dict(fields, list_of_voxels=first_items[key]))]
+            else:
+                candidates = [t for t in ml.map_types if key in load_schema(t).get('properties', {})]
+            streamed = {t: get_stream_validators(t)[1][key] for t in candidates if key in get_stream_validators(t)[1]}
+            if not streamed:
+                fields[key] = first_items[key] + list(items) if is_array else reader.read_value()
+                continue
+            fields[key] = None
+            trees = {t: validator for t, validator in streamed.items() if validator[0] == 'tree'}
+            for t in trees if is_array or reader.peek() != '{' else []:
+                errors[t] = _invalid(key, "data must be object")
+            for t, validator in streamed.items():
+                if validator[0] == 'items' and not is_array:
+                    errors[t] = _invalid(key, "data must be array")
+            if is_array:
+                _validate_items(key, itertools.chain(first_items[key], items),
+                                {t: validator[2] for t, validator in streamed.items() if validator[0] == 'items'},
+                                errors)
+            elif trees and reader.peek() == '{':
+                # only the octree has a tree
+                (_, child_keys, validate), = trees.values()
+                _validate_tree(reader, key, child_keys, validate)
+            else:
+                reader.skip_value()
+    map_type = map_type or ml.detect_map_type(dict(fields, **first_items))
+    if map_type in errors:
+        raise errors[map_type]
+    get_stream_validators(map_type)[0](fields)
+    return map_type
+
+
+def validate_file(path, map_type=None, streaming=False):
+    """
+    Function validating a local map file against the schema of its type.
+    :param path: path of the JSON file
+    :param map_type: one of map_loaders.map_types, detected from the file if None
+    :param streaming: if True the file is validated while it is parsed (see stream_validate), the load time is then
+    included in the validation time
+    :return: dictionary with the file, its map type, the outcome, the error message and the load and validation times
+    in seconds
+    """
+    result = {'file': path, 'map_type': map_type, 'valid': False, 'error': None, 'load_time': 0.0,
+              'validation_time': 0.0}
+    if streaming:
+        start = time.perf_counter()
+        try:
+            result['map_type'] = stream_validate(path, map_type)
+            result['valid'] = True
+        except (OSError, ValueError, TypeError, KeyError, fastjsonschema.JsonSchemaException) as e:
+            result['error'] = str(e)
+        result['validation_time'] = time.perf_counter() - start
+        return result
+
+    start = time.perf_counter()
+    try:
+        with open(path, 'r') as f:
+            local_map = json.load(f)
+        if result['map_type'] is None:
+            result['map_type'] = ml.detect_map_type(local_map)
+    except (OSError, ValueError, TypeError, KeyError, RecursionError) as e:
+        result['error'] = str(e)
+        return result
+    finally:
+        result['load_time'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        get_validator(result['map_type'])(local_map)
+        result['valid'] = True
+    except (fastjsonschema.JsonSchemaException, RecursionError) as e:
+        result['error'] = str(e)
+    result['validation_time'] = time.perf_counter() - start
+    return result
+
+
+def collect_files(paths):
+    """
+    Function listing the JSON files to validate.
+    :param paths: list of files and directories, the directories are searched recursively for .json files
+    :return: sorted list of file paths
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                files.extend(os.path.join(folder, name) for name in names if name.endswith('.json'))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def validate_files(files, map_type=None, workers=None, streaming=False):
+    """
+    Function validating many files across a pool of processes.
+    :param files: list of file paths
+    :param map_type: one of map_loaders.map_types for all the files, detected from every file if None
+    :param workers: number of processes, all the cores if None, 1 validates in the current process
+    :param streaming: if True the files are validated while they are parsed, see stream_validate
+    :return: summary dictionary with the counts, the total time and the list of results of validate_file
+    """
+    start = time.perf_counter()
+    validate = functools.partial(validate_file, map_type=map_type, streaming=streaming)
+    if workers == 1 or len(files) < 2:
+        results = [validate(f) for f in files]
+    else:
+        workers = workers or os.cpu_count()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(validate, files, chunksize=max(1, len(files) // (4 * workers))))
+    valid = sum(result['valid'] for result in results)
+    return {'files': len(results), 'valid': valid, 'invalid': len(results) - valid,
+            'total_time': time.perf_counter() - start, 'results': results}
+
+
+def print_summary(summary):
+    """
+    Function printing a readable report of the summary of validate_files.
+    :param summary: summary dictionary
+    """
+    for result in summary['results']:
+        print(result['file'] + ":   " + ("OK" if result['valid'] else "FAILED: " + result['error']))
+    print("%d files, %d valid, %d invalid in %.3f s" % (summary['files'], summary['valid'], summary['invalid'],
+                                                        summary['total_time']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validator of local maps against the 3D-MDR JSON schemas.')
+    parser.add_argument('paths', nargs='+', type=str, help='files or directories of local maps to validate')
+    parser.add_argument('--map-type', choices=ml.map_types, default=None,
+                        help='type of all the maps, detected from every file by default')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all the cores by default')
+    parser.add_argument('--streaming', action='store_true',
+                        help='validate the files while parsing them, for maps larger than the memory')
+    parser.add_argument('--summary', type=str, default=None,
+                        help='file receiving the JSON summary, "-" for the standard output')
+    args = parser.parse_args()
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be positive")
+
+    summary = validate_files(collect_files(args.paths), args.map_type, args.workers, args.streaming)
+    if args.summary == '-':
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.summary != '-':
+        print_summary(summary)
+    sys.exit(0 if summary['invalid'] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
 import matplotlib.colors as cs
 import matplotlib.pyplot as plt
 import numpy as np
-from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+from mpl_toolkits.mplot3d.art3d import Line3DCollection, Poly3DCollection
 
-import helpers as he
+import oct_tree as oc
+import voxel_pyramid as vp
+
+# faces of a box as quads of its corners, corner i being at the upper bound along the axes of the set bits of i (x
+# first): the faces of lower and upper x, then of y, then of z
+BOX_FACES = np.array([[0, 2, 6, 4], [1, 3, 7, 5], [0, 1, 5, 4], [2, 3, 7, 6], [0, 1, 3, 2], [4, 5, 7, 6]])
+# maximal number of voxels drawn by show_pseudo_dense_grid, larger grids are drawn at a coarser level
+DENSE_VOXEL_BUDGET = 20000
+# color of the voxels of show_pseudo_dense_grid, their opacity being their value relative to the largest one
+DENSE_VOXEL_COLOR = (0.12, 0.46, 0.7)
 
 
 def expand_coordinates(indices):
@@ -28,7 +37,7 @@ def explode(data):
 
 def make_ax(grid=False):
     fig = plt.figure()
-    ax = fig.gca(projection='3d')
+    ax = fig.add_subplot(111, projection='3d')
     ax.set_xlabel("x")
     ax.set_ylabel("y")
     ax.set_zlabel("z")
@@ -56,18 +65,102 @@ def rect_prism(x_range, y_range, z_range, ax, color="r"):
     ax.plot_surface(xx, y_range[1], zz, color=color, alpha=0.2)
 
 
+def _first_of_groups(keys):
+    # mask of the first row of every group of identical rows and mask of the rows having an identical row
+    order = np.lexsort(keys.T[::-1])
+    same = np.all(keys[order][1:] == keys[order][:-1], axis=1)
+    first = np.empty(len(keys), dtype=bool)
+    first[order] = np.concatenate([[True], ~same])
+    shared = np.empty(len(keys), dtype=bool)
+    shared[order] = np.concatenate([[False], same]) | np.concatenate([same, [False]])
+    return first, shared
+
+
+def box_faces(lower, upper, cull=True):
+    """
+    Function computing the faces of axis aligned boxes.
+    :param lower: (N,3) array of the lower corners of the boxes
+    :param upper: (N,3) array of the upper corners of the boxes
+    :param cull: if True the faces shared by two boxes, which are inside the union of the boxes, are removed
+    :return: (F,4,3) array of the corners of the faces
+    """
+    lower = np.asarray(lower, dtype=float).reshape(-1, 3)
+    upper = np.asarray(upper, dtype=float).reshape(-1, 3)
+    bits = ((np.arange(8)[:, None] >> np.arange(3)) & 1).astype(bool)
+    corners = np.where(bits, upper[:, None], lower[:, None])
+    faces = corners[:, BOX_FACES].reshape(-1, 4, 3)
+    if cull and len(faces):
+        # a face is identified by its bounds
+        faces = faces[~_first_of_groups(np.concatenate([faces.min(axis=1), faces.max(axis=1)], axis=1))[1]]
+    return faces
+
+
+def face_edges(faces):
+    """
+    Function computing the edges of axis aligned faces, the edges shared by several faces being returned once.
+    :param faces: (F,4,3) array of the corners of the faces, as returned by box_faces
+    :return: (E,2,3) array of the end points of the edges
+    """
+    edges = np.stack([faces, np.roll(faces, -1, axis=1)], axis=2).reshape(-1, 2, 3)
+    # the edges are axis aligned, so their lower and upper end points are the minima and maxima of their coordinates
+    edges = np.stack([edges.min(axis=1), edges.max(axis=1)], axis=1)
+    if len(edges) == 0:
+        return edges
+    return edges[_first_of_groups(edges.reshape(-1, 6))[0]]
+
+
+def draw_boxes(ax, lower, upper, color="r", cull=True):
+    """
+    Function drawing axis aligned boxes as one collection of transparent faces and one collection of edges, instead
+    of one artist per face and edge.
+    :param ax: 3D axes
+    :param lower: (N,3) array of the lower corners of the boxes
+    :param upper: (N,3) array of the upper corners of the boxes
+    :param color: color of the boxes
+    :param cull: if True the faces shared by two boxes are not drawn
+    """
+    faces = box_faces(lower, upper, cull)
+    ax.add_collection3d(Poly3DCollection(faces, facecolors=cs.to_rgba(color, 0.2), edgecolors='none'))
+    ax.add_collection3d(Line3DCollection(face_edges(faces), colors=color, linewidths=0.5))
+
+
+def set_limits(ax, lower, upper):
+    """
+    Function setting the limits of 3D axes to the bounding box of boxes, collections are not taken into account by
+    the automatic limits.
+    :param ax: 3D axes
+    :param lower: (N,3) array of the lower corners of the boxes
+    :param upper: (N,3) array of the upper corners of the boxes
+    """
+    lower = np.asarray(lower, dtype=float).reshape(-1, 3)
+    upper = np.asarray(upper, dtype=float).reshape(-1, 3)
+    if len(lower) == 0:
+        return
+    low = lower.min(axis=0)
+    high = upper.max(axis=0)
+    ax.set_xlim3d(low[0], high[0])
+    ax.set_ylim3d(low[1], high[1])
+    ax.set_zlim3d(low[2], high[2])
+
+
 def show_oct_tree(tree):
     ax = make_ax()
-    for node in tree:
-        if node.leaf:
-            if len(node.points) > 0:
-                rect_prism(np.array([node.corners['x_min'], node.corners['x_max']]),
-                           np.array([node.corners['y_min'], node.corners['y_max']]),
-                           np.array([node.corners['z_min'], node.corners['z_max']]), ax, "r")
-            else:
-                rect_prism(np.array([node.corners['x_min'], node.corners['x_max']]),
-                           np.array([node.corners['y_min'], node.corners['y_max']]),
-                           np.array([node.corners['z_min'], node.corners['z_max']]), ax, "b")
+    leaves = np.flatnonzero(tree.leaf)
+    bounds = tree.bounds[leaves]
+    occupied = tree.point_end[leaves] > tree.point_start[leaves]
+    draw_boxes(ax, bounds[occupied, :3], bounds[occupied, 3:], "r")
+    draw_boxes(ax, bounds[~occupied, :3], bounds[~occupied, 3:], "b")
+    set_limits(ax, bounds[:, :3], bounds[:, 3:])
+
+    plt.show()
+
+
+def show_occupancy_oct_tree(tree):
+    ax = make_ax()
+    occupied = tree.values > oc.OCCUPANCY_THRESHOLD
+    bounds = tree.leaf_bounds()[occupied]
+    draw_boxes(ax, bounds[:, :3], bounds[:, 3:], "r")
+    set_limits(ax, bounds[:, :3], bounds[:, 3:])
 
     plt.show()
 
@@ -86,27 +179,33 @@ def show_pseudo_measurements(pseudo_walls):
     plt.show()
 
 
-def show_pseudo_dense_grid(h):
+def show_pseudo_dense_grid(h, voxel_budget=DENSE_VOXEL_BUDGET):
     ax = make_ax()
 
-    alpha = np.expand_dims(h / h.max(), axis=3)
-    colors = np.array([[[[0.12, 0.46, 0.7]] * alpha.shape[2]] * alpha.shape[1]] * alpha.shape[0])
-    colors = np.append(colors, alpha, axis=3)
-    colors = np.apply_along_axis(to_hex_wrapper, 3, colors)
-
-    filled = explode(np.ones(colors.shape))
-    colors = explode(colors)
-
-    x, y, z = expand_coordinates(np.indices(np.array(filled.shape) + 1))
-    ax.voxels(x, y, z, filled, facecolors=colors, edgecolors='#80808001', shade=False)
+    # the grid is summed over 2x2x2 voxels until the non-empty voxels fit in the budget
+    scale = 1
+    while np.count_nonzero(h) > voxel_budget and max(h.shape) > 1:
+        h = vp.reduce_dense_grid(h, 'sum')
+        scale *= 2
+    cells = np.argwhere(h > 0)
+    values = h[tuple(cells.T)]
+    colors = np.empty((len(cells), 4))
+    colors[:, :3] = DENSE_VOXEL_COLOR
+    colors[:, 3] = values / values.max() if len(values) else 1
+
+    lower = cells * scale
+    faces = box_faces(lower, lower + scale, cull=False)
+    ax.add_collection3d(Poly3DCollection(faces, facecolors=np.repeat(colors, len(BOX_FACES), axis=0),
+                                         edgecolors='none'))
+    set_limits(ax, np.zeros((1, 3)), np.array(h.shape) * scale)
     plt.show()
 
 
 def show_pseudo_sparse_grid(sparse):
     ax = make_ax()
-    for cell in sparse.elements:
-        rect_prism(np.array([cell[0], cell[0] + 1]), np.array([cell[1], cell[1] + 1]), np.array([cell[2], cell[2] + 1]),
-                   ax, "r")
+    cells = sparse.coordinates()
+    draw_boxes(ax, cells, cells + 1, "r")
+    set_limits(ax, cells, cells + 1)
     plt.show()
 
 
@@ -116,33 +215,21 @@ def show_pseudo_pointcloud(points):
     plt.show()
 
 
-def show_pseudo_mesh(mesh):
+def show_pseudo_mesh(vertices, polygon_offsets, polygon_indices):
     ax = make_ax()
 
-    x_min = float('Inf')
-    x_max = -float('Inf')
-    y_min = float('Inf')
-    y_max = -float('Inf')
-    z_min = float('Inf')
-    z_max = -float('Inf')
-
-    verts = []
-    for pw in mesh:
-        x, y, z = he.get_points_from_mesh(pw)
-        x_min = min(x_min, min(x))
-        x_max = max(x_max, max(x))
-        y_min = min(y_min, min(y))
-        y_max = max(y_max, max(y))
-        z_min = min(z_min, min(z))
-        z_max = max(z_max, max(z))
-
-        verts.append(list(zip(x, y, z)))
-
+    vertices = np.asarray(vertices, dtype=float).reshape(-1, 3)
+    indices = np.asarray(polygon_indices)
+    offsets = np.asarray(polygon_offsets).tolist()
+    verts = [vertices[indices[start:end]] for start, end in zip(offsets[:-1], offsets[1:])]
     poly = Poly3DCollection(verts, alpha=.6)
 
-    ax.set_xlim3d(x_min, x_max)
-    ax.set_ylim3d(y_min, y_max)
-    ax.set_zlim3d(z_min, z_max)
+    if len(vertices) > 0:
+        x_min, y_min, z_min = vertices.min(axis=0)
+        x_max, y_max, z_max = vertices.max(axis=0)
+        ax.set_xlim3d(x_min, x_max)
+        ax.set_ylim3d(y_min, y_max)
+        ax.set_zlim3d(z_min, z_max)
 
     ax.add_collection3d(poly)
 
@@ -0,0 +1,115 @@
+import numpy as np
+
+import nd_sparse_matrix as sp
+
+# reductions of the 2x2x2 voxels of a level into the voxel of the next coarser level
+reductions = {'sum': np.add, 'max': np.maximum, 'any': np.logical_or}
+# padding of the odd sized axes, neutral for the reduction
+padding_modes = {'sum': 'constant', 'max': 'edge', 'any': 'edge'}
+
+
+def level_resolution(resolution, level):
+    """
+    Function computing the size of the voxels of a level of the pyramid.
+    :param resolution: three element list describing the size of a voxel of level 0 along each dimension
+    :param level: level of the pyramid, 0 for the finest
+    :return: three element list of the sizes of the voxels of the level
+    """
+    return [r * 2 ** level for r in resolution]
+
+
+def level_shape(shape, level):
+    """
+    Function computing the number of voxels of a level of the pyramid, every level halving the previous one rounded up.
+    :param shape: three element list of the number of voxels of level 0 along each dimension
+    :param level: level of the pyramid, 0 for the finest
+    :return: three element list of the number of voxels of the level
+    """
+    return [-(-int(s) // 2 ** level) for s in shape]
+
+
+def _check_reductions(names, count):
+    names = [names] * count if isinstance(names, str) else list(names)
+    if len(names) != count:
+        raise ValueError("%d reductions given for %d characteristics" % (len(names), count))
+    for name in names:
+        if name not in reductions:
+            raise ValueError("%s is an invalid reduction, use one of %s" % (name, ', '.join(reductions)))
+    return names
+
+
+def reduce_dense_grid(grid, reduction='sum'):
+    """
+    Function computing the next coarser level of a dense grid, every voxel combining 2x2x2 voxels of the grid. Odd
+    sized axes are padded so the reduction is not affected.
+    :param grid: array indexed by (x, y, z), with a last axis for the characteristics if there are more than one
+    :param reduction: name of the reduction of reductions, or list of names, one per characteristic
+    :return: array of the coarser level, of size ceil(size / 2) along each axis
+    """
+    grid = np.asarray(grid)
+    values = grid if grid.ndim == 4 else grid[..., None]
+    names = _check_reductions(reduction, values.shape[3])
+    levels = []
+    for c, name in enumerate(names):
+        channel = values[..., c]
+        pad = [(0, s % 2) for s in channel.shape]
+        channel = np.pad(channel, pad, mode=padding_modes[name])
+        x, y, z = (s // 2 for s in channel.shape)
+        blocks = channel.reshape(x, 2, y, 2, z, 2)
+        reduced = reductions[name].reduce(reductions[name].reduce(reductions[name].reduce(blocks, axis=5), axis=3),
+                                          axis=1)
+        levels.append(reduced.astype(grid.dtype))
+    return np.stack(levels, axis=-1) if grid.ndim == 4 else levels[0]
+
+
+def dense_pyramid(grid, levels=None, reduction='sum'):
+    """
+    Function computing the multi-resolution pyramid of a dense grid, each level being reduced from the previous one
+    only.
+    :param grid: array of level 0 indexed by (x, y, z), with a last axis for the characteristics if there are more
+    than one
+    :param levels: number of levels, by default until a single voxel remains
+    :param reduction: name of the reduction of reductions, or list of names, one per characteristic
+    :return: list of the arrays of the levels, level 0 first
+    """
+    pyramid = [np.asarray(grid)]
+    while (levels is None and max(pyramid[-1].shape[:3]) > 1) or (levels is not None and len(pyramid) < levels):
+        pyramid.append(reduce_dense_grid(pyramid[-1], reduction))
+    return pyramid
+
+
+def reduce_sparse_grid(sparse_grid, reduction='sum'):
+    """
+    Function computing the next coarser level of a sparse grid, every voxel combining the stored voxels among 2x2x2
+    voxels of the grid, so the cost depends on the number of stored voxels only.
+    :param sparse_grid: NDSparseMatrix
+    :param reduction: name of the reduction of reductions
+    :return: NDSparseMatrix of the coarser level
+    """
+    name, = _check_reductions(reduction, 1)
+    coarse = sp.NDSparseMatrix(sparse_grid.ndim, sparse_grid.values.dtype)
+    if len(sparse_grid) == 0:
+        return coarse
+    keys = coarse.pack(sparse_grid.coordinates() >> 1)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    values = reductions[name].reduceat(sparse_grid.values[order], starts)
+    coarse.keys = keys[starts]
+    coarse.values = values.astype(sparse_grid.values.dtype)
+    return coarse
+
+
+def sparse_pyramid(sparse_grid, levels=None, reduction='sum'):
+    """
+    Function computing the multi-resolution pyramid of a sparse grid, each level being reduced from the previous one
+    only.
+    :param sparse_grid: NDSparseMatrix of level 0
+    :param levels: number of levels, by default until a single voxel remains
+    :param reduction: name of the reduction of reductions
+    :return: list of the NDSparseMatrix of the levels, level 0 first
+    """
+    pyramid = [sparse_grid]
+    while (levels is None and len(pyramid[-1]) > 1) or (levels is not None and len(pyramid) < levels):
+        pyramid.append(reduce_sparse_grid(pyramid[-1], reduction))
+    return pyramid